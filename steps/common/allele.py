@@ -1,7 +1,11 @@
-from typing import Dict, List
-from Bio.SeqIO.FastaIO import FastaIterator
+from typing import Dict, Iterator, List, Optional, Tuple
+from functools import lru_cache
 
 import hashlib
+import re
+import sys
+
+import numpy as np
 
 
 locus_ignore_list = ['MICA','MICB','TAP1','TAP2']
@@ -132,10 +136,198 @@ class_i_starts = [
 
 allele_name_modifiers = ['N','L','S','C','A','Q']
 
-def fasta_reader(filename:str) -> List:
-    with open(filename) as handle:
-        for record in FastaIterator(handle):
-            yield record
+
+def build_trie_pattern(motifs:List[str]) -> str:
+    """
+    This function builds a regular expression for a set of literal motifs, with the alternation nested as a prefix trie so that each position in a sequence is only tested once per character
+
+    Args:
+        motifs (List[str]): the literal motifs to be matched
+
+    Returns:
+        str: the regular expression, longer motifs are preferred over shorter ones which are their prefixes
+    """
+    trie = {}
+    for motif in motifs:
+        node = trie
+        for character in motif:
+            node = node.setdefault(character, {})
+        node[''] = True
+
+    def build_node(node:Dict) -> str:
+        if '' in node and len(node) == 1:
+            return ''
+        branches = [re.escape(character) + build_node(child) for character, child in sorted(node.items()) if character != '']
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = f"(?:{'|'.join(branches)})"
+        if '' in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build_node(trie)
+
+
+# the full starts are ranked by their first appearance in class_i_starts, which is the order in which they were previously tested
+class_i_start_ranks = {}
+for rank, start in enumerate(class_i_starts):
+    class_i_start_ranks.setdefault(start, rank)
+
+# the truncated starts (missing the first residue) are ranked by their last appearance, as previously the last truncated match found was kept
+class_i_truncated_start_ranks = {}
+for rank, start in enumerate(class_i_starts):
+    class_i_truncated_start_ranks[start[1:]] = rank
+
+# a single lookahead pattern which finds every (possibly overlapping) full or truncated start in one scan of the sequence
+class_i_start_pattern = re.compile(f"(?=({build_trie_pattern(list(class_i_start_ranks) + list(class_i_truncated_start_ranks))}))")
+
+
+def find_class_i_start(sequence:str) -> Tuple[Optional[str], Optional[int], bool]:
+    """
+    This function finds the best matching Class I start motif in a sequence in a single pass
+
+    A full start motif is always preferred over a truncated one (a start motif missing its first residue).
+
+    Args:
+        sequence (str): the protein sequence to be searched
+
+    Returns:
+        str: the start motif matched, or None if there is no match
+        int: the position of the first occurrence of the start motif in the sequence, or None if there is no match
+        bool: whether the start motif matched is a truncated one
+    """
+    full_match = None
+    truncated_match = None
+    for match in class_i_start_pattern.finditer(sequence):
+        motif = match.group(1)
+        if motif in class_i_start_ranks:
+            rank = class_i_start_ranks[motif]
+            if full_match is None or rank < full_match[0]:
+                full_match = (rank, motif, match.start())
+        elif full_match is None:
+            rank = class_i_truncated_start_ranks[motif]
+            if truncated_match is None or rank > truncated_match[0]:
+                truncated_match = (rank, motif, match.start())
+    if full_match:
+        return full_match[1], full_match[2], False
+    elif truncated_match:
+        return truncated_match[1], truncated_match[2], True
+    else:
+        return None, None, False
+
+
+def parse_fasta_record(record:bytes) -> Optional[Tuple[str, str]]:
+    """
+    This function parses a single raw FASTA record (the header line and its sequence lines) into its header and sequence
+
+    Args:
+        record (bytes): the raw record, with or without the leading > character
+
+    Returns:
+        Tuple[str, str]: the header (without the > character) and the sequence with all whitespace removed, or None for an empty record
+    """
+    header, _, body = record.partition(b'\n')
+    header = header.lstrip(b'>').strip()
+    if not header:
+        return None
+    return header.decode('utf-8'), b''.join(body.split()).decode('ascii')
+
+
+def fasta_reader(filename:str, chunk_size:int=1048576) -> Iterator[Tuple[str, str]]:
+    """
+    This function reads a FASTA file in large chunks and yields the header and sequence of each record in turn
+
+    Args:
+        filename (str): the path to the FASTA file
+        chunk_size (int): the number of bytes read from the file at a time
+
+    Returns:
+        Iterator[Tuple[str, str]]: the header (description) and sequence of each record
+    """
+    with open(filename, 'rb') as handle:
+        buffer = b''
+        first_record = True
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            buffer += chunk
+            # records are separated by a > at the start of a line, the last piece may be incomplete so is carried over
+            records = buffer.split(b'\n>')
+            buffer = records.pop()
+            for record in records:
+                # any text before the first record header is not part of a record
+                if first_record:
+                    first_record = False
+                    if not record.lstrip().startswith(b'>'):
+                        continue
+                entry = parse_fasta_record(record)
+                if entry:
+                    yield entry
+        if first_record and not buffer.lstrip().startswith(b'>'):
+            return
+        entry = parse_fasta_record(buffer)
+        if entry:
+            yield entry
+
+
+@lru_cache(maxsize=None)
+def allele_sort_key(gene_allele_name:str) -> Optional[Tuple[Tuple[int, ...], str]]:
+    """
+    This function generates the natural sort key for an allele name, used to find the canonical (lowest numbered) allele
+
+    The allele number fields are padded to four with 01 (so HLA-A*02:01 sorts with HLA-A*02:01:01:01) and any expression or isoform modifier is kept as a tie breaker. The key is cached as the same allele name is seen many times over a run.
+
+    Args:
+        gene_allele_name (str): the allele name e.g. HLA-A*02:01:01:01
+
+    Returns:
+        Tuple[Tuple[int, ...], str]: the integer allele number fields and the modifier (or an empty string), or None if the allele number is not numeric e.g. for non-standard nomenclature
+    """
+    if '*' not in gene_allele_name:
+        return None
+    allele_number = gene_allele_name.split('*')[1]
+    suffix = ''
+    # check if the allele number contains a modifier which relates to expression level or soluble isoform
+    #TODO think about whether we should just bin these from ever being considered for canonicity
+    if allele_number and allele_number[-1] in allele_name_modifiers:
+        suffix = allele_number[-1]
+        allele_number = allele_number[:-1]
+    fields = allele_number.split(':')
+    # some allele numbers include letters, we need to ignore these
+    if not all([field.isnumeric() for field in fields]):
+        return None
+    fields = [int(field) for field in fields]
+    while len(fields) < 4:
+        fields.append(1)
+    return tuple(fields), suffix
+
+
+class AlleleRecord():
+    """
+    A compact, slotted representation of the allele information parsed from a single sequence record
+
+    The locus and source strings are interned as they are shared by every record of a locus.
+    """
+    fields = ['protein_allele_name', 'gene_allele_name', 'locus', 'id', 'source']
+    __slots__ = fields
+
+    def __init__(self, protein_allele_name:str, gene_allele_name:str, locus:str, id:str, source:str):
+        self.protein_allele_name = protein_allele_name
+        self.gene_allele_name = gene_allele_name
+        self.locus = sys.intern(locus)
+        self.id = id
+        self.source = sys.intern(source)
+
+
+    @classmethod
+    def from_allele_info(cls, allele_info:Dict) -> 'AlleleRecord':
+        return cls(**allele_info)
+
+
+    def to_dict(self) -> Dict:
+        return {field:getattr(self, field) for field in self.fields}
 
 
 def parse_hla_description(description:str) -> Dict:
@@ -190,23 +382,12 @@ def parse_mhc_description(description:str) -> Dict:
 
      
 def find_canonical_allele(allele_set:Dict):
-    # set min to be far higher initially than the numerical representation of the allele number
-    min = 10000000000  
-    for this_allele in allele_set['alleles']:
-        allele_number = this_allele['gene_allele_name'].split('*')[1]
-        # check if the allele number contains a modifier which relates to expression level or soluble isoform
-        #TODO think about whether we should just bin these from ever being considered for canonicity
-        if allele_number[-1] in allele_name_modifiers:
-            allele_number = allele_number[:-1]
-        while allele_number.count(':') < 3:
-            allele_number += ':01'
-        # some allele numbers include letters, we need to ignore these
-        if allele_number.replace(':','').isnumeric():
-            # then cast to an int
-            allele_number_numeric = int(allele_number.replace(':',''))
-            if allele_number_numeric < min:
-                min = allele_number_numeric
-                allele_set['canonical_allele'] = this_allele
+    # the canonical allele is the one with the lowest natural sort key, the first one seen wins any ties
+    # the key of each allele is looked up once, alleles without a numeric key are never canonical
+    sort_keys = [allele_sort_key(this_allele['gene_allele_name']) for this_allele in allele_set['alleles']]
+    candidates = [i for i, sort_key in enumerate(sort_keys) if sort_key is not None]
+    if candidates:
+        allele_set['canonical_allele'] = allele_set['alleles'][min(candidates, key=lambda i: sort_keys[i])]
     return allele_set
 
     
@@ -218,31 +399,83 @@ def build_pocket_pseudosequence(sequence:str, pocket_residues:List) -> str:
     return pseudosequence
 
 
+def encode_sequences(sequences:List[str], width:Optional[int]=None, gap_character:str='-') -> np.ndarray:
+    """
+    This function packs a list of sequences into a fixed width matrix of single byte residue codes, one row per sequence
+
+    Args:
+        sequences (List[str]): the sequences to be encoded
+        width (int): the width of the matrix, sequences are padded or trimmed to this width, defaults to the length of the longest sequence
+        gap_character (str): the character used to pad sequences shorter than the width
+
+    Returns:
+        np.ndarray: a uint8 matrix of shape (number of sequences, width)
+    """
+    if width is None:
+        width = max([len(sequence) for sequence in sequences], default=0)
+    packed = ''.join([sequence[:width].ljust(width, gap_character) for sequence in sequences])
+    return np.frombuffer(packed.encode('ascii'), dtype=np.uint8).reshape(len(sequences), width)
+
+
+def decode_sequences(matrix:np.ndarray) -> List[str]:
+    """
+    This function converts a matrix of single byte residue codes back into a list of sequences, one per row
+
+    Args:
+        matrix (np.ndarray): a uint8 matrix as generated by encode_sequences
+
+    Returns:
+        List[str]: the sequences
+    """
+    width = matrix.shape[1]
+    if width == 0:
+        return ['' for row in matrix]
+    packed = np.ascontiguousarray(matrix).tobytes().decode('ascii')
+    return [packed[i:i + width] for i in range(0, len(packed), width)]
+
+
+def build_pocket_pseudosequences(sequences:List[str], pocket_residues:List) -> Tuple[List[str], np.ndarray]:
+    """
+    This function builds the pocket pseudosequences for a batch of sequences in a single operation
+
+    Sequences which are too short to contain a pocket residue are padded with gaps.
+
+    Args:
+        sequences (List[str]): the trimmed cytoplasmic sequences
+        pocket_residues (List): the (1 based) IMGT numbered pocket residues
+
+    Returns:
+        List[str]: the pocket pseudosequences, in the same order as the sequences
+        np.ndarray: a uint8 matrix of shape (number of sequences, number of pocket residues) of the pocket pseudosequences
+    """
+    sequence_matrix = encode_sequences(sequences, width=max(pocket_residues))
+    pocket_matrix = sequence_matrix[:, np.array(pocket_residues) - 1]
+    return decode_sequences(pocket_matrix), pocket_matrix
+
+
 def process_sequence(sequence:str, pocket_residues:List) -> Dict:
     missing_start = None
     cytoplasmic_sequence = None
     gdomain_sequence = None
     pocket_pseudosequence = None
     appropriate_length = None
-    start_match = False
     has_class_i_start = False
     if len(sequence) > 270:
         appropriate_length = True
-        for start in class_i_starts:
-            if start in sequence:
-                has_class_i_start = True
-                start_string = start
-                missing_start = False
-                start_match = True
-                break
-            elif start[1:] in sequence and not start_match:
-                has_class_i_start = True
-                start_string = start[1:]
-                missing_start = True
+        start_string, start_position, missing_start = find_class_i_start(sequence)
+        if start_string:
+            has_class_i_start = True
+        else:
+            missing_start = None
     else:
         appropriate_length = False
     if has_class_i_start:
-        cytoplasmic_sequence = start_string + sequence.split(start_string)[1]
+        # the cytoplasmic sequence runs from the start motif up to any repeat of the motif
+        end_position = sequence.find(start_string, start_position + len(start_string))
+        if end_position == -1:
+            cytoplasmic_sequence = sequence[start_position:]
+        else:
+            cytoplasmic_sequence = sequence[start_position:end_position]
         if missing_start:
             cytoplasmic_sequence = f"-{cytoplasmic_sequence[:274]}"
         cytoplasmic_sequence = cytoplasmic_sequence[:275]
@@ -0,0 +1,75 @@
+from typing import Dict, Optional
+
+import json
+
+
+# the types of data the steps publish, these match the folders in output/processed_data the data is also written to
+artifact_types = ['protein_alleles', 'cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences', 'allele_suffixes', 'reference_alleles', 'allele_groups']
+
+
+class ArtifactStore():
+    """
+    An in-memory store of the data a step has written to the processed_data folder, keyed by data type and locus slug, so that later steps run in the same process can use it without reading the JSON files back in
+
+    Data taken from the store is shared between steps, so steps must not modify it.
+    """
+    def __init__(self):
+        self.artifacts = {}
+
+
+    def publish(self, data_type:str, locus_slug:str, data:Dict, sort_keys:bool=False):
+        """
+        Adds the data for a locus to the store
+
+        Args:
+            data_type (str): the type of data e.g. protein_alleles
+            locus_slug (str): the slug for the locus e.g. hla_a
+            data (Dict): the data, as it was written to the JSON file
+            sort_keys (bool): whether the JSON file was written with sort_keys, if so the keys are put in the same order so the data is iterated in the same order as if it were loaded from the file
+        """
+        if data_type not in artifact_types:
+            raise ValueError(f"{data_type} is not one of the artifact types ({', '.join(artifact_types)})")
+        if sort_keys:
+            data = {key:data[key] for key in sorted(data)}
+        self.artifacts[(data_type, locus_slug)] = data
+
+
+    def get(self, data_type:str, locus_slug:str) -> Optional[Dict]:
+        """
+        Returns the data for a locus from the store
+
+        Args:
+            data_type (str): the type of data e.g. protein_alleles
+            locus_slug (str): the slug for the locus e.g. hla_a
+
+        Returns:
+            Dict: the data, or None if it has not been published in this process
+        """
+        return self.artifacts.get((data_type, locus_slug))
+
+
+def load_artifact(artifacts:Optional[ArtifactStore], data_type:str, locus_slug:str, output_path:str='output') -> Dict:
+    """
+    This function returns the data of a type for a locus, from the artifact store if a step in the same process has published it, otherwise from the JSON file in the output directory
+
+    Data loaded from the file is published to the store, so that later steps can use it as well.
+
+    Args:
+        artifacts (ArtifactStore): the artifact store for the pipeline run, or None if the step is running without one e.g. in a worker process
+        data_type (str): the type of data e.g. protein_alleles
+        locus_slug (str): the slug for the locus e.g. hla_a
+        output_path (str): the path to the output directory
+
+    Returns:
+        Dict: the data
+    """
+    if artifacts is not None:
+        data = artifacts.get(data_type, locus_slug)
+        if data is not None:
+            return data
+    filename = f"{output_path}/processed_data/{data_type}/{locus_slug}.json"
+    with open(filename, 'r') as json_file:
+        data = json.load(json_file)
+    if artifacts is not None:
+        artifacts.publish(data_type, locus_slug, data)
+    return data
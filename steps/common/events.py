@@ -0,0 +1,159 @@
+from typing import Dict, List, Optional
+
+import datetime
+import json
+import os
+
+
+def append_event(filename:str, event:Dict):
+    """
+    This function appends an event to a JSONL event log as a single line
+
+    The file is opened in append mode for each event, so steps running in worker processes can add events to the same log as the pipeline.
+
+    Args:
+        filename (str): the path to the event log
+        event (Dict): the event
+    """
+    with open(filename, 'a') as event_file:
+        event_file.write(f"{json.dumps(event)}\n")
+
+
+class EventLog():
+    """
+    An append-only JSONL log of the events of pipeline runs, so that a run can be followed while it is in progress e.g. with tail -f
+
+    Each event records the time, the run it belongs to (identified by the time the run started) and the type of event, along with any other details.
+    """
+    def __init__(self, filename:str, run_started_at:str):
+        self.filename = filename
+        self.run_started_at = run_started_at
+
+
+    def emit(self, event_type:str, **details):
+        """
+        Appends an event to the log
+
+        Args:
+            event_type (str): the type of event e.g. step_started
+            details: the details of the event e.g. the step and task
+        """
+        append_event(self.filename, {'time': datetime.datetime.now().isoformat(), 'run_started_at': self.run_started_at, 'event': event_type, **details})
+
+
+    def progress_reporter(self, task_id:str, step_action:str, interval:int) -> 'ProgressReporter':
+        """
+        Returns a progress reporter for a step, which adds its events to this log
+
+        Args:
+            task_id (str): the number (and substep number) of the step e.g. 3 or 9.1
+            step_action (str): the name of the step function
+            interval (int): the number of records between progress events
+
+        Returns:
+            ProgressReporter: the progress reporter
+        """
+        return ProgressReporter(self.filename, self.run_started_at, task_id, step_action, interval)
+
+
+class ProgressReporter():
+    """
+    Adds a step_progress event to the event log each time a step has processed another interval of records
+
+    Steps are passed a progress reporter in their progress argument and call update with the number of records processed so far. It holds no open files, so it can be passed to steps run in worker processes.
+    """
+    def __init__(self, filename:str, run_started_at:str, task_id:str, step_action:str, interval:int):
+        self.filename = filename
+        self.run_started_at = run_started_at
+        self.task_id = task_id
+        self.step_action = step_action
+        self.interval = interval
+        self.next_report = interval
+
+
+    def update(self, records_processed:int, total:Optional[int]=None):
+        """
+        Records the number of records processed so far, adding a progress event if another interval has been passed
+
+        Args:
+            records_processed (int): the number of records processed so far by the step
+            total (int): the number of records the step will process, if known
+        """
+        if self.interval < 1 or records_processed < self.next_report:
+            return
+        append_event(self.filename, {
+            'time': datetime.datetime.now().isoformat(),
+            'run_started_at': self.run_started_at,
+            'event': 'step_progress',
+            'task': self.task_id,
+            'step_action': self.step_action,
+            'records_processed': records_processed,
+            'total': total
+        })
+        self.next_report = (records_processed // self.interval + 1) * self.interval
+
+
+def report_progress(progress:Optional[ProgressReporter], records_processed:int, total:Optional[int]=None):
+    """
+    This function passes the number of records a step has processed to its progress reporter, if it has been given one
+
+    Args:
+        progress (ProgressReporter): the progress reporter for the step, or None
+        records_processed (int): the number of records processed so far by the step
+        total (int): the number of records the step will process, if known
+    """
+    if progress is not None:
+        progress.update(records_processed, total)
+
+
+def escape_label(label) -> str:
+    """
+    This function escapes a label value for the Prometheus text format, where backslashes, double quotes and newlines must be escaped
+
+    Args:
+        label: the label value
+
+    Returns:
+        str: the escaped label value
+    """
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metric(name:str, help_text:str, metric_type:str, samples:List) -> List[str]:
+    """
+    This function formats a metric in the Prometheus text exposition format
+
+    Args:
+        name (str): the name of the metric e.g. allele_pipeline_tasks_completed
+        help_text (str): the description of the metric
+        metric_type (str): the type of the metric e.g. gauge
+        samples (List): the labels (a dictionary) and value of each sample
+
+    Returns:
+        List[str]: the lines for the metric
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        if labels:
+            label_text = ','.join([f'{key}="{escape_label(label)}"' for key, label in labels.items()])
+            lines.append(f"{name}{{{label_text}}} {value}")
+        else:
+            lines.append(f"{name} {value}")
+    return lines
+
+
+def write_metrics(filename:str, metrics:List[Dict]):
+    """
+    This function writes a set of metrics to a Prometheus text file, replacing it atomically so that a scraper never reads a partly written file
+
+    Args:
+        filename (str): the path to the metrics file e.g. logs/allele_pipeline.prom
+        metrics (List[Dict]): the name, help text, type and samples of each metric, as arguments to format_metric
+    """
+    lines = []
+    for metric in metrics:
+        lines += format_metric(metric['name'], metric['help'], metric['type'], metric['samples'])
+    temporary_filename = f"{filename}.tmp"
+    with open(temporary_filename, 'w') as metrics_file:
+        metrics_file.write('\n'.join(lines) + '\n')
+    os.replace(temporary_filename, filename)
@@ -0,0 +1,244 @@
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import os
+import json
+import mmap
+
+from .allele import parse_hla_description, parse_h2_description, parse_mhc_description, parse_fasta_record
+from .pipeline import write_json_atomically
+
+
+# the description parser used for each downloaded dataset, these give the same ids, names and loci as the parsing steps use
+dataset_description_parsers = {
+    'IPD_IMGT_HLA_PROT': parse_hla_description,
+    'IPD_MHC_PROT': parse_mhc_description,
+    'H2_CLASS_I_PROT': parse_h2_description
+}
+
+
+def index_filename(filename:str) -> str:
+    """
+    This function returns the filename of the sidecar index for a FASTA file
+
+    Args:
+        filename (str): the path to the FASTA file
+
+    Returns:
+        str: the path to the index file
+    """
+    return f"{filename}.index.json"
+
+
+def source_fingerprint(filename:str) -> Dict:
+    """
+    This function returns the size and modification time of a file, used to check whether an index is still valid for it
+
+    Args:
+        filename (str): the path to the file
+
+    Returns:
+        Dict: the size and modification time (in nanoseconds) of the file
+    """
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_fasta_index(filename:str, description_parser:Callable) -> Dict:
+    """
+    This function scans a FASTA file once and writes a sidecar index of the byte offset and length of every record
+
+    Args:
+        filename (str): the path to the FASTA file
+        description_parser (Callable): the function used to parse each record description e.g. parse_hla_description
+
+    Returns:
+        Dict: the index, which is also written to the sidecar file
+    """
+    records = []
+    with open(filename, 'rb') as handle:
+        if os.path.getsize(filename) > 0:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_length = len(mapped)
+                # find the first record header
+                if mapped[:1] == b'>':
+                    start = 0
+                else:
+                    start = mapped.find(b'\n>')
+                    start = start + 1 if start != -1 else -1
+                while start != -1:
+                    end = mapped.find(b'\n>', start)
+                    end = end + 1 if end != -1 else file_length
+                    header_end = mapped.find(b'\n', start, end)
+                    if header_end == -1:
+                        header_end = end
+                    description = mapped[start + 1:header_end].decode('utf-8').strip()
+                    allele_info = description_parser(description)
+                    records.append([allele_info['id'], allele_info['gene_allele_name'], allele_info['locus'], start, end - start])
+                    start = end if end < file_length else -1
+
+    fasta_index = {
+        'source': source_fingerprint(filename),
+        'description_parser': description_parser.__name__,
+        'fields': ['id', 'gene_allele_name', 'locus', 'offset', 'length'],
+        'records': records
+    }
+    write_json_atomically(index_filename(filename), fasta_index)
+    return fasta_index
+
+
+def fasta_chunk_boundaries(filename:str, chunk_count:int) -> List[Tuple[int, int]]:
+    """
+    This function splits a FASTA file into roughly equal byte ranges which each start at a record boundary
+
+    Args:
+        filename (str): the path to the FASTA file
+        chunk_count (int): the number of chunks wanted, fewer may be returned for small files
+
+    Returns:
+        List[Tuple[int, int]]: the start and end byte offsets of each chunk, in file order
+    """
+    file_length = os.path.getsize(filename)
+    if file_length == 0:
+        return []
+    boundaries = [0]
+    with open(filename, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for i in range(1, chunk_count):
+                boundary = mapped.find(b'\n>', max(file_length * i // chunk_count, boundaries[-1]))
+                if boundary == -1:
+                    break
+                if boundary + 1 > boundaries[-1]:
+                    boundaries.append(boundary + 1)
+    boundaries.append(file_length)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def fasta_chunk_reader(filename:str, start:int, end:int) -> Iterator[Tuple[str, str]]:
+    """
+    This function yields the description and sequence of each record in a byte range of a FASTA file, as produced by fasta_chunk_boundaries
+
+    Args:
+        filename (str): the path to the FASTA file
+        start (int): the byte offset of the start of the chunk
+        end (int): the byte offset of the end of the chunk
+
+    Returns:
+        Iterator[Tuple[str, str]]: the header (description) and sequence of each record
+    """
+    with open(filename, 'rb') as handle:
+        handle.seek(start)
+        chunk = handle.read(end - start)
+    for i, record in enumerate(chunk.split(b'\n>')):
+        # any text before the first record header of the file is not part of a record
+        if i == 0 and not record.lstrip().startswith(b'>'):
+            continue
+        entry = parse_fasta_record(record)
+        if entry:
+            yield entry
+
+
+class FastaIndex():
+    """
+    Random access to the records of an indexed FASTA file by accession, gene allele name or locus, through a memory map of the file
+    """
+    def __init__(self, filename:str, fasta_index:Dict):
+        self.filename = filename
+        self.description_parser = fasta_index['description_parser']
+        self.records = fasta_index['records']
+        self.by_id = {}
+        self.by_gene_allele_name = {}
+        self.by_locus = {}
+        for position, (id, gene_allele_name, locus, offset, length) in enumerate(self.records):
+            self.by_id[id] = position
+            self.by_gene_allele_name[gene_allele_name] = position
+            if locus not in self.by_locus:
+                self.by_locus[locus] = []
+            self.by_locus[locus].append(position)
+        self.handle = None
+        self.mapped = None
+
+
+    def open(self):
+        if self.mapped is None:
+            self.handle = open(self.filename, 'rb')
+            self.mapped = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.handle.close()
+            self.mapped = None
+            self.handle = None
+
+
+    def __enter__(self):
+        self.open()
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def read_record(self, position:int) -> Tuple[str, str]:
+        self.open()
+        offset, length = self.records[position][3:5]
+        return parse_fasta_record(self.mapped[offset:offset + length])
+
+
+    def get_by_id(self, id:str) -> Optional[Tuple[str, str]]:
+        if id not in self.by_id:
+            return None
+        return self.read_record(self.by_id[id])
+
+
+    def get_by_gene_allele_name(self, gene_allele_name:str) -> Optional[Tuple[str, str]]:
+        if gene_allele_name not in self.by_gene_allele_name:
+            return None
+        return self.read_record(self.by_gene_allele_name[gene_allele_name])
+
+
+    def reader(self, loci:List[str]) -> Iterator[Tuple[str, str]]:
+        """
+        Yields the description and sequence of every record for a set of loci, in the order they appear in the file
+        """
+        positions = []
+        for locus in loci:
+            if locus in self.by_locus:
+                positions += self.by_locus[locus]
+        for position in sorted(positions):
+            yield self.read_record(position)
+
+
+def load_fasta_index(filename:str, description_parser:Optional[Callable]=None) -> Optional[FastaIndex]:
+    """
+    This function loads the sidecar index for a FASTA file, rebuilding it if a description parser is supplied and the index is missing or out of date
+
+    Args:
+        filename (str): the path to the FASTA file
+        description_parser (Callable): the function used to parse each record description, if not supplied a missing or stale index is not rebuilt
+
+    Returns:
+        FastaIndex: the index, or None if there is no valid index for the file
+    """
+    if not os.path.exists(filename):
+        return None
+    fasta_index = None
+    if os.path.exists(index_filename(filename)):
+        with open(index_filename(filename), 'r') as index_file:
+            try:
+                fasta_index = json.load(index_file)
+            except json.JSONDecodeError:
+                # an index left partly written by an earlier version is treated as missing
+                fasta_index = None
+        # the index is only valid for the exact file it was built from, and with the same description parser
+        if fasta_index is not None and fasta_index['source'] != source_fingerprint(filename):
+            fasta_index = None
+        elif fasta_index is not None and description_parser is not None and fasta_index['description_parser'] != description_parser.__name__:
+            fasta_index = None
+    if fasta_index is None:
+        if description_parser is None:
+            return None
+        fasta_index = build_fasta_index(filename, description_parser)
+    return FastaIndex(filename, fasta_index)
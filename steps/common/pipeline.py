@@ -1,17 +1,26 @@
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import toml
 import json
-
-import git
-from importlib.metadata import version
-from dparse import parse, filetypes
+import os
+import glob
+import importlib
+import importlib.util
         
 import datetime
 import hashlib
+import time
+import re
+import resource
+import sys
+import cProfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from rich import print
 
+from .artifacts import ArtifactStore
+from .events import EventLog, write_metrics
+
 def load_config(console, verbose:bool=False) -> Dict:
     """ 
     Loads the configuration file for the pipline and returns a dictionary of values
@@ -33,6 +42,24 @@ def load_config(console, verbose:bool=False) -> Dict:
     return config
 
 
+def get_output_paths(config:Dict, mode:str) -> Tuple[str, str]:
+    """
+    Returns the output and log directories for a mode, in release mode these are in the warehouse
+
+    Args:
+        config (Dict) - the configuration dictionary
+        mode (str) - the mode the pipeline is run in, development or release
+
+    Returns:
+        str: the path to the output directory
+        str: the path to the log directory
+    """
+    if mode == 'release':
+        # switch the output directory to the warehouse
+        return f"{config['PATHS']['WAREHOUSE_PATH']}/{config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}", f"{config['PATHS']['WAREHOUSE_PATH']}/logs/{config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}"
+    return config['PATHS']['OUTPUT_PATH'], config['PATHS']['LOG_PATH']
+
+
 def read_lockfile(filename:str) -> Optional[str]:
     """
     Reads the content of a lockfile
@@ -65,11 +92,31 @@ def write_lockfile(filename:str, text:str):
     pass
 
 
+def write_json_atomically(filename:str, data:Dict):
+    """
+    Writes a JSON file by writing a temporary file alongside it and renaming it into place, so the file is never left partly written if the pipeline fails
+
+    The temporary file is named for the process writing it, so steps running in different worker processes can safely write the same file.
+
+    Args:
+        filename (str) - the filename of the JSON file
+        data (Dict) - the data to be written
+    """
+    temporary_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, 'w') as json_file:
+        json_file.write(json.dumps(data, sort_keys=True, indent=4))
+    os.replace(temporary_filename, filename)
+
+
 def get_current_time() -> str:
     return datetime.datetime.now().isoformat()
 
 
 def get_dependencies() -> Dict:
+    # dparse is only imported when the dependency versions are not already in the provenance cache
+    from dparse import parse, filetypes
+    from importlib.metadata import version
+
     with open('Pipfile','r') as file:
         pipfile = parse(file.read(), file_type=filetypes.pipfile)
     json_pipfile = json.loads(pipfile.json())
@@ -79,24 +126,315 @@ def get_dependencies() -> Dict:
         
 
 
+def read_git_head(path:str='.') -> Optional[str]:
+    """
+    Returns the commit sha of HEAD by reading the files in the .git folder, which is much faster than opening the repository with GitPython
+
+    Args:
+        path (str) - the path to search upwards from for the .git folder
+
+    Returns:
+        str: the commit sha, or None if it cannot be read directly e.g. in a worktree
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(os.path.join(path, '.git')):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    git_path = os.path.join(path, '.git')
+    with open(f"{git_path}/HEAD", 'r') as head_file:
+        head = head_file.read().strip()
+    if not head.startswith('ref: '):
+        return head
+    ref = head[5:]
+    if os.path.exists(f"{git_path}/{ref}"):
+        with open(f"{git_path}/{ref}", 'r') as ref_file:
+            return ref_file.read().strip()
+    if os.path.exists(f"{git_path}/packed-refs"):
+        with open(f"{git_path}/packed-refs", 'r') as packed_refs_file:
+            for line in packed_refs_file:
+                if line.strip().endswith(f" {ref}"):
+                    return line.split()[0]
+    return None
+
+
+def get_provenance(cache_filename:str) -> Dict:
+    """
+    Returns the repository name, commit sha and dependency versions of the pipeline
+
+    These are cached, and only gathered again with GitPython and dparse when the commit or the Pipfile have changed.
+
+    Args:
+        cache_filename (str) - the filename of the provenance cache
+
+    Returns:
+        Dict: the repository name, pipeline version (commit sha) and dependency versions
+    """
+    pipeline_version = read_git_head()
+    pipfile = {'size': os.path.getsize('Pipfile'), 'mtime_ns': os.stat('Pipfile').st_mtime_ns} if os.path.exists('Pipfile') else None
+    if pipeline_version and os.path.exists(cache_filename):
+        with open(cache_filename, 'r') as cache_file:
+            provenance = json.load(cache_file)
+        if provenance['pipeline_version'] == pipeline_version and provenance['pipfile'] == pipfile:
+            return provenance
+
+    import git
+    repo = git.Repo(search_parent_directories=True)
+    provenance = {
+        'repository_name': repo.remotes.origin.url.split('.git')[0].split('/')[-1],
+        'pipeline_version': repo.head.object.hexsha,
+        'pipfile': pipfile,
+        'dependencies': get_dependencies()
+    }
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    write_json_atomically(cache_filename, provenance)
+    return provenance
+
+
+def file_hash(filename:str) -> str:
+    """
+    Returns the SHA-256 hex digest of the contents of a file
+
+    Args:
+        filename (str) - the path to the file
+
+    Returns:
+        str: the hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_files(patterns:List[str]) -> Dict:
+    """
+    Returns the content hashes of the files matching a list of paths or glob patterns
+
+    Args:
+        patterns (List[str]) - the paths or glob patterns of the files
+
+    Returns:
+        Dict: the hex digest for each file, keyed by path, a pattern with no matching files is recorded with a value of None
+    """
+    hashes = {}
+    for pattern in patterns:
+        filenames = sorted(glob.glob(pattern))
+        if not filenames:
+            hashes[pattern] = None
+        for filename in filenames:
+            hashes[filename] = file_hash(filename)
+    return hashes
+
+
+def resolve_step_function(function_name:str) -> Callable:
+    """
+    Imports the module of a step function and returns the function, so that a step's module is only imported when the step is run
+
+    Args:
+        function_name (str) - the module and name of the step function e.g. parse_class_i_locus_data.construct_class_i_locus_allele_lists
+
+    Returns:
+        Callable: the step function
+    """
+    module_name, name = function_name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), name)
+
+
+def get_code_version(function_name:str) -> str:
+    """
+    Returns a hash of the source of the module a step function is defined in, and of the shared code in the common package
+
+    The module is located without being imported.
+
+    Args:
+        function_name (str) - the module and name of the step function
+
+    Returns:
+        str: the hex digest
+    """
+    common_path = os.path.dirname(os.path.abspath(__file__))
+    source_files = [importlib.util.find_spec(function_name.rsplit('.', 1)[0]).origin] + sorted(glob.glob(f"{common_path}/*.py"))
+    digest = hashlib.sha256()
+    for source_file in source_files:
+        digest.update(file_hash(source_file).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# the action log keys used by steps to report how many sequence records they have read
+record_count_keys = ['sequences_processed', 'all_sequences_count', 'indexed_records', 'records_processed']
+
+
+def read_process_io() -> Optional[Dict]:
+    """
+    Returns the I/O counters of the current process, which are only available on Linux
+
+    Returns:
+        Dict: the counters from /proc/self/io e.g. rchar and wchar, or None if they are not available
+    """
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            return {key:int(value) for key, value in [line.split(':') for line in io_file.read().splitlines()]}
+    except OSError:
+        return None
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of the current process so that the peak for a single step can be measured, which is only possible on Linux
+
+    Returns:
+        bool: whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss() -> int:
+    """
+    Returns the peak resident set size of the current process in bytes
+
+    Returns:
+        int: the peak resident set size, since it was last reset if that is supported, otherwise since the process started
+    """
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+
+def count_records_processed(action_log) -> Optional[int]:
+    """
+    Returns the number of records a step has processed, from the counts reported anywhere in its action log
+
+    Args:
+        action_log - the action log returned by the step
+
+    Returns:
+        int: the number of records, or None if the step does not report any
+    """
+    if not isinstance(action_log, dict):
+        return None
+    counts = []
+    for key, value in action_log.items():
+        if key in record_count_keys and isinstance(value, int):
+            counts.append(value)
+        else:
+            count = count_records_processed(value)
+            if count is not None:
+                counts.append(count)
+    if not counts:
+        return None
+    return sum(counts)
+
+
+def execute_step(function_name:str, config:Dict, kwargs:Dict, profile_filename:Optional[str]=None) -> Union[Dict, Dict]:
+    """
+    Runs a step function and measures the resources it uses, this is run in a worker process when steps are run in parallel
+
+    CPU time includes any worker processes the step starts itself, the peak resident set size and bytes read and written are for the process the step runs in.
+
+    Args:
+        function_name (str) - the module and name of the step function, which is imported if it has not been already
+        config (Dict) - the pipeline configuration
+        kwargs (Dict) - the arguments for the step
+        profile_filename (str) - if supplied, the step is run under cProfile and the statistics are written to this file
+
+    Returns:
+        Dict: the action log returned by the step
+        Dict: the resources used by the step
+    """
+    function = resolve_step_function(function_name)
+
+    reset_peak_rss()
+    io_before = read_process_io()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+
+    if profile_filename:
+        profiler = cProfile.Profile()
+        _action_log = profiler.runcall(function, config, **kwargs)
+        profiler.dump_stats(profile_filename)
+    else:
+        _action_log = function(config, **kwargs)
+
+    wall_time = time.perf_counter() - wall_before
+    cpu_time = time.process_time() - cpu_before
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time += (children_after.ru_utime + children_after.ru_stime) - (children_before.ru_utime + children_before.ru_stime)
+    io_after = read_process_io()
+
+    resources = {
+        'wall_time': round(wall_time, 6),
+        'cpu_time': round(cpu_time, 6),
+        'peak_rss': get_peak_rss(),
+        'bytes_read': io_after['rchar'] - io_before['rchar'] if io_before and io_after else None,
+        'bytes_written': io_after['wchar'] - io_before['wchar'] if io_before and io_after else None,
+        'records_processed': count_records_processed(_action_log)
+    }
+    return _action_log, resources
+
+
 class Pipeline():
-    def __init__(self, steps:Dict, console, verbose:bool=False, mode:str='development', force:bool=False):
+    def __init__(self, steps:Dict, console, verbose:bool=False, mode:str='development', force:bool=False, profile:bool=False, resume:bool=False, metrics:bool=False, progress_interval:int=1000):
 
-        self.logoutput = True
         self.verbose = verbose
         self.force = force
+        self.profile = profile
+        self.resume = resume
+        self.metrics = metrics
+        self.progress_interval = progress_interval
+        # the data published by steps for later steps run in this process
+        self.artifacts = ArtifactStore()
         self.console = console
         self.steps = steps
         self.mode = mode
+        # the number of worker processes given to steps declared with 'worker_pool', set by run_steps
+        self.step_pool_size = 1
 
         self.config = load_config(self.console, verbose=self.verbose )
         
-        self.get_repository_info()
         self.initialise()
 
         
     def run_step(self, step_number, **kwargs):
         
+        step_run = self.start_step(step_number, kwargs)
+
+        if step_run['cached_step'] is None:
+            _action_log, resources = execute_step(self.steps[step_number]['function'], self.config, step_run['kwargs'], step_run['profile_filename'])
+            self.complete_step(step_run, _action_log, resources)
+        pass
+
+
+    def start_step(self, step_number:str, kwargs:Dict) -> Dict:
+        """
+        Announces a step, adds the pipeline wide arguments and checks the step cache for a previous run which can be reused
+
+        If a previous run is reused, its action log is recorded straight away and the step does not need to be run.
+
+        Args:
+            step_number (str) - the number of the step
+            kwargs (Dict) - the arguments for the step
+
+        Returns:
+            Dict: the state of the step run, including the arguments to call the step function with and the cached step, if any
+        """
         if 'substep' in kwargs:
             step_title_number = f"{step_number}.{kwargs['substep']}"
             substep = kwargs['substep']
@@ -113,31 +451,385 @@ class Pipeline():
         kwargs['force'] = self.force
         kwargs['output_path'] = self.output_path
         kwargs['log_path'] = self.log_path
+        kwargs['artifacts'] = self.artifacts
+        if self.steps[step_number].get('worker_pool', False):
+            kwargs['workers'] = self.step_pool_size
+        kwargs['progress'] = self.events.progress_reporter(step_title_number, self.step_action(step_number), self.progress_interval)
+
+        step_run = {
+            'step_number': step_number,
+            'step_title_number': step_title_number,
+            'substep': substep,
+            'started_at': started_at,
+            'kwargs': kwargs,
+            'cached_step': None,
+            'profile_filename': f"{self.log_path}/{self.repository_name}-step-{step_title_number}.pstats" if self.profile else None
+        }
 
-        _action_log = self.steps[step_number]['function'](self.config, **kwargs)
+        # if the step's inputs, configuration, arguments and code are unchanged since it last ran, reuse the previous run
+        step_run['fingerprint'] = self.fingerprint_step(step_number, kwargs)
+        step_run['cache_key'] = self.step_cache_key(step_number, kwargs)
+        if step_run['fingerprint'] and not self.force and self.is_cached(step_run['cache_key'], step_run['fingerprint']):
+            cached_step = self.step_cache[step_run['cache_key']]
+            step_run['cached_step'] = cached_step
+            print (f"Inputs unchanged since {cached_step['completed_at']}, reusing previous outputs")
+            self.action_logs['steps'][step_title_number] = {
+                'step': step_number,
+                'substep': substep,
+                'step_action': self.step_action(step_number),
+                'started_at':started_at,
+                'completed_at': get_current_time(),
+                'cached': True,
+                'cached_from': cached_step['completed_at'],
+                'arguments': self.logged_arguments(kwargs),
+                'action_log': cached_step['action_log']
+            }
+            self.update_checkpoint(step_title_number)
+            self.events.emit('step_cached', task=step_title_number, step=step_number, step_action=self.step_action(step_number), cached_from=cached_step['completed_at'])
+        else:
+            self.running[step_title_number] = started_at
+            self.events.emit('step_started', task=step_title_number, step=step_number, step_action=self.step_action(step_number), arguments=self.logged_arguments(kwargs))
+        self.update_metrics()
+        return step_run
 
-        if 'verbose' in kwargs:
-            del kwargs['verbose']
-        
-        if 'substep' in kwargs:
-            del kwargs['substep']
+
+    def complete_step(self, step_run:Dict, _action_log:Dict, resources:Dict):
+        """
+        Records the action log and resource usage of a step which has been run, and updates the step cache
+
+        Args:
+            step_run (Dict) - the state of the step run, as returned by start_step
+            _action_log (Dict) - the action log returned by the step function
+            resources (Dict) - the resources used by the step, as returned by execute_step
+        """
+        step_number = step_run['step_number']
+        step_title_number = step_run['step_title_number']
+        kwargs = step_run['kwargs']
 
         completed_at = get_current_time()
-        print (f"Completed at {completed_at}")
+        print (f"{step_title_number}. Completed at {completed_at}")
+
+        if step_run['fingerprint']:
+            self.update_step_cache(step_run['cache_key'], step_number, step_run['fingerprint'], kwargs, _action_log, completed_at)
 
         self.action_logs['steps'][step_title_number] = {
             'step': step_number,
-            'substep': substep,
-            'step_action': self.steps[step_number]['function'].__name__,
-            'started_at':started_at,
+            'substep': step_run['substep'],
+            'step_action': self.step_action(step_number),
+            'started_at':step_run['started_at'],
             'completed_at': completed_at,
-            'arguments': kwargs,
+            'resources': resources,
+            'arguments': self.logged_arguments(kwargs),
             'action_log': _action_log
         }
-
-        if self.logoutput:
-            self.console.print(self.action_logs['steps'][step_title_number])
-        pass
+        self.update_checkpoint(step_title_number)
+
+        # the action log is written to the event log rather than printed, rendering large action logs to the console slowed down long runs
+        self.running.pop(step_title_number, None)
+        self.events.emit('step_finished', task=step_title_number, step=step_number, step_action=self.step_action(step_number), resources=resources, action_log=_action_log)
+        self.update_metrics()
+
+
+    def build_step_graph(self, step_arguments:Dict, loci:List[str]) -> List[Dict]:
+        """
+        Expands the steps to be run into a graph of tasks, using the dependencies and per-locus fan-out declared in the steps dictionary
+
+        A step declared with 'fan_out' becomes one task per locus, which depends only on the tasks for the same locus of the steps it depends on, unless it is also declared with 'gather', in which case it depends on the tasks for every locus. A step without fan-out depends on every task of the steps it depends on. Dependencies on steps which are not being run are ignored.
+
+        Args:
+            step_arguments (Dict) - the arguments for each step to be run, keyed by step number, in the order the steps should be logged
+            loci (List[str]) - the loci for the fanned out steps
+
+        Returns:
+            List[Dict]: the tasks, in the order they would be run serially
+        """
+        tasks = []
+        for step_number, arguments in step_arguments.items():
+            if self.steps[step_number].get('fan_out', False):
+                for i, locus in enumerate(loci, start=1):
+                    tasks.append({
+                        'task_id': f"{step_number}.{i}",
+                        'step_number': step_number,
+                        'locus': locus,
+                        'kwargs': {'substep': i, 'locus': locus, **arguments}
+                    })
+            else:
+                tasks.append({
+                    'task_id': str(step_number),
+                    'step_number': step_number,
+                    'locus': None,
+                    'kwargs': dict(arguments)
+                })
+        for task in tasks:
+            step = self.steps[task['step_number']]
+            task['depends_on'] = []
+            for other in tasks:
+                if other['step_number'] not in step.get('depends_on', []):
+                    continue
+                if task['locus'] is None or other['locus'] is None or step.get('gather', False) or other['locus'] == task['locus']:
+                    task['depends_on'].append(other['task_id'])
+        return tasks
+
+
+    def run_steps(self, step_arguments:Dict, loci:List[str], workers:int=1):
+        """
+        Runs a set of steps, scheduling the tasks of the step graph on a pool of worker processes as soon as the tasks they depend on have completed
+
+        With a single worker, or a single task, the tasks are run one after another in this process. The step entries of the action log are always in the same order, whatever order the tasks complete in.
+
+        Args:
+            step_arguments (Dict) - the arguments for each step to be run, keyed by step number, in the order the steps should be logged
+            loci (List[str]) - the loci for the fanned out steps
+            workers (int) - the number of worker processes
+        """
+        tasks = self.build_step_graph(step_arguments, loci)
+        self.task_count = len(tasks)
+
+        # a step with its own worker pool only uses the worker processes when it is the only task, otherwise the tasks already run in parallel and it runs serially so there are never more processes than workers
+        self.step_pool_size = workers if len(tasks) == 1 else 1
+
+        # when resuming, the tasks completed by the previous run are not run again
+        completed = set([task['task_id'] for task in tasks if self.restore_from_checkpoint(task)])
+
+        # a single task is run in this process, a step with its own worker pool then uses the worker processes itself
+        if workers <= 1 or len(tasks) == 1:
+            for task in tasks:
+                if task['task_id'] not in completed:
+                    self.run_step(task['step_number'], **task['kwargs'])
+            return
+
+        pending = [task for task in tasks if task['task_id'] not in completed]
+        running = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                # start every task whose dependencies have completed, a task reused from the step cache completes immediately so may free up others
+                ready = [task for task in pending if all([task_id in completed for task_id in task['depends_on']])]
+                while ready:
+                    for task in ready:
+                        pending.remove(task)
+                        step_run = self.start_step(task['step_number'], task['kwargs'])
+                        if step_run['cached_step'] is None:
+                            # the artifact store is not shared with the worker processes, so steps run there use the files in the output directory
+                            worker_kwargs = {k:v for k,v in step_run['kwargs'].items() if k != 'artifacts'}
+                            future = executor.submit(execute_step, self.steps[task['step_number']]['function'], self.config, worker_kwargs, step_run['profile_filename'])
+                            running[future] = (task, step_run)
+                        else:
+                            completed.add(task['task_id'])
+                    ready = [task for task in pending if all([task_id in completed for task_id in task['depends_on']])]
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task, step_run = running.pop(future)
+                    self.complete_step(step_run, *future.result())
+                    completed.add(task['task_id'])
+
+        # the action log entries are ordered as if the tasks had been run serially, so the logs of different runs can be compared
+        step_logs = self.action_logs['steps']
+        ordered_step_logs = {task['task_id']:step_logs[task['task_id']] for task in tasks}
+        self.action_logs['steps'] = {**{k:v for k,v in step_logs.items() if k not in ordered_step_logs}, **ordered_step_logs}
+
+
+    def restore_from_checkpoint(self, task:Dict) -> bool:
+        """
+        Restores the action log entry for a task from the checkpoint of a previous run, if it completed there with the same arguments
+
+        Args:
+            task (Dict) - the task, as returned by build_step_graph
+
+        Returns:
+            bool: whether the task was completed by the previous run, and so does not need to be run again
+        """
+        step_log = self.checkpoint['steps'].get(task['task_id'])
+        if step_log is None or step_log['step'] != task['step_number']:
+            return False
+        kwargs = {**task['kwargs'], 'force': self.force, 'output_path': self.output_path, 'log_path': self.log_path}
+        if step_log['arguments'] != json.loads(json.dumps(self.logged_arguments(kwargs))):
+            return False
+        print (f"{task['task_id']}. Completed at {step_log['completed_at']} in the run being resumed")
+        self.action_logs['steps'][task['task_id']] = {**step_log, 'resumed': True}
+        self.events.emit('step_resumed', task=task['task_id'], step=task['step_number'], step_action=step_log['step_action'], completed_at=step_log['completed_at'])
+        return True
+
+
+    def update_checkpoint(self, step_title_number:str):
+        """
+        Adds the action log entry for a completed step to the checkpoint manifest, so a failed run can be resumed from where it stopped
+
+        Args:
+            step_title_number (str) - the number (and substep number) of the step
+        """
+        self.checkpoint['steps'][step_title_number] = self.action_logs['steps'][step_title_number]
+        write_json_atomically(self.checkpoint_filename, self.checkpoint)
+
+
+    def logged_arguments(self, kwargs:Dict) -> Dict:
+        """
+        Returns the arguments of a step as they are recorded in the action log
+
+        Args:
+            kwargs (Dict) - the arguments for the step
+
+        Returns:
+            Dict: the arguments, without verbose, substep, the worker pool size, the artifact store and the progress reporter
+        """
+        return {k:v for k,v in kwargs.items() if k not in ['verbose', 'substep', 'workers', 'artifacts', 'progress']}
+
+
+    def step_arguments(self, kwargs:Dict) -> Dict:
+        """
+        Returns the arguments of a step which affect its outputs, excluding those which only affect how it reports progress or how many processes it uses
+
+        Args:
+            kwargs (Dict) - the arguments for the step
+
+        Returns:
+            Dict: the arguments
+        """
+        return {k:v for k,v in kwargs.items() if k not in ['verbose', 'force', 'substep', 'workers', 'artifacts', 'progress']}
+
+
+    def step_cache_key(self, step_number:str, kwargs:Dict) -> str:
+        """
+        Returns the key for a step in the step cache manifest, a step run once per locus has an entry for each locus
+
+        Args:
+            step_number (str) - the number of the step
+            kwargs (Dict) - the arguments for the step
+
+        Returns:
+            str: the key
+        """
+        return f"{step_number} {json.dumps(self.step_arguments(kwargs), sort_keys=True)}"
+
+
+    def fingerprint_step(self, step_number:str, kwargs:Dict) -> Optional[str]:
+        """
+        Generates a fingerprint of everything a step depends on, its input files, the configuration items it uses, its arguments and its code
+
+        Steps which do not declare their inputs are not fingerprinted and always run, as are steps with a declared input which matches no file, so a missing input is never taken to be unchanged.
+
+        Args:
+            step_number (str) - the number of the step
+            kwargs (Dict) - the arguments for the step
+
+        Returns:
+            str: the fingerprint, or None if the step does not declare its inputs or one of them is missing
+        """
+        step = self.steps[step_number]
+        if 'inputs' not in step:
+            return None
+        input_hashes = hash_files(step['inputs'](kwargs))
+        if None in input_hashes.values():
+            return None
+        if 'config_keys' in step:
+            config_items = {key:self.config[key.split('.')[0]][key.split('.')[1]] for key in step['config_keys']}
+        else:
+            config_items = self.config['CONSTANTS']
+        fingerprint = {
+            'inputs': input_hashes,
+            'config': config_items,
+            'arguments': self.step_arguments(kwargs),
+            'code_version': get_code_version(step['function'])
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    def is_cached(self, cache_key:str, fingerprint:str) -> bool:
+        """
+        Checks whether a step has a previous run with the same fingerprint whose outputs are still in place and unchanged
+
+        Args:
+            cache_key (str) - the key for the step in the step cache manifest
+            fingerprint (str) - the fingerprint of the step
+
+        Returns:
+            bool: whether the previous run can be reused
+        """
+        if cache_key not in self.step_cache:
+            return False
+        cached_step = self.step_cache[cache_key]
+        if cached_step['fingerprint'] != fingerprint:
+            return False
+        return hash_files(list(cached_step['outputs'].keys())) == cached_step['outputs']
+
+
+    def update_step_cache(self, cache_key:str, step_number:str, fingerprint:str, kwargs:Dict, action_log:Dict, completed_at:str):
+        """
+        Records the fingerprint, output hashes and action log of a completed step in the step cache manifest
+
+        Args:
+            cache_key (str) - the key for the step in the step cache manifest
+            step_number (str) - the number of the step
+            fingerprint (str) - the fingerprint of the step
+            kwargs (Dict) - the arguments for the step
+            action_log (Dict) - the action log returned by the step
+            completed_at (str) - the time the step completed
+        """
+        step = self.steps[step_number]
+        if 'outputs' in step:
+            outputs = hash_files(step['outputs'](kwargs))
+        else:
+            outputs = {}
+        self.step_cache[cache_key] = {
+            'fingerprint': fingerprint,
+            'outputs': outputs,
+            'action_log': action_log,
+            'completed_at': completed_at
+        }
+        write_json_atomically(self.step_cache_filename, self.step_cache)
+
+
+    def step_action(self, step_number:str) -> str:
+        """
+        Returns the name of the function of a step, as recorded in the action log
+
+        Args:
+            step_number (str) - the number of the step
+
+        Returns:
+            str: the name of the step function e.g. construct_class_i_locus_allele_lists
+        """
+        return self.steps[step_number]['function'].rsplit('.', 1)[1]
+
+
+    def update_metrics(self):
+        """
+        Rewrites the Prometheus text metrics file with the progress of the run and the resources used by each completed step, if metrics are enabled
+
+        The file is replaced each time a step starts or completes, so it can be scraped while the run is in progress.
+        """
+        if not self.metrics:
+            return
+        prefix = re.sub(r'[^a-zA-Z0-9_]', '_', self.repository_name)
+        step_logs = self.action_logs['steps']
+        completed = list(step_logs.values())
+        task_states = {
+            'total': self.task_count if self.task_count is not None else len(completed) + len(self.running),
+            'completed': len(completed),
+            'running': len(self.running),
+            'cached': len([step_log for step_log in completed if step_log.get('cached')]),
+            'resumed': len([step_log for step_log in completed if step_log.get('resumed')])
+        }
+        metrics = [
+            {'name': f"{prefix}_run_started_timestamp_seconds", 'help': 'The time the current run started', 'type': 'gauge', 'samples': [({}, datetime.datetime.fromisoformat(self.action_logs['started_at']).timestamp())]},
+            {'name': f"{prefix}_run_completed", 'help': 'Whether the current run has completed', 'type': 'gauge', 'samples': [({}, 1 if 'completed_at' in self.action_logs else 0)]},
+            {'name': f"{prefix}_tasks", 'help': 'The number of tasks in the current run, by state', 'type': 'gauge', 'samples': [({'state': state}, count) for state, count in task_states.items()]}
+        ]
+        resource_metrics = [
+            ('wall_time', 'step_wall_time_seconds', 'The wall time of each completed step'),
+            ('cpu_time', 'step_cpu_time_seconds', 'The CPU time of each completed step, including any worker processes it started'),
+            ('peak_rss', 'step_peak_rss_bytes', 'The peak resident set size of each completed step'),
+            ('records_processed', 'step_records_processed', 'The number of sequence records processed by each completed step')
+        ]
+        for key, name, help_text in resource_metrics:
+            samples = []
+            for task_id, step_log in step_logs.items():
+                if step_log.get('resources') and step_log['resources'].get(key) is not None:
+                    samples.append(({'task': task_id, 'step_action': step_log['step_action']}, step_log['resources'][key]))
+            metrics.append({'name': f"{prefix}_{name}", 'help': help_text, 'type': 'gauge', 'samples': samples})
+        metrics.append({'name': f"{prefix}_last_update_timestamp_seconds", 'help': 'The time the metrics were last updated', 'type': 'gauge', 'samples': [({}, time.time())]})
+        write_metrics(self.metrics_filename, metrics)
 
 
     def get_config_item(self, key:str) -> Union[None, str, int, List]:
@@ -148,22 +840,37 @@ class Pipeline():
         
 
     def get_repository_info(self):
-        repo = git.Repo(search_parent_directories=True)
-        self.repository_name = repo.remotes.origin.url.split('.git')[0].split('/')[-1]
-        self.pipeline_version = repo.head.object.hexsha
+        # the provenance is cached in the log directory, so GitPython and dparse are only needed when the commit or Pipfile change
+        self.provenance = get_provenance(f"{self.log_path}/provenance.json")
+        self.repository_name = self.provenance['repository_name']
+        self.pipeline_version = self.provenance['pipeline_version']
         self.pipeline_name = self.repository_name.replace('_',' ').capitalize()
 
 
     def initialise(self):
-        if self.mode == 'release':
-            # switch the output directory to the warehouse
-            self.output_path = f"{self.config['PATHS']['WAREHOUSE_PATH']}/{self.config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}"
-            self.log_path = f"{self.config['PATHS']['WAREHOUSE_PATH']}/logs/{self.config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}"
+        self.output_path, self.log_path = get_output_paths(self.config, self.mode)
+
+        self.get_repository_info()
+
+        # the step cache manifest records the fingerprint and outputs of each step from previous runs
+        self.step_cache_filename = f"{self.log_path}/step_cache.json"
+        if os.path.exists(self.step_cache_filename):
+            with open(self.step_cache_filename) as step_cache_file:
+                self.step_cache = json.load(step_cache_file)
         else:
-            self.output_path = self.config['PATHS']['OUTPUT_PATH']
-            self.log_path = self.config['PATHS']['LOG_PATH']
+            self.step_cache = {}
 
         started_at = get_current_time()
+
+        # the checkpoint manifest records each step as it completes, it is removed once the whole pipeline has completed
+        self.checkpoint_filename = f"{self.log_path}/checkpoint.json"
+        if self.resume and os.path.exists(self.checkpoint_filename):
+            with open(self.checkpoint_filename) as checkpoint_file:
+                self.checkpoint = json.load(checkpoint_file)
+            self.console.print(f"Resuming the run started at {self.checkpoint['started_at']}, {len(self.checkpoint['steps'])} steps completed")
+        else:
+            self.checkpoint = {'started_at': started_at, 'pipeline_version': self.pipeline_version, 'steps': {}}
+
         self.action_logs = {
             'started_at': started_at,
             'steps':{},
@@ -171,6 +878,14 @@ class Pipeline():
             'pipeline_name': self.pipeline_name,
             'pipeline_version': self.pipeline_version
         }
+
+        # the events of the run are appended to the event log as they happen, and the metrics file is rewritten, so that long runs can be followed before they complete
+        self.events = EventLog(f"{self.log_path}/events.jsonl", started_at)
+        self.metrics_filename = f"{self.log_path}/metrics.prom"
+        self.running = {}
+        self.task_count = None
+        self.events.emit('pipeline_started', repository_name=self.repository_name, pipeline_version=self.pipeline_version, mode=self.mode, force=self.force, resumed_from=self.checkpoint['started_at'] if self.resume and self.checkpoint['steps'] else None)
+        self.update_metrics()
         
         self.console.print ("")
         self.console.rule(title="Initialising...")
@@ -186,7 +901,7 @@ class Pipeline():
 
 
     def finalise(self):
-        self.action_logs['dependencies'] = get_dependencies()
+        self.action_logs['dependencies'] = self.provenance['dependencies']
         self.action_logs['completed_at'] = get_current_time()
         start = datetime.datetime.fromisoformat(self.action_logs['started_at'])
         end = datetime.datetime.fromisoformat(self.action_logs['completed_at'])
@@ -195,5 +910,9 @@ class Pipeline():
         logfilename = f"{self.log_path}/{self.repository_name}-{datehash}.json"
         with open(logfilename, 'w') as logfile:
             logfile.write(json.dumps(self.action_logs, sort_keys=True, indent=4))
+        if os.path.exists(self.checkpoint_filename):
+            os.remove(self.checkpoint_filename)
+        self.events.emit('pipeline_finished', log_filename=logfilename, execution_time=delta.total_seconds())
+        self.update_metrics()
         self.console.print(f"Pipeline completed at {self.action_logs['completed_at']} : Execution time : {delta}") 
         return self.action_logs
@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional
+
+import hashlib
+import json
+import os
+
+from .artifacts import ArtifactStore, load_artifact
+from .pipeline import file_hash, write_json_atomically
+
+
+# the reference panels built in this process, keyed by the hash of their inputs, so every locus of a run shares the same panel
+reference_panels = {}
+
+
+def reference_panel_key(config:Dict, loci:List[str], species_stem:str, file_fingerprints:List) -> str:
+    """
+    This function returns the key for a reference panel, a hash of the known alleles for each relationship type and of the fingerprints of the protein allele files it is built from
+
+    Args:
+        config (Dict): the configuration dictionary
+        loci (List[str]): the loci the panel is built from e.g. ['A', 'B', 'C']
+        species_stem (str): the species stem for the loci e.g. hla
+        file_fingerprints (List): a fingerprint of each protein allele file, either its size and modification time or the hash of its contents
+
+    Returns:
+        str: the hex digest of the inputs
+    """
+    inputs = {
+        'loci': loci,
+        'species_stem': species_stem,
+        'known_alleles': {relationship_type:config['CONSTANTS'][f"{relationship_type.upper()}_ALLELES"] for relationship_type in config['CONSTANTS']['RELATIONSHIP_TYPES']},
+        'files': file_fingerprints
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def build_reference_panel(config:Dict, loci:List[str], species_stem:str, output_path:str='output', cache_path:Optional[str]=None, artifacts:Optional[ArtifactStore]=None) -> Dict[str, Dict[str, str]]:
+    """
+    This function returns the reference panel for a set of loci, the pocket pseudosequences of the alleles with a known motif, structure or NetMHCPan pseudosequence
+
+    The panel is only built from the protein allele files once, it is kept for the rest of the run and, if a cache path is given, saved there along with the hash of its inputs so later runs and ad-hoc queries can load it without reading the protein allele files.
+
+    The panel is first looked up by the size and modification time of the protein allele files, so the locus tasks of a run, which each need the panel, do not each read every file. The contents of the files are only hashed when these have changed, and if the contents have not changed the cached panel is kept and recorded against the new sizes and modification times.
+
+    Args:
+        config (Dict): the configuration dictionary
+        loci (List[str]): the loci the panel is built from e.g. ['A', 'B', 'C']
+        species_stem (str): the species stem for the loci e.g. hla
+        output_path (str): the path to the output directory
+        cache_path (str): the folder the panel is cached in e.g. logs/reference_panels, if not given the panel is not cached on disk
+        artifacts (ArtifactStore): the artifact store for the pipeline run, used for the protein alleles if a step in the same process has published them
+
+    Returns:
+        Dict[str, Dict[str, str]]: the pocket pseudosequence of each known allele, keyed by relationship type and then allele slug, in the order of the loci and the alleles in their files
+    """
+    filenames = [f"{output_path}/processed_data/protein_alleles/{species_stem}_{locus.lower()}.json" for locus in loci]
+    file_stats = [[os.stat(filename).st_size, os.stat(filename).st_mtime_ns] for filename in filenames]
+    stat_key = reference_panel_key(config, loci, species_stem, file_stats)
+    if stat_key in reference_panels:
+        return reference_panels[stat_key]
+
+    cache_filename = f"{cache_path}/{species_stem}.json" if cache_path else None
+    cached_panel = None
+    if cache_filename and os.path.exists(cache_filename):
+        with open(cache_filename, 'r') as cache_file:
+            cached_panel = json.load(cache_file)
+        if cached_panel.get('stat_key') == stat_key:
+            reference_panels[stat_key] = {relationship_type:dict(known_pseudosequences) for relationship_type, known_pseudosequences in cached_panel['pseudosequences'].items()}
+            return reference_panels[stat_key]
+
+    key = reference_panel_key(config, loci, species_stem, [file_hash(filename) for filename in filenames])
+    pseudosequences = None
+    if cached_panel and cached_panel['key'] == key:
+        pseudosequences = {relationship_type:dict(known_pseudosequences) for relationship_type, known_pseudosequences in cached_panel['pseudosequences'].items()}
+    if pseudosequences is None:
+        relationship_types = config['CONSTANTS']['RELATIONSHIP_TYPES']
+        known_alleles = {relationship_type:set(config['CONSTANTS'][f"{relationship_type.upper()}_ALLELES"]) for relationship_type in relationship_types}
+        pseudosequences = {relationship_type:{} for relationship_type in relationship_types}
+        for locus in loci:
+            protein_alleles = load_artifact(artifacts, 'protein_alleles', f"{species_stem}_{locus.lower()}", output_path)
+            for allele in protein_alleles:
+                for relationship_type in relationship_types:
+                    if allele in known_alleles[relationship_type]:
+                        pseudosequences[relationship_type][allele] = protein_alleles[allele]['pocket_pseudosequence']
+
+    if cache_filename:
+        os.makedirs(cache_path, exist_ok=True)
+        # the pseudosequences are saved as lists of pairs, as the order of the known alleles is the order they are searched in
+        write_json_atomically(cache_filename, {'key': key, 'stat_key': stat_key, 'loci': loci, 'pseudosequences': {relationship_type:list(known_pseudosequences.items()) for relationship_type, known_pseudosequences in pseudosequences.items()}})
+    reference_panels[stat_key] = pseudosequences
+    return pseudosequences
@@ -0,0 +1,206 @@
+from typing import Dict, Iterator, List, Tuple
+
+import random
+
+from .allele import class_i_starts
+
+
+amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+
+# the approximate number of protein sequences for each locus in a release of the IPD-IMGT/HLA dataset, with some Class II and non-classical loci which the parsing steps should skip
+hla_release_locus_counts = {
+    'A': 7500, 'B': 9000, 'C': 7000, 'E': 300, 'F': 60, 'G': 100,
+    'DRB1': 3700, 'DQB1': 1900, 'DPB1': 1900, 'DQA1': 300, 'MICA': 280
+}
+
+# the allele groups found for each locus, the earlier groups are given more alleles, as in the real dataset
+hla_allele_groups = {
+    'A': [2, 24, 1, 3, 11, 26, 68, 30, 33, 31, 29, 23, 32, 25, 34, 66, 74, 36, 69, 43, 80],
+    'B': [15, 7, 35, 44, 40, 51, 8, 18, 27, 57, 13, 39, 58, 14, 38, 55, 52, 49, 37, 53, 50, 56, 41, 45, 47, 54, 46, 48, 67, 73, 78, 81, 82, 83, 42, 59],
+    'C': [7, 4, 3, 6, 1, 12, 15, 5, 8, 14, 16, 2, 17, 18],
+    'E': [1], 'F': [1], 'G': [1],
+    'DRB1': [4, 11, 13, 15, 1, 3, 14, 7, 8, 12, 16, 10, 9],
+    'DQB1': [3, 6, 2, 5, 4],
+    'DPB1': list(range(1, 200)),
+    'DQA1': [1, 5, 3, 2, 4, 6],
+    'MICA': list(range(1, 80))
+}
+
+# the approximate number of protein sequences for each locus in a release of the IPD-MHC dataset
+mhc_release_locus_counts = {
+    'Mamu-A1': 1800, 'Mamu-B': 2600, 'Mamu-E': 300, 'Mafa-A1': 1100, 'Mafa-B': 1500, 'Patr-A': 250, 'Patr-B': 350,
+    'SLA-1': 400, 'SLA-2': 350, 'BoLA-1': 250, 'BoLA-2': 200, 'DLA-88': 250, 'Gaga-BF2': 300,
+    'Mamu-DRB': 2400, 'Mamu-DQA1': 600, 'Patr-DQA1': 150, 'SLA-DRB1': 300
+}
+
+
+def zipf_weights(count:int) -> List[float]:
+    """
+    This function returns weights which fall off with rank, used to give the first allele groups more alleles than the rest
+
+    Args:
+        count (int): the number of weights
+
+    Returns:
+        List[float]: the weights
+    """
+    return [1 / rank for rank in range(1, count + 1)]
+
+
+def mutate(sequence:str, mutations:int, start:int, end:int, generator:random.Random) -> str:
+    """
+    This function returns a copy of a sequence with a number of random substitutions between two positions
+
+    Args:
+        sequence (str): the sequence
+        mutations (int): the number of substitutions
+        start (int): the first position which may be substituted
+        end (int): the last position which may be substituted
+        generator (random.Random): the seeded random number generator
+
+    Returns:
+        str: the mutated sequence
+    """
+    residues = list(sequence)
+    for _ in range(mutations):
+        residues[generator.randint(start, min(end, len(residues) - 1))] = generator.choice(amino_acids)
+    return ''.join(residues)
+
+
+def synthetic_locus_records(locus:str, count:int, allele_groups:List[int], field_width:int, generator:random.Random) -> Iterator[Tuple[str, str]]:
+    """
+    This function yields the allele names and sequences for a locus, allele names are assigned sequentially within each allele group as they are in IPD
+
+    Each locus has a template sequence of a leader peptide, a Class I start motif and the mature protein. Allele groups and protein alleles differ from it by substitutions in the peptide binding domains, synonymous alleles share the sequence of their protein allele, and some sequences are partial or have expression suffixes.
+
+    Args:
+        locus (str): the name of the locus e.g. A or Mamu-A1
+        count (int): the number of records to generate
+        allele_groups (List[int]): the allele groups for the locus, in order of decreasing size
+        field_width (int): the number of digits in the first two fields of the allele name e.g. 2 for HLA and 3 for IPD-MHC
+        generator (random.Random): the seeded random number generator
+
+    Returns:
+        Iterator[Tuple[str, str]]: the gene allele name and sequence of each record
+    """
+    leader = ''.join(generator.choice(amino_acids) for _ in range(24))
+    start = generator.choice(class_i_starts)
+    template = leader + start + ''.join(generator.choice(amino_acids) for _ in range(334))
+    # substitutions are kept clear of the start motif, so that every full length sequence is recognised as Class I
+    domain_start = len(leader) + len(start)
+    group_sequences = {}
+    protein_alleles = {}
+    weights = zipf_weights(len(allele_groups))
+    for _ in range(count):
+        group = generator.choices(allele_groups, weights=weights)[0]
+        if group not in group_sequences:
+            group_sequences[group] = mutate(template, generator.randint(4, 12), domain_start, 205, generator)
+            protein_alleles[group] = []
+        # most records are new protein alleles, the rest are synonymous or non-coding variants of an existing one
+        if not protein_alleles[group] or generator.random() < 0.6:
+            protein_alleles[group].append({'sequence': mutate(group_sequences[group], generator.randint(1, 3), domain_start, 300, generator), 'variants': 0})
+            protein_number = len(protein_alleles[group])
+        else:
+            protein_number = generator.randint(1, len(protein_alleles[group]))
+        protein_allele = protein_alleles[group][protein_number - 1]
+        protein_allele['variants'] += 1
+        name = f"{locus}*{group:0{field_width}d}:{protein_number:0{field_width}d}:{protein_allele['variants']:02d}"
+        if generator.random() < 0.3:
+            name += f":{generator.randint(1, 20):02d}"
+        suffix_roll = generator.random()
+        if suffix_roll < 0.025:
+            name += 'N'
+        elif suffix_roll < 0.03:
+            name += 'Q'
+        elif suffix_roll < 0.031:
+            name += 'L'
+        sequence = protein_allele['sequence']
+        # around one in six sequences in a release are partial, covering only some exons
+        partial_roll = generator.random()
+        if partial_roll < 0.08:
+            sequence = sequence[generator.randint(25, 60):generator.randint(200, len(sequence))]
+        elif partial_roll < 0.16:
+            sequence = sequence[:generator.randint(200, len(sequence))]
+        yield name, sequence
+
+
+def write_fasta_records(filehandle, records:Iterator[Tuple[str, str, str]]) -> int:
+    """
+    This function writes records to a FASTA file with the sequence wrapped at 60 characters, as in the IPD downloads
+
+    Args:
+        filehandle: the open file
+        records (Iterator[Tuple[str, str, str]]): the accession, gene allele name and sequence of each record
+
+    Returns:
+        int: the number of records written
+    """
+    written = 0
+    for accession, name, sequence in records:
+        filehandle.write(f">{accession} {name} {len(sequence)} bp\n")
+        for i in range(0, len(sequence), 60):
+            filehandle.write(f"{sequence[i:i + 60]}\n")
+        written += 1
+    return written
+
+
+def interleave(streams:Dict[str, Iterator], counts:Dict[str, int], generator:random.Random) -> Iterator[Tuple[str, Tuple]]:
+    """
+    This function interleaves the records of several loci at random, so that the loci are mixed through the file as they are in the IPD downloads
+
+    Args:
+        streams (Dict[str, Iterator]): the records for each locus
+        counts (Dict[str, int]): the number of records for each locus
+        generator (random.Random): the seeded random number generator
+
+    Returns:
+        Iterator[Tuple[str, Tuple]]: the locus and record for each record
+    """
+    remaining = dict(counts)
+    loci = list(remaining.keys())
+    while loci:
+        locus = generator.choices(loci, weights=[remaining[locus] for locus in loci])[0]
+        yield locus, next(streams[locus])
+        remaining[locus] -= 1
+        if remaining[locus] == 0:
+            loci.remove(locus)
+
+
+def generate_hla_fasta(filename:str, scale:float=1, seed:int=1) -> int:
+    """
+    This function writes a synthetic IPD-IMGT/HLA protein dataset, at a multiple of the size of a release
+
+    Args:
+        filename (str): the path to the FASTA file to write e.g. tmp/ipd_imgt_hla_prot.fasta
+        scale (float): the size of the dataset as a multiple of a release
+        seed (int): the seed for the random number generator, the same seed and scale always give the same file
+
+    Returns:
+        int: the number of records written
+    """
+    generator = random.Random(seed)
+    counts = {locus:max(1, int(count * scale)) for locus, count in hla_release_locus_counts.items()}
+    streams = {locus:synthetic_locus_records(locus, counts[locus], hla_allele_groups[locus], 2, generator) for locus in counts}
+    records = ((f"HLA:HLA{i + 1:05d}", name, sequence) for i, (locus, (name, sequence)) in enumerate(interleave(streams, counts, generator)))
+    with open(filename, 'w') as filehandle:
+        return write_fasta_records(filehandle, records)
+
+
+def generate_mhc_fasta(filename:str, scale:float=1, seed:int=1) -> int:
+    """
+    This function writes a synthetic IPD-MHC protein dataset, at a multiple of the size of a release
+
+    Args:
+        filename (str): the path to the FASTA file to write e.g. tmp/ipd_mhc_prot.fasta
+        scale (float): the size of the dataset as a multiple of a release
+        seed (int): the seed for the random number generator, the same seed and scale always give the same file
+
+    Returns:
+        int: the number of records written
+    """
+    generator = random.Random(seed)
+    counts = {locus:max(1, int(count * scale)) for locus, count in mhc_release_locus_counts.items()}
+    streams = {locus:synthetic_locus_records(locus, counts[locus], list(range(1, 120)), 3, generator) for locus in counts}
+    records = ((f"MHC:NHP{i + 1:05d}", name, sequence) for i, (locus, (name, sequence)) in enumerate(interleave(streams, counts, generator)))
+    with open(filename, 'w') as filehandle:
+        return write_fasta_records(filehandle, records)
@@ -1,6 +1,8 @@
 from typing import Dict, List, Union
 import json
 
+from common.artifacts import load_artifact
+
 
 def construct_reference_allele_lists(config:Dict, **kwargs) -> None:
     """
@@ -16,14 +18,13 @@ def construct_reference_allele_lists(config:Dict, **kwargs) -> None:
     locus = kwargs['locus']
     species_stem = kwargs['species_stem']
     verbose = kwargs['verbose']
+    output_path = kwargs['output_path']
 
     locus_slug = f"{species_stem}_{locus.lower()}"
 
 
-    input_filename = f"output/processed_data/protein_alleles/{locus_slug}.json"
-
-    with open(input_filename, 'r') as alleles_file:
-        alleles = json.load(alleles_file)
+    # the protein alleles are taken from the artifact store if step 3 ran in the same process, otherwise from the file
+    alleles = load_artifact(kwargs.get('artifacts'), 'protein_alleles', locus_slug, output_path)
 
     reference_alleles = {
         'allele_groups': {},
@@ -46,14 +47,18 @@ def construct_reference_allele_lists(config:Dict, **kwargs) -> None:
         if allele not in allele_groups[allele_group]:
             allele_groups[allele_group].append(allele)
 
-    output_file = f"output/processed_data/reference_alleles/{locus_slug}.json"
+    output_file = f"{output_path}/processed_data/reference_alleles/{locus_slug}.json"
     with open(output_file, 'w') as reference_alleles_file:
         alleles = json.dump(reference_alleles, reference_alleles_file)
 
-    output_file = f"output/processed_data/allele_groups/{locus_slug}.json"
+    output_file = f"{output_path}/processed_data/allele_groups/{locus_slug}.json"
     with open(output_file, 'w') as allele_groups_file:
         alleles = json.dump(allele_groups, allele_groups_file)
 
+    if kwargs.get('artifacts') is not None:
+        kwargs['artifacts'].publish('reference_alleles', locus_slug, reference_alleles)
+        kwargs['artifacts'].publish('allele_groups', locus_slug, allele_groups)
+
     if verbose:
         print (reference_alleles)
         print ('')
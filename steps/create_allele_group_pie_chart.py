@@ -4,12 +4,11 @@ import base64
 from io import BytesIO
 
 from common.helpers import slugify
+from common.artifacts import load_artifact
 
 from matplotlib.figure import Figure
 import numpy as np
 
-import json
-
 
 
 
@@ -201,7 +200,7 @@ def deslugify_allele(text:str) -> str:
     return allele_number
 
 
-def create_pie_chart(labels:List, percentages:List, counts:List, others:List, others_percentages:List, allele_group:str):
+def create_pie_chart(labels:List, percentages:List, counts:List, others:List, others_percentages:List, allele_group:str, output_path:str='output'):
     """
     This function takes a list of labels and percentages and creates a pie chart.
 
@@ -212,6 +211,7 @@ def create_pie_chart(labels:List, percentages:List, counts:List, others:List, ot
         others (List): A list of other labels.
         others_percentages (List): A list of other percentages.
         allele_group (str): The allele group.
+        output_path (str): The path to the output directory.
     
     Returns: 
         None
@@ -248,7 +248,7 @@ def create_pie_chart(labels:List, percentages:List, counts:List, others:List, ot
         ax.annotate(labels[i], xy=(x, y), xytext=(1.35*np.sign(x), 1.4*y),horizontalalignment=horizontalalignment, **kw, size=30)
 
     # finally we'll save the figure as an SVG   
-    filename = f"output/processed_data/pie_charts/allele_groups/{allele_group}.svg"
+    filename = f"{output_path}/processed_data/pie_charts/allele_groups/{allele_group}.svg"
     fig.savefig(filename, format="svg", bbox_inches='tight', pad_inches=0.5)
 
     # and we'll close the figure object to free up memory
@@ -269,12 +269,11 @@ def create_allele_group_pie_chart(config:Dict, **kwargs):
     # first, we'll load the pseudosequences for the locus
     locus = kwargs['locus']
     species_stem = kwargs['species_stem']
+    output_path = kwargs['output_path']
     
     locus_slug = f"{species_stem}_{locus.lower()}"
 
-    input_filename = f"output/processed_data/pocket_pseudosequences/{locus_slug}.json"
-    with open(input_filename, 'r') as f:
-        pseudosequences = json.load(f)
+    pseudosequences = load_artifact(kwargs.get('artifacts'), 'pocket_pseudosequences', locus_slug, output_path)
 
     # next, we'll generate the allele groups from the pseudosequences
     allele_groups = generate_allele_groups(pseudosequences)
@@ -292,12 +291,12 @@ def create_allele_group_pie_chart(config:Dict, **kwargs):
         # we'll get the top n labels and values
         labels, percentages, counts, others, others_percentages = top_n(allele_group_stats, 9)
         # and finally, we'll create the pie chart   
-        create_pie_chart(labels, percentages, counts, others, others_percentages, allele_group)
+        create_pie_chart(labels, percentages, counts, others, others_percentages, allele_group, output_path)
 
 
 def main():
 
-    create_allele_group_pie_chart({}, locus='B', species_stem='hla')
+    create_allele_group_pie_chart({}, locus='B', species_stem='hla', output_path='output')
 
 
 
@@ -0,0 +1,145 @@
+from typing import Dict, Iterator, List
+
+import os
+
+# pyarrow is an optional dependency, it is only needed if the columnar export is run
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from create_db_from_tabular_representations import table_columns
+
+
+# the columns with few distinct values, which are dictionary encoded along with the pocket residue columns
+dictionary_columns = ['allele_group_slug', 'allele_group', 'locus_slug', 'locus', 'species', 'relationship_label', 'relationship_type']
+
+
+def column_type(column_name:str, sqlite_type:str) -> 'pyarrow.DataType':
+    """
+    This function returns the Arrow type of a column from its SQLite type, the pocket residue columns and columns with few distinct values are dictionary encoded
+
+    The dictionary indices are int32, which is the only index type the Arrow CSV reader can convert to
+
+    Args:
+        column_name (str): the name of the column
+        sqlite_type (str): the SQLite type of the column e.g. INTEGER NOT NULL
+
+    Returns:
+        pyarrow.DataType: the Arrow type
+    """
+    if sqlite_type.startswith('INTEGER'):
+        return pyarrow.int16()
+    elif column_name.startswith('alpha_') or column_name in dictionary_columns:
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    else:
+        return pyarrow.string()
+
+
+def table_schema(table_name:str, pocket_positions:List) -> 'pyarrow.Schema':
+    """
+    This function returns the Arrow schema of a table, with the columns of the database table
+
+    Args:
+        table_name (str): the name of the table, alleles or relationships
+        pocket_positions (List): the IMGT positions of the pocket residues
+
+    Returns:
+        pyarrow.Schema: the schema
+    """
+    return pyarrow.schema([(column_name, column_type(column_name, sqlite_type)) for column_name, sqlite_type in table_columns(table_name, pocket_positions)])
+
+
+def read_csv_batches(filename:str, table_name:str, schema:'pyarrow.Schema') -> Iterator['pyarrow.RecordBatch']:
+    """
+    This function streams a CSV file as Arrow record batches with the schema of the table, empty cells are read as nulls as they are stored as NULL in the database
+
+    Args:
+        filename (str): the path to the CSV file
+        table_name (str): the name of the table, alleles or relationships
+        schema (pyarrow.Schema): the schema of the table
+
+    Returns:
+        Iterator[pyarrow.RecordBatch]: the batches of rows of the file
+    """
+    convert_options = pyarrow.csv.ConvertOptions(column_types={field.name:field.type for field in schema}, null_values=[''], strings_can_be_null=True)
+    reader = pyarrow.csv.open_csv(filename, convert_options=convert_options)
+    if reader.schema.names != schema.names:
+        raise ValueError(f"The header of {filename} does not match the schema of the {table_name} table, expected {schema.names} but found {reader.schema.names}")
+    for batch in reader:
+        yield batch
+
+
+def write_parquet_file(filenames:List[str], table_name:str, pocket_positions:List, filename:str, compression:str) -> int:
+    """
+    This function streams a set of CSV files with the same header into a single Parquet file, so a table is never held in memory as a whole, replacing any existing file atomically so a reader never sees a partly written file
+
+    Args:
+        filenames (List[str]): the paths to the CSV files
+        table_name (str): the name of the table, alleles or relationships
+        pocket_positions (List): the IMGT positions of the pocket residues
+        filename (str): the path to the Parquet file
+        compression (str): the compression codec e.g. zstd
+
+    Returns:
+        int: the number of rows written
+    """
+    schema = table_schema(table_name, pocket_positions)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary_filename = f"{filename}.{os.getpid()}.tmp"
+    rows = 0
+    try:
+        with pyarrow.parquet.ParquetWriter(temporary_filename, schema, compression=compression) as writer:
+            for csv_filename in filenames:
+                for batch in read_csv_batches(csv_filename, table_name, schema):
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+    except Exception:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    os.replace(temporary_filename, filename)
+    return rows
+
+
+def create_columnar_representations(config:Dict, **kwargs) -> Dict:
+    """
+    This function takes the tabular representations of the alleles and relationships of a locus and writes them as Parquet files, alongside the CSV files
+
+    The files are partitioned by locus, as the CSV files are e.g. output/columnar_data/alleles/hla_a.parquet, so each folder can be read as a single dataset with pyarrow.dataset, or a single locus read on its own. The relationships of every relationship type for the locus are in one file.
+
+    Args:
+        locus (str): the locus to be exported
+        species_stem (str): the species stem for the locus e.g. hla
+        compression (str): the Parquet compression codec (zstd is the default)
+        verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+    Returns:
+        Dict: the action dictionary for this step, the number of rows and the size of each Parquet file, which will be stored in the pipeline log
+    """
+    if pyarrow is None:
+        raise ImportError("The columnar export needs pyarrow, install it with pip install pyarrow")
+
+    locus = kwargs['locus']
+    species_stem = kwargs['species_stem']
+    compression = kwargs.get('compression', 'zstd')
+
+    output_path = kwargs['output_path']
+
+    locus_slug = f"{species_stem}_{locus.lower()}"
+    pocket_positions = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
+
+    table_filenames = {
+        'alleles': [f"{output_path}/tabular_data/alleles/{locus_slug}.csv"]
+    }
+    # relationships are not found for HLA-E, F and G
+    if locus_slug not in ['hla_e', 'hla_f', 'hla_g']:
+        table_filenames['relationships'] = [f"{output_path}/tabular_data/relationships/{locus_slug}_{relationship_type}.csv" for relationship_type in config['CONSTANTS']['RELATIONSHIP_TYPES']]
+
+    action_log = {}
+    for table_name, filenames in table_filenames.items():
+        parquet_filename = f"{output_path}/columnar_data/{table_name}/{locus_slug}.parquet"
+        rows = write_parquet_file(filenames, table_name, pocket_positions, parquet_filename, compression)
+        action_log[table_name] = {'rows': rows, 'bytes': os.path.getsize(parquet_filename)}
+    return action_log
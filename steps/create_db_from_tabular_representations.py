@@ -1,62 +1,293 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import os
 import json
 import csv
+import sqlite3
+import itertools
 
-from common.helpers import write_csv_file
+# the columns which identify a row of each table, a unique index is created on them and they are used to match rows when a database is updated in place
+table_keys = {
+    'alleles': ['allele_slug'],
+    'relationships': ['allele_slug', 'known_allele_slug', 'relationship_type']
+}
 
-def create_db_from_csvs(input_filenames:List[str], output_filename:str) -> None:
-    if os.path.exists(output_filename):
-        os.remove(output_filename)
+# the other columns indexed on each table once it has been loaded
+table_indexes = {
+    'alleles': ['locus_slug', 'allele_group_slug'],
+    'relationships': ['known_allele_slug']
+}
 
-    if len(input_filenames) > 1:
-        input_filename_str = ' '.join(input_filenames)
+
+def table_columns(table_name:str, pocket_positions:List) -> List[Tuple[str, str]]:
+    """
+    This function returns the schema of a database table, in the same column order as its CSV file
+
+    Args:
+        table_name (str): the name of the table, alleles or relationships
+        pocket_positions (List): the IMGT positions of the pocket residues, each of which has a column
+
+    Returns:
+        List[Tuple[str, str]]: the name and SQLite type of each column
+    """
+    if table_name == 'alleles':
+        columns = [('allele_slug', 'TEXT NOT NULL'), ('allele', 'TEXT'), ('allele_id', 'TEXT'), ('allele_url', 'TEXT'), ('allele_group_slug', 'TEXT'), ('allele_group', 'TEXT'), ('locus_slug', 'TEXT'), ('locus', 'TEXT'), ('species', 'TEXT'), ('netmhcpan_pseudosequence', 'TEXT')]
+        # the residue at each pocket position
+        pocket_type = 'CHAR(1)'
+    elif table_name == 'relationships':
+        columns = [('allele_slug', 'TEXT NOT NULL'), ('known_allele_slug', 'TEXT NOT NULL'), ('distance', 'INTEGER NOT NULL'), ('relationship_label', 'TEXT'), ('relationship_type', 'TEXT NOT NULL')]
+        # the polymorphism at each pocket position e.g. Y7F, or NULL if the residue is the same
+        pocket_type = 'TEXT'
     else:
-        input_filename_str = input_filenames[0]
+        raise ValueError(f"{table_name} is not one of the database tables ({', '.join(table_indexes)})")
+    for position in pocket_positions:
+        columns.append((f"alpha_{position}", pocket_type))
+    return columns
+
+
+def convert_row(row:List[str], integer_columns:List[int]) -> List:
+    """
+    This function converts a CSV row to the values stored in the database, empty cells are stored as NULL and integer columns as integers
+
+    Args:
+        row (List[str]): the values of the row, as read from the CSV file
+        integer_columns (List[int]): the indices of the integer columns
+
+    Returns:
+        List: the values for the database
+    """
+    values = [value if value != '' else None for value in row]
+    for i in integer_columns:
+        if values[i] is not None:
+            values[i] = int(values[i])
+    return values
+
+
+def table_definition(table_name:str, columns:List[Tuple[str, str]]) -> str:
+    """
+    This function returns the statement which creates a database table, which is also how an existing table is checked to have the same schema
+
+    Args:
+        table_name (str): the name of the table
+        columns (List[Tuple[str, str]]): the name and SQLite type of each column
+
+    Returns:
+        str: the CREATE TABLE statement
+    """
+    column_definitions = ', '.join([f"{column_name} {column_type}" for column_name, column_type in columns])
+    return f"CREATE TABLE {table_name} ({column_definitions})"
+
+
+def can_upsert(connection:sqlite3.Connection, table_name:str, columns:List[Tuple[str, str]]) -> bool:
+    """
+    This function checks whether a table in an existing database can be updated in place, it must have the same schema and the unique index on its key
+
+    Args:
+        connection (sqlite3.Connection): the connection to the database
+        table_name (str): the name of the table
+        columns (List[Tuple[str, str]]): the name and SQLite type of each column
+
+    Returns:
+        bool: whether the table can be updated in place
+    """
+    schema = dict(connection.execute("SELECT name, sql FROM sqlite_master WHERE tbl_name = ?", (table_name,)).fetchall())
+    return schema.get(table_name) == table_definition(table_name, columns) and f"{table_name}_key" in schema
+
+
+def upsert_table(connection:sqlite3.Connection, table_name:str, staging_table_name:str, column_names:List[str]) -> Dict[str, int]:
+    """
+    This function applies the rows loaded into a staging table to a table, deleting the rows which are no longer present, inserting the new rows and updating the rows which have changed
+
+    Rows are matched on the key of the table, rows which have not changed are left untouched.
+
+    Args:
+        connection (sqlite3.Connection): the connection to the database
+        table_name (str): the name of the table
+        staging_table_name (str): the name of the table holding the new rows
+        column_names (List[str]): the columns of the table
+
+    Returns:
+        Dict[str, int]: the number of rows inserted, updated and deleted
+    """
+    key_columns = table_keys[table_name]
+    key_match = ' AND '.join([f"{staging_table_name}.{column_name} = {table_name}.{column_name}" for column_name in key_columns])
+    value_columns = [column_name for column_name in column_names if column_name not in key_columns]
+    columns = ', '.join(column_names)
+
+    connection.execute(f"CREATE INDEX temp.{staging_table_name}_key ON {staging_table_name} ({', '.join(key_columns)})")
+    deleted = connection.execute(f"DELETE FROM {table_name} WHERE NOT EXISTS (SELECT 1 FROM {staging_table_name} WHERE {key_match})").rowcount
+    inserted = connection.execute(f"SELECT count(*) FROM {staging_table_name} WHERE NOT EXISTS (SELECT 1 FROM {table_name} WHERE {key_match})").fetchone()[0]
+    # the WHERE true resolves the ambiguity between a join and the ON CONFLICT clause for SQLite's parser
+    changed = connection.execute(f"""
+        INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {staging_table_name} WHERE true
+        ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {', '.join([f"{column_name} = excluded.{column_name}" for column_name in value_columns])}
+        WHERE {' OR '.join([f"{table_name}.{column_name} IS NOT excluded.{column_name}" for column_name in value_columns])}
+    """).rowcount
+    connection.execute(f"DROP TABLE {staging_table_name}")
+    return {'inserted': inserted, 'updated': changed - inserted, 'deleted': deleted}
+
+
+def create_dbs_from_tables(tables:Dict[str, Iterable[List]], databases:Dict[str, List[str]], pocket_positions:List, upsert:bool=False, batch_size:int=10000) -> Dict[str, Dict]:
+    """
+    This function builds a set of SQLite databases from tables of rows, loading each table into every database which includes it in a single pass through its rows
+
+    The rows are read a batch at a time, so a table can be streamed from its CSV files.
+
+    Each database is built in a temporary file in a single transaction, with an explicit schema, and then swapped in for the existing database, so anything reading the database sees either the old or the new version and never a missing or partly built one. By default the tables are built from scratch. In upsert mode the temporary file starts as a copy of the existing database and only the rows which have been added, changed or removed are applied, matched on the key of each table; a table is built from scratch if the database does not exist or the table has a different schema.
+
+    Args:
+        tables (Dict[str, Iterable[List]]): the rows of each table, keyed by table name, the first row is the header
+        databases (Dict[str, List[str]]): the tables in each database, keyed by the database filename e.g. {'output/tabular_data/alleles.db': ['alleles']}
+        pocket_positions (List): the IMGT positions of the pocket residues
+        upsert (bool): whether existing databases are updated in place rather than built from scratch
+        batch_size (int): the number of rows inserted with each executemany
+
+    Returns:
+        Dict[str, Dict]: the number of rows loaded into each table, and the number of rows inserted, updated and deleted in each table of each database
+    """
+    connections = {}
+    temporary_filenames = {database_filename:f"{database_filename}.{os.getpid()}.tmp" for database_filename in databases}
+    try:
+        for database_filename, temporary_filename in temporary_filenames.items():
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+            connection = sqlite3.connect(temporary_filename)
+            if upsert and os.path.exists(database_filename):
+                existing_connection = sqlite3.connect(database_filename)
+                existing_connection.backup(connection)
+                existing_connection.close()
+            # the database is built in a temporary file, so if the build fails it is discarded and the existing database is left in place
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('BEGIN')
+            connections[database_filename] = connection
+
+        row_counts = {}
+        changes = {database_filename:{} for database_filename in databases}
+        for table_name, rows in tables.items():
+            rows = iter(rows)
+            headers = next(rows)
+            columns = table_columns(table_name, pocket_positions)
+            column_names = [column_name for column_name, column_type in columns]
+            if headers != column_names:
+                raise ValueError(f"The header of the {table_name} table does not match its schema, expected {column_names} but found {headers}")
+            integer_columns = [i for i, (column_name, column_type) in enumerate(columns) if column_type.startswith('INTEGER')]
+
+            # tables which can be updated in place are loaded into a staging table, the others are built from scratch
+            insert_statements = {}
+            for database_filename, connection in connections.items():
+                if table_name not in databases[database_filename]:
+                    continue
+                if upsert and can_upsert(connection, table_name, columns):
+                    target_table_name = f"staging_{table_name}"
+                    connection.execute(table_definition(f"temp.{target_table_name}", columns))
+                else:
+                    target_table_name = table_name
+                    connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+                    connection.execute(table_definition(table_name, columns))
+                insert_statements[database_filename] = (target_table_name, f"INSERT INTO {target_table_name} ({', '.join(column_names)}) VALUES ({', '.join(['?'] * len(columns))})")
+
+            # the rows are converted once and each batch is inserted into every database with the table
+            row_counts[table_name] = 0
+            batch = [convert_row(row, integer_columns) for row in itertools.islice(rows, batch_size)]
+            while batch:
+                for database_filename, (target_table_name, insert_statement) in insert_statements.items():
+                    connections[database_filename].executemany(insert_statement, batch)
+                row_counts[table_name] += len(batch)
+                batch = [convert_row(row, integer_columns) for row in itertools.islice(rows, batch_size)]
+
+            for database_filename, (target_table_name, insert_statement) in insert_statements.items():
+                connection = connections[database_filename]
+                if target_table_name == table_name:
+                    connection.execute(f"CREATE UNIQUE INDEX {table_name}_key ON {table_name} ({', '.join(table_keys[table_name])})")
+                    for column_name in table_indexes[table_name]:
+                        connection.execute(f"CREATE INDEX {table_name}_{column_name} ON {table_name} ({column_name})")
+                    changes[database_filename][table_name] = {'inserted': row_counts[table_name], 'updated': 0, 'deleted': 0, 'rebuilt': True}
+                else:
+                    changes[database_filename][table_name] = {**upsert_table(connection, table_name, target_table_name, column_names), 'rebuilt': False}
+
+        for database_filename, connection in connections.items():
+            connection.commit()
+            connection.close()
+            # the new database is flushed to disk before it replaces the existing one
+            with open(temporary_filenames[database_filename], 'rb') as database_file:
+                os.fsync(database_file.fileno())
+            os.replace(temporary_filenames[database_filename], database_filename)
+    finally:
+        for database_filename, temporary_filename in temporary_filenames.items():
+            if database_filename in connections:
+                connections[database_filename].close()
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+    return {'row_counts': row_counts, 'changes': changes}
 
-    csvs_to_sqllite_command = f"csvs-to-sqlite {input_filename_str} {output_filename}"
-    os.system(csvs_to_sqllite_command)
 
-def combine_csv_files(filenames:List) -> List:
-    i = 0
-    table = []
+def combine_csv_files(filenames:List[str]) -> Iterator[List[str]]:
+    """
+    This function streams the rows of a set of CSV files as a single table, the header once and then the data rows of each file in turn
+
+    Only one row is held in memory at a time. Each file must have the same header as the first.
+
+    Args:
+        filenames (List[str]): the paths to the CSV files
+
+    Returns:
+        Iterator[List[str]]: the header and then the data rows
+    """
+    headers = None
     for filename in filenames:
-        print (f"Appending {filename} to table")
         with open(filename, 'r') as filehandle:
             reader = csv.reader(filehandle)
-            if i == 0:
-                table = [row for row in reader]
-                headers = table[0]
-                data_row_length = len(table) - 1
-                print (f"Appending headers {headers} and {data_row_length} data rows")
-            data_rows = [row for row in reader][1:]
-            print (f"Appending {len(data_rows)} data rows...")
-            table = table + data_rows
-            i += 1
-        print (f"New table length {len(table)}")
-    print (f"Completed combining files, table length {len(table)}")    
-    return table
+            file_headers = next(reader, None)
+            if file_headers is None:
+                raise ValueError(f"{filename} has no header")
+            if headers is None:
+                headers = file_headers
+                yield headers
+            elif file_headers != headers:
+                raise ValueError(f"The header of {filename} does not match the header of {filenames[0]}, expected {headers} but found {file_headers}")
+            data_row_count = 0
+            for row in reader:
+                data_row_count += 1
+                yield row
+        print (f"Appended {data_row_count} data rows from {filename}")
 
 
+def write_csv_rows(rows:Iterable[List[str]], filename:str) -> Iterator[List[str]]:
+    """
+    This function writes rows to a CSV file as they are streamed through it, so a table can be saved and loaded into a database in a single pass
 
+    Args:
+        rows (Iterable[List[str]]): the rows of the table
+        filename (str): the path to the CSV file
 
+    Returns:
+        Iterator[List[str]]: the same rows, once each has been written
+    """
+    with open(filename, 'w', newline='\n') as filehandle:
+        writer = csv.writer(filehandle)
+        for row in rows:
+            writer.writerow(row)
+            yield row
 
 
-def create_db_from_tabular_representations(config:Dict, **kwargs) -> None:
+def create_db_from_tabular_representations(config:Dict, **kwargs) -> Dict:
     """
     This function takes a set of loci and builds a database table from them.
 
     Args:
         loci (List): the list of loci to be processed
         verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+        upsert (bool): whether the existing databases are updated in place with only the rows which have changed, rather than built from scratch
     Returns:
+        Dict: the action dictionary for this step, the number of rows loaded into each table and the changes made to each database, which will be stored in the pipeline log
 
     """
     loci = kwargs['loci']
     species_stem = kwargs['species_stem']
+    output_path = kwargs['output_path']
     relationship_types = config['CONSTANTS']['RELATIONSHIP_TYPES']
-    
+    upsert = kwargs.get('upsert', False)
 
     # combine allele sequence information
 
@@ -64,15 +295,8 @@ def create_db_from_tabular_representations(config:Dict, **kwargs) -> None:
 
     for locus in loci:
         locus_slug = f"{species_stem}_{locus.lower()}"
-        allele_sequence_filenames.append(f"output/tabular_data/alleles/{locus_slug}.csv")
-    table = combine_csv_files(allele_sequence_filenames)
-
-    alleles_output_filename = "output/tabular_data/alleles.csv"
-
-    write_csv_file(alleles_output_filename , table)
-
-    create_db_from_csvs([alleles_output_filename], "output/tabular_data/alleles.db")
-
+        allele_sequence_filenames.append(f"{output_path}/tabular_data/alleles/{locus_slug}.csv")
+    alleles_output_filename = f"{output_path}/tabular_data/alleles.csv"
 
     allele_relationship_filenames = []
 
@@ -80,17 +304,20 @@ def create_db_from_tabular_representations(config:Dict, **kwargs) -> None:
         for locus in loci:
             locus_slug = f"{species_stem}_{locus.lower()}"
             if locus_slug not in ['hla_e', 'hla_f', 'hla_g']:
-                allele_relationship_filenames.append(f"output/tabular_data/relationships/{locus_slug}_{relationship_type}.csv")
-    
-    table = combine_csv_files(allele_relationship_filenames)
-
-    relationships_output_filename = "output/tabular_data/relationships.csv"
-
-    write_csv_file(relationships_output_filename , table)
-
-    create_db_from_csvs([relationships_output_filename], "output/tabular_data/relationships.db")
+                allele_relationship_filenames.append(f"{output_path}/tabular_data/relationships/{locus_slug}_{relationship_type}.csv")
 
+    relationships_output_filename = f"{output_path}/tabular_data/relationships.csv"
 
-    create_db_from_csvs([alleles_output_filename, relationships_output_filename], "output/tabular_data/combined.db")
+    # the rows of the locus files are streamed into the combined CSV files and the databases at the same time
+    tables = {
+        'alleles': write_csv_rows(combine_csv_files(allele_sequence_filenames), alleles_output_filename),
+        'relationships': write_csv_rows(combine_csv_files(allele_relationship_filenames), relationships_output_filename)
+    }
 
-    pass
+    # the combined database is loaded in the same pass as the alleles and relationships databases
+    databases = {
+        f"{output_path}/tabular_data/alleles.db": ['alleles'],
+        f"{output_path}/tabular_data/relationships.db": ['relationships'],
+        f"{output_path}/tabular_data/combined.db": ['alleles', 'relationships']
+    }
+    return create_dbs_from_tables(tables, databases, config['CONSTANTS']['IMGT_POCKET_RESIDUES'], upsert=upsert)
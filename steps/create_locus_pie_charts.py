@@ -6,7 +6,7 @@ from io import BytesIO
 from matplotlib.figure import Figure
 import numpy as np
 
-import json
+from common.artifacts import load_artifact
 
 def top_n(dataset:Dict, n:int=10):
     # Sort the dictionary by percentage in descending order
@@ -27,7 +27,7 @@ def deslugify_allele_group(text:str) -> str:
     return f"{elements[0]}-{elements[1]}*{elements[2]}".upper()
 
 
-def generate_allele_group_pie_chart(allele_groups:Dict, allele_count:int, locus:str) -> Tuple[str, str, str]:
+def generate_allele_group_pie_chart(allele_groups:Dict, allele_count:int, locus:str, output_path:str='output') -> Tuple[str, str, str]:
     labels = []
     values = []
     others = []
@@ -69,7 +69,7 @@ def generate_allele_group_pie_chart(allele_groups:Dict, allele_count:int, locus:
     svg = BytesIO()
 
 
-    filestem = f"output/processed_data/pie_charts/{locus.lower()}"
+    filestem = f"{output_path}/processed_data/pie_charts/{locus.lower()}"
     
     fig.savefig(png, format="png")
     fig.savefig(f"{filestem}.png", format="png")
@@ -101,14 +101,12 @@ def create_locus_pie_charts(config:Dict, **kwargs) -> None:
     """
     locus = kwargs['locus']
     species_stem = kwargs['species_stem']
+    output_path = kwargs['output_path']
     
     locus_slug = f"{species_stem}_{locus.lower()}"
 
 
-    input_filename = f"output/processed_data/allele_groups/{locus_slug}.json"
-
-    with open(input_filename, 'r') as allele_groups_file:
-        allele_groups = json.load(allele_groups_file)
+    allele_groups = load_artifact(kwargs.get('artifacts'), 'allele_groups', locus_slug, output_path)
     
 
     allele_count = 0
@@ -124,6 +122,6 @@ def create_locus_pie_charts(config:Dict, **kwargs) -> None:
         allele_group_count += 1
 
 
-    png_data, svg_data, alt_text = generate_allele_group_pie_chart(allele_group_stats, allele_count, locus)
+    png_data, svg_data, alt_text = generate_allele_group_pie_chart(allele_group_stats, allele_count, locus, output_path)
 
     pass
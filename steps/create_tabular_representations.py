@@ -1,7 +1,8 @@
 from typing import Dict, List, Tuple
 
 import csv
-import json
+
+from common.artifacts import load_artifact
 
 
 def get_allele_group(text:str) -> str:
@@ -38,15 +39,14 @@ def create_tabular_representations(config:Dict, **kwargs) -> None:
     """
     locus = kwargs['locus']
     species_stem = kwargs['species_stem']
+    output_path = kwargs['output_path']
     
     locus_slug = f"{species_stem}_{locus.lower()}"
 
 
-    input_filename = f"output/processed_data/protein_alleles/{locus_slug}.json"
-    output_filename = f"output/tabular_data/alleles/{locus_slug}.csv"
+    output_filename = f"{output_path}/tabular_data/alleles/{locus_slug}.csv"
 
-    with open(input_filename, 'r') as protein_alleles_filehandle:
-        protein_alleles = json.load(protein_alleles_filehandle)
+    protein_alleles = load_artifact(kwargs.get('artifacts'), 'protein_alleles', locus_slug, output_path)
     
     pocket_positions = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
 
@@ -9,6 +9,7 @@ console = Console()
 
 from common.helpers import slugify
 from common.pipeline import get_current_time
+from common.fasta_index import load_fasta_index, dataset_description_parsers
 
 def fetch_raw_datasets(config:Dict, **kwargs):
     
@@ -53,6 +54,17 @@ def fetch_raw_datasets(config:Dict, **kwargs):
                 print("")
             
             action_log[slugify(datasource)] = {'cached':downloaded_at}
+
+        # build (or rebuild if the file has changed) the byte offset index of the records in the file
+        if os.path.exists(filepath):
+            try:
+                fasta_index = load_fasta_index(filepath, dataset_description_parsers[datasource])
+                action_log[slugify(datasource)]['indexed_records'] = len(fasta_index.records)
+            except (IndexError, KeyError, UnicodeDecodeError) as error:
+                # the index is only an optimisation, a dataset with a record the parser cannot read (or a download which is not a FASTA file) is left unindexed and read in full by the steps which use it
+                action_log[slugify(datasource)]['index_error'] = f"{type(error).__name__}: {error}"
+                if verbose:
+                    print (f"{datasource} could not be indexed, {type(error).__name__}: {error}")
     
     return action_log
 
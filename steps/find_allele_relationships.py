@@ -2,9 +2,15 @@ from typing import Dict, List, Tuple
 
 from Levenshtein import hamming
 
+import numpy as np
 import json
 import csv
 
+from common.allele import encode_sequences
+from common.artifacts import load_artifact
+from common.reference_panel import build_reference_panel
+from common.events import report_progress
+
 def locate_polymorphisms(allele_pseudosequence:str, match_pseudosequence:str, pocket_positions:List) -> Dict:
     polymorphisms = {}
     for i, position in enumerate(pocket_positions):
@@ -70,6 +76,84 @@ def find_closest_alleles_function(allele_slug:str, known_alleles:List[str], know
     return closest_alleles
 
 
+def find_closest_alleles(alleles_to_test:Dict[str, str], known_alleles:List[str], known_pseudosequences:Dict[str, str], pocket_positions:List, mode:str='motif', block_size:int=2048) -> Dict[str, List]:
+    """
+    This function finds the closest known alleles for a set of alleles, giving the same results as calling find_closest_alleles_function for each allele
+
+    Many protein alleles share the same pocket pseudosequence, so the search is run once for each distinct pseudosequence and the result is shared by every allele with that pseudosequence. Pseudosequences which exactly match a known allele are found through a hash index. For the rest, the pseudosequences are encoded as uint8 matrices and the Hamming distances to every known allele are computed in a single broadcast, for a block of pseudosequences at a time to bound the memory used. The polymorphisms are taken from the same mismatch matrix.
+
+    Args:
+        alleles_to_test (Dict[str, str]): the pocket pseudosequence of each allele to test, keyed by allele slug
+        known_alleles (List[str]): the slugs of the alleles with a known motif or structure
+        known_pseudosequences (Dict[str, str]): the pocket pseudosequence of each known allele, keyed by allele slug, in the order they are searched
+        pocket_positions (List): the IMGT positions of the pocket residues
+        mode (str): the relationship type e.g. motif
+        block_size (int): the number of pseudosequences compared with the known alleles at a time
+
+    Returns:
+        Dict[str, List]: the closest known alleles for each allele, in the same order as alleles_to_test, alleles with the same pseudosequence share the same list
+    """
+    known_alleles = set(known_alleles)
+    known_slugs = list(known_pseudosequences.keys())
+    known_matrix = encode_sequences(list(known_pseudosequences.values()), width=len(pocket_positions))
+
+    # the exact match index gives the first known allele searched with each pseudosequence, as the search stops at the first exact match
+    exact_matches = {}
+    for known_slug, known_pseudosequence in known_pseudosequences.items():
+        if known_pseudosequence not in exact_matches:
+            exact_matches[known_pseudosequence] = known_slug
+
+    closest_alleles = {}
+    pseudosequence_matches = {}
+    search_pseudosequences = []
+    for allele_slug, allele_pseudosequence in alleles_to_test.items():
+        # alleles with a known motif or structure are labelled without a search
+        if allele_slug in known_alleles:
+            closest_alleles[allele_slug] = [{
+                'nearest_known_allele':allele_slug,
+                'distance':0,
+                'relationship_label':f"experimentally_determined_{mode}",
+                'polymorphisms': None
+            }]
+        elif allele_pseudosequence not in pseudosequence_matches:
+            if allele_pseudosequence in exact_matches:
+                pseudosequence_matches[allele_pseudosequence] = [{
+                    'nearest_known_allele':exact_matches[allele_pseudosequence],
+                    'distance':0,
+                    'relationship_label':'exact_pseudosequence_match',
+                    'polymorphisms': None
+                }]
+            else:
+                pseudosequence_matches[allele_pseudosequence] = []
+                search_pseudosequences.append(allele_pseudosequence)
+
+    for start in range(0, len(search_pseudosequences), block_size):
+        block_pseudosequences = search_pseudosequences[start:start + block_size]
+        block_matrix = encode_sequences(block_pseudosequences, width=len(pocket_positions))
+        # mismatches has a shape of (pseudosequences, known alleles, pocket positions)
+        mismatches = block_matrix[:, np.newaxis, :] != known_matrix[np.newaxis, :, :]
+        distances = mismatches.sum(axis=2)
+        min_distances = distances.min(axis=1)
+        # every (pseudosequence, known allele) pair at the minimum distance for the pseudosequence, in the order the known alleles are searched
+        pair_rows, pair_columns = np.nonzero(distances == min_distances[:, np.newaxis])
+        # and the pocket positions at which each of those pairs differ
+        pair_numbers, mismatch_positions = np.nonzero(mismatches[pair_rows, pair_columns])
+        pair_mismatches = np.split(mismatch_positions, np.cumsum(np.bincount(pair_numbers, minlength=len(pair_rows)))[:-1])
+        min_distances = min_distances.tolist()
+        for pair_number, (i, j) in enumerate(zip(pair_rows.tolist(), pair_columns.tolist())):
+            allele_pseudosequence = block_pseudosequences[i]
+            known_pseudosequence = known_pseudosequences[known_slugs[j]]
+            pseudosequence_matches[allele_pseudosequence].append({
+                'nearest_known_allele':known_slugs[j],
+                'distance':min_distances[i],
+                'relationship_label':"nearest_pseudosequence_match",
+                'polymorphisms': {pocket_positions[k]:{'from':known_pseudosequence[k], 'to':allele_pseudosequence[k]} for k in pair_mismatches[pair_number].tolist()}
+            })
+
+    # the results for each pseudosequence are fanned back out to the alleles which share it
+    return {allele_slug:closest_alleles[allele_slug] if allele_slug in closest_alleles else pseudosequence_matches[alleles_to_test[allele_slug]] for allele_slug in alleles_to_test}
+
+
 def tabulate_relationships(relationships:Dict, relationship_type:str, pocket_positions:List, distance_frequency_cutoff:int=10) -> List:
     rows = []
     outliers = []
@@ -117,6 +201,10 @@ def find_allele_relationships(config:Dict, **kwargs) -> None:
     """
     test_locus = kwargs['locus']
     loci = kwargs['loci']
+    species_stem = kwargs['species_stem']
+    output_path = kwargs['output_path']
+
+    test_locus_slug = f"{species_stem}_{test_locus.lower()}"
 
     relationship_types = config['CONSTANTS']['RELATIONSHIP_TYPES']
 
@@ -128,40 +216,24 @@ def find_allele_relationships(config:Dict, **kwargs) -> None:
 
     pocket_positions = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
 
-    # we'll initialise some datastructures that we'll use to store the pseudosequences for the known motifs and structures and the alleles we want to test
+    # the pseudosequences for the known motifs, structures and NetMHCPan alleles are built once and shared by every locus
+    if 'log_path' in kwargs:
+        cache_path = f"{kwargs['log_path']}/reference_panels"
+    else:
+        cache_path = None
+    pseudosequences = build_reference_panel(config, loci, species_stem, output_path=output_path, cache_path=cache_path, artifacts=kwargs.get('artifacts'))
 
-    alleles_to_test = None
+    # we'll load the alleles for the locus we're testing
+    raw_alleles = load_artifact(kwargs.get('artifacts'), 'protein_alleles', test_locus_slug, output_path)
 
-    pseudosequences = {}
+    alleles_to_test = {}
 
-    for relationship_type in relationship_types:
-        pseudosequences[relationship_type] = {}
-
-    # we'll iterate through the loci 
-    for locus in loci:
-        # we'll load the pseudosequences for the known motifs and structures
-        input_filename = f"output/processed_data/protein_alleles/{locus.lower()}.json"
-        with open(input_filename, 'r') as protein_alleles_filehandle:
-            raw_alleles = json.load(protein_alleles_filehandle)
-
-        # we'll iterate through the alleles in the raw alleles
-        for allele in raw_alleles:
-            
-            for relationship_type in relationship_types:
-                # we'll check if the allele is in the known motifs
-                if allele in known_alleles[relationship_type]:
-                    pseudosequences[relationship_type][allele] = raw_alleles[allele]['pocket_pseudosequence']
-                    
-       # if the locus is the locus we're testing, we'll add the alleles to the alleles to test dictionary
-        if locus == test_locus:
-            alleles_to_test = {}
-
-            # we'll iterate through the alleles in the raw alleles
-            for allele in raw_alleles:
-                canonical_protein_allele_name = raw_alleles[allele]['canonical_allele']['protein_allele_name']
-                # we'll check if the canonical protein allele name doesn't end in N or Q (these have differential or no expression and often contain deletions)
-                if not canonical_protein_allele_name[-1] in ['N','Q']:
-                    alleles_to_test[allele] = raw_alleles[allele]['pocket_pseudosequence']
+    # we'll iterate through the alleles in the raw alleles
+    for allele in raw_alleles:
+        canonical_protein_allele_name = raw_alleles[allele]['canonical_allele']['protein_allele_name']
+        # we'll check if the canonical protein allele name doesn't end in N or Q (these have differential or no expression and often contain deletions)
+        if not canonical_protein_allele_name[-1] in ['N','Q']:
+            alleles_to_test[allele] = raw_alleles[allele]['pocket_pseudosequence']
 
     # we'll initialise some datastructures to store the related alleles
 
@@ -176,9 +248,10 @@ def find_allele_relationships(config:Dict, **kwargs) -> None:
         related_alleles[relationship_type] = {}
         outlier_alleles[relationship_type] = {}
 
-    for allele_slug in alleles_to_test:
-        for relationship_type in relationship_types:            
-            related_alleles[relationship_type][allele_slug] = find_closest_alleles_function(allele_slug, known_alleles[relationship_type], pseudosequences[relationship_type], alleles_to_test[allele_slug],pocket_positions,  mode=relationship_type)
+    # the alleles are compared with all the known alleles of each relationship type at once, progress is reported as the number of allele comparisons made
+    for i, relationship_type in enumerate(relationship_types, start=1):
+        related_alleles[relationship_type] = find_closest_alleles(alleles_to_test, known_alleles[relationship_type], pseudosequences[relationship_type], pocket_positions, mode=relationship_type)
+        report_progress(kwargs.get('progress'), len(alleles_to_test) * i, len(alleles_to_test) * len(relationship_types))
 
     
     # metrics needed
@@ -197,10 +270,10 @@ def find_allele_relationships(config:Dict, **kwargs) -> None:
     distance_frequency_cutoff = 10
     outlier_alleles = {}
     distance_count_set = {}
-    distance_filename = f"output/processed_data/relationships/{test_locus.lower()}_distances.json"
+    distance_filename = f"{output_path}/processed_data/relationships/{test_locus_slug}_distances.json"
 
     for mode in relationship_types:
-        csv_filename = f"output/tabular_data/relationships/{test_locus.lower()}_{mode}.csv"
+        csv_filename = f"{output_path}/tabular_data/relationships/{test_locus_slug}_{mode}.csv"
         
 
         table, outlier_alleles['motif'], distance_counts = tabulate_relationships(related_alleles[mode], mode, pocket_positions, distance_frequency_cutoff)
@@ -1,7 +1,11 @@
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
 import json
+import os
 
-from common.allele import parse_mhc_description, fasta_reader, process_sequence, find_canonical_allele, allele_name_modifiers
+from common.allele import parse_mhc_description, process_sequence, find_canonical_allele, allele_name_modifiers
+from common.fasta_index import fasta_chunk_boundaries, fasta_chunk_reader
+from common.events import ProgressReporter, report_progress
 from common.helpers import slugify
 
 from rich import print
@@ -11,36 +15,31 @@ from rich import print
 pocket_residues = None
 
 
-def generate_lists(sequence_set:str, verbose:bool=True) -> Union[Dict, Dict, Dict, Dict, Dict, List]:
+def parse_chunk(filename:str, start:int, end:int, progress:Optional[ProgressReporter]=None) -> Dict:
     """
-    This function takes a dataset and generate an allele list and associated sequence lists for all Class I loci contained within it.
+    This function parses the records in a byte range of a dataset into partial allele and sequence lists, it is run in a worker process when parsing in parallel
 
     Args:
-        sequence_set (str): the name of the sequence set, this is used to determine the file name e.g. IPD_MHC_PROT which results in the filename tmp/ipd_mhc_prot.fasta
-        verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+        filename (str): the path to the FASTA file
+        start (int): the byte offset of the start of the chunk, at a record boundary
+        end (int): the byte offset of the end of the chunk, at a record boundary
+        progress (ProgressReporter): the progress reporter for the step, which is passed the number of records read, only used when the whole dataset is parsed as one chunk
+
     Returns:
-        Dict: the dictionary of protein alleles 
-        Dict: the dictionary of cytoplasmic sequences
-        Dict: the dictionary of g-domain sequences
-        Dict: the dictionary of pocket pseudosequences (same as NetMHCPan pseudosequences), in this case empty until we can generate them reliably for non-IMGT numbering compliant sequences
-        Dict: the dictionary of basic statistics
-        List: an array of unmatched alleles
+        Dict: the partial dictionaries of protein alleles, cytoplasmic and g-domain sequences, the unmatched alleles and the sequence counts for the chunk
     """
-    # this variable stores a simple counter of all sequences in the dataset
+    # this variable stores a simple counter of all sequences in the chunk
     all_sequences_count = 0
-    
-    filename = f"tmp/{sequence_set.lower()}.fasta"
 
     unmatched = []
 
     protein_alleles = {}
     cytoplasmic_sequences = {}
     gdomain_sequences = {}
-    pocket_pseudosequences = None
 
     mhc_class_i_count = 0
-    for entry in fasta_reader(filename):
-        allele_info = parse_mhc_description(str(entry.description))
+    for description, sequence in fasta_chunk_reader(filename, start, end):
+        allele_info = parse_mhc_description(description)
         
         # first of all exclude any sequences whose locus is that of classical Class II, this won't catch all species, but will do for primates
         if not allele_info['locus'].split('-')[1][0:3] in ['DPA','DPB','DQA','DQB','DRA','DRB']:
@@ -48,7 +47,7 @@ def generate_lists(sequence_set:str, verbose:bool=True) -> Union[Dict, Dict, Dic
             allele_slug = None
             locus_slug = None
 
-            sequence_data = process_sequence(str(entry.seq), pocket_residues)
+            sequence_data = process_sequence(sequence, pocket_residues)
             if sequence_data['class_i_start'] and sequence_data['appropriate_length']:
                 mhc_class_i_count += 1
 
@@ -109,12 +108,125 @@ def generate_lists(sequence_set:str, verbose:bool=True) -> Union[Dict, Dict, Dic
                 unmatched.append(allele_info['protein_allele_name'])
                 
         all_sequences_count += 1
+        report_progress(progress, all_sequences_count)
+    return {
+        'protein_alleles': protein_alleles,
+        'cytoplasmic_sequences': cytoplasmic_sequences,
+        'gdomain_sequences': gdomain_sequences,
+        'unmatched': unmatched,
+        'all_sequences_count': all_sequences_count,
+        'mhc_class_i_count': mhc_class_i_count
+    }
+
+
+def merge_sequence_dicts(sequences:Dict, partial_sequences:Dict) -> Dict:
+    """
+    This function merges a partial species -> locus -> sequence dictionary from a later chunk into the dictionary for the earlier chunks
+
+    Args:
+        sequences (Dict): the dictionary for the earlier chunks
+        partial_sequences (Dict): the dictionary for the later chunk
+
+    Returns:
+        Dict: the merged dictionary
+    """
+    for species_slug in partial_sequences:
+        if species_slug not in sequences:
+            sequences[species_slug] = {}
+        for locus_slug in partial_sequences[species_slug]:
+            if locus_slug not in sequences[species_slug]:
+                sequences[species_slug][locus_slug] = {}
+            for sequence in partial_sequences[species_slug][locus_slug]:
+                if sequence not in sequences[species_slug][locus_slug]:
+                    sequences[species_slug][locus_slug][sequence] = partial_sequences[species_slug][locus_slug][sequence]
+                else:
+                    sequences[species_slug][locus_slug][sequence]['alleles'] += partial_sequences[species_slug][locus_slug][sequence]['alleles']
+    return sequences
+
+
+def merge_chunks(partials:List[Dict]) -> Dict:
+    """
+    This function merges the partial lists from each chunk, in file order, so that the result is the same as parsing the dataset in a single pass
+
+    Args:
+        partials (List[Dict]): the partial lists generated by parse_chunk, in file order
+
+    Returns:
+        Dict: the merged lists
+    """
+    merged = {
+        'protein_alleles': {},
+        'cytoplasmic_sequences': {},
+        'gdomain_sequences': {},
+        'unmatched': [],
+        'all_sequences_count': 0,
+        'mhc_class_i_count': 0
+    }
+    protein_alleles = merged['protein_alleles']
+    for partial in partials:
+        for locus_slug in partial['protein_alleles']:
+            if locus_slug not in protein_alleles:
+                protein_alleles[locus_slug] = {}
+            for allele_slug in partial['protein_alleles'][locus_slug]:
+                partial_allele = partial['protein_alleles'][locus_slug][allele_slug]
+                if allele_slug not in protein_alleles[locus_slug]:
+                    protein_alleles[locus_slug][allele_slug] = partial_allele
+                else:
+                    protein_alleles[locus_slug][allele_slug]['alleles'] += partial_allele['alleles']
+                    for sequence in partial_allele['sequences']:
+                        if sequence not in protein_alleles[locus_slug][allele_slug]['sequences']:
+                            protein_alleles[locus_slug][allele_slug]['sequences'].append(sequence)
+        for sequence_type in ['cytoplasmic_sequences', 'gdomain_sequences']:
+            merge_sequence_dicts(merged[sequence_type], partial[sequence_type])
+        merged['unmatched'] += partial['unmatched']
+        merged['all_sequences_count'] += partial['all_sequences_count']
+        merged['mhc_class_i_count'] += partial['mhc_class_i_count']
+    return merged
+
+
+def generate_lists(sequence_set:str, verbose:bool=True, workers:Optional[int]=None, progress:Optional[ProgressReporter]=None) -> Union[Dict, Dict, Dict, Dict, Dict, List]:
+    """
+    This function takes a dataset and generate an allele list and associated sequence lists for all Class I loci contained within it.
+
+    Args:
+        sequence_set (str): the name of the sequence set, this is used to determine the file name e.g. IPD_MHC_PROT which results in the filename tmp/ipd_mhc_prot.fasta
+        verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+        workers (int): the number of worker processes to parse the dataset with, if not set (or 1) the dataset is parsed in this process
+        progress (ProgressReporter): the progress reporter for the step, which is passed the number of records read
+    Returns:
+        Dict: the dictionary of protein alleles 
+        Dict: the dictionary of cytoplasmic sequences
+        Dict: the dictionary of g-domain sequences
+        Dict: the dictionary of pocket pseudosequences (same as NetMHCPan pseudosequences), in this case empty until we can generate them reliably for non-IMGT numbering compliant sequences
+        Dict: the dictionary of basic statistics
+        List: an array of unmatched alleles
+    """
+    filename = f"tmp/{sequence_set.lower()}.fasta"
+
+    pocket_pseudosequences = None
+
+    if workers and workers > 1:
+        # the file is split at record boundaries into more chunks than workers to even out the load, the chunks are merged back in file order
+        chunks = fasta_chunk_boundaries(filename, workers * 4)
+        partials = []
+        records_read = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # progress is reported as each chunk is returned, in file order
+            for partial in executor.map(parse_chunk, [filename] * len(chunks), [chunk[0] for chunk in chunks], [chunk[1] for chunk in chunks]):
+                partials.append(partial)
+                records_read += partial['all_sequences_count']
+                report_progress(progress, records_read)
+    else:
+        partials = [parse_chunk(filename, 0, os.path.getsize(filename), progress=progress)]
+
+    merged = merge_chunks(partials)
+
     stats = {
-        'all_sequences_count':all_sequences_count,
-        'all_class_i_allele_sequences_count':mhc_class_i_count,
-        'unmatched_count': len(unmatched)
+        'all_sequences_count':merged['all_sequences_count'],
+        'all_class_i_allele_sequences_count':merged['mhc_class_i_count'],
+        'unmatched_count': len(merged['unmatched'])
     }
-    return protein_alleles, cytoplasmic_sequences, gdomain_sequences, pocket_pseudosequences, stats, unmatched
+    return merged['protein_alleles'], merged['cytoplasmic_sequences'], merged['gdomain_sequences'], pocket_pseudosequences, stats, merged['unmatched']
 
 
 def parse_sequence_dict(sequences:Dict) -> Dict:
@@ -131,6 +243,8 @@ def construct_class_i_bulk_allele_lists(config:Dict, **kwargs):
         config (Dict): the configuration dictionary
         sequence_set (str): the dataset to be processed e.g. IPD_IMGT_HLA_PROT for the HLA protein sequence dataset from IPD/IMGT
         verbose (bool): a boolean as to whether this step should output to the terminal
+        workers (int): the number of worker processes to parse the dataset with, if not set the dataset is parsed in a single process
+        progress (ProgressReporter): the progress reporter the number of records read is passed to, if any
 
     Returns:
         Dict: the action dictionary for this step which will be stored in the pipeline log
@@ -141,8 +255,22 @@ def construct_class_i_bulk_allele_lists(config:Dict, **kwargs):
         verbose = kwargs['verbose']
     else:
         verbose = False
+    if 'workers' in kwargs:
+        workers = kwargs['workers']
+    else:
+        workers = None
+    if 'progress' in kwargs:
+        progress = kwargs['progress']
+    else:
+        progress = None
     
-    protein_alleles, cytoplasmic_sequences, gdomain_sequences, pocket_pseudosequences, stats, unmatched = generate_lists(sequence_set)
+    protein_alleles, cytoplasmic_sequences, gdomain_sequences, pocket_pseudosequences, stats, unmatched = generate_lists(sequence_set, workers=workers, progress=progress)
+
+    sequence_dicts = {
+        'cytoplasmic_sequences': cytoplasmic_sequences,
+        'gdomain_sequences': gdomain_sequences,
+        'pocket_pseudosequences': pocket_pseudosequences
+    }
 
     all_allele_count = 0
     # now we'll iterate through the alleles to find the canonical allele (the one with the lowest number)
@@ -172,7 +300,7 @@ def construct_class_i_bulk_allele_lists(config:Dict, **kwargs):
 
     for sequence_type in ['cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences']:
         directory_path = f"{output_path}/processed_data/{sequence_type}"
-        sequences = eval(sequence_type)
+        sequences = sequence_dicts[sequence_type]
         if sequences:
             for species in sequences:
                 for locus in sequences[species]:
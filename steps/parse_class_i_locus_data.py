@@ -1,8 +1,14 @@
-from typing import Dict, Union
+from typing import Dict, List, Optional, Tuple, Union
+import hashlib
 import json
+import os
 
-from common.allele import parse_hla_description, parse_h2_description, fasta_reader, process_sequence, find_canonical_allele, allele_name_modifiers
+from common.allele import AlleleRecord, parse_hla_description, parse_h2_description, fasta_reader, process_sequence, build_pocket_pseudosequences, find_canonical_allele, allele_name_modifiers
 from common.helpers import slugify
+from common.fasta_index import load_fasta_index
+from common.artifacts import ArtifactStore, load_artifact
+from common.events import ProgressReporter, report_progress
+from common.pipeline import file_hash, write_json_atomically
 
 from rich import print
 
@@ -14,104 +20,308 @@ species_functions = {
 
 non_standard_nomenclature_species = ['h2']
 
-def generate_lists_for_locus(locus:str, species_slug, sequence_set:str, config:Dict, verbose:bool) -> Union[int, Dict, Dict, Dict, Dict]:
+# the modules whose code determines the contents of the output files, the parsing and canonical allele logic, if any of them change the record manifests from a previous run cannot be used
+steps_path = os.path.dirname(os.path.abspath(__file__))
+provenance_modules = [os.path.join(steps_path, filename) for filename in ['parse_class_i_locus_data.py', 'common/allele.py', 'common/helpers.py']]
+
+def new_locus_lists() -> Dict:
     """
-    This function takes a dataset and generate an allele list and associated sequence lists for a specific locus.
+    This function creates the empty set of accumulators used to collect the sequences and alleles for a single locus
+
+    Each allele record is stored once in the records list, the other accumulators refer to it by its integer record id (its index in that list) until the lists are materialised.
+
+    Returns:
+        Dict: a dictionary of empty accumulators for the locus
+    """
+    return {
+        'total_sequences': 0,
+        'materialised': False,
+        'records': [],
+        'protein_alleles': {},
+        'protein_allele_sequences': {},
+        'cytoplasmic_sequences': {},
+        'gdomain_sequences': {},
+        'pocket_pseudosequences': {},
+        'pocket_records': [],
+        'suffixed_alleles': {},
+        'manifest': [],
+        'changed_records': {}
+    }
+
+
+def sequence_hash(sequence:str) -> str:
+    """
+    This function returns a content hash of a sequence, used to detect changed records between releases of a dataset
 
     Args:
-        locus (str): the locus of interest e.g. A
+        sequence (str): the sequence
+
+    Returns:
+        str: the hexadecimal SHA-256 digest of the sequence
+    """
+    return hashlib.sha256(sequence.encode('utf-8')).hexdigest()
+
+
+def classify_record(allele_info:Dict, sequence:str, species_slug:str) -> Tuple[Optional[str], Optional[str], Dict]:
+    """
+    This function processes the sequence of a record and decides whether it belongs in the protein allele lists
+
+    Args:
+        allele_info (Dict): the parsed description of the sequence record
+        sequence (str): the full protein sequence of the record
+        species_slug (str): the slug for the species e.g. h2, hla
+
+    Returns:
+        str: the slug of the protein allele for the record, or None if the record is not included
+        str: the suffix (modifier) of the allele name if the record is excluded as a suffixed allele, otherwise None
+        Dict: the processed sequence data (without the pocket pseudosequence)
+    """
+    # the pocket pseudosequences are extracted for the whole locus in one batch by assign_pocket_pseudosequences
+    sequence_data = process_sequence(sequence, None)
+    # we only want alleles with sequences long enough to include cytoplasmic domains
+    if sequence_data['appropriate_length'] and sequence_data['cytoplasmic_sequence']:
+        if len(sequence_data['cytoplasmic_sequence']) > 270:
+            protein_allele_name = allele_info['protein_allele_name']
+            if species_slug not in non_standard_nomenclature_species:
+                # we need to check if the allele name has a modifier, such as N, Q etc
+                modifier = protein_allele_name[-1]
+                if modifier in allele_name_modifiers:
+                    return None, modifier, sequence_data
+            # slugify the cleaned allele name
+            return slugify(protein_allele_name), None, sequence_data
+    return None, None, sequence_data
+
+
+def add_to_locus_lists(locus_lists:Dict, allele_info:Dict, sequence:str, species_slug:str, config:Dict) -> Tuple[Optional[str], Optional[str]]:
+    """
+    This function processes a single sequence record and adds it to the accumulators for its locus
+
+    Args:
+        locus_lists (Dict): the accumulators for the locus, as created by new_locus_lists
+        allele_info (Dict): the parsed description of the sequence record
+        sequence (str): the full protein sequence of the record
+        species_slug (str): the slug for the species e.g. h2, hla
+        config (Dict): the configuration dictionary
+
+    Returns:
+        str: the slug of the protein allele the record was added to, or None if it was not added
+        str: the suffix of the allele name if the record was excluded as a suffixed allele, otherwise None
+    """
+    protein_alleles = locus_lists['protein_alleles']
+    protein_allele_sequences = locus_lists['protein_allele_sequences']
+    suffixed_alleles = locus_lists['suffixed_alleles']
+
+    # increment the total sequence counter, only incrementing for class I sequences
+    locus_lists['total_sequences'] += 1
+    allele_slug, suffix, sequence_data = classify_record(allele_info, sequence, species_slug)
+
+    if suffix:
+        if not suffix in suffixed_alleles:
+            suffixed_alleles[suffix] = []
+        suffixed_alleles[suffix].append(allele_info['protein_allele_name'])
+
+    if allele_slug:
+        # store the allele information once and refer to it by record id from here on
+        record_id = len(locus_lists['records'])
+        locus_lists['records'].append(AlleleRecord.from_allele_info(allele_info))
+
+        # and check if it's in the protein allele dict
+        if allele_slug not in protein_alleles:
+            protein_allele_sequences[allele_slug] = set()
+            protein_alleles[allele_slug] = {
+                'sequences':[],
+                'alleles':[],
+                'canonical_allele':'',
+                'canonical_sequence':'',
+                'gdomain_sequence':sequence_data['gdomain_sequence'],
+                'pocket_pseudosequence':sequence_data['pocket_pseudosequence']
+            }
+        # and append the specific allele information    
+        protein_alleles[allele_slug]['alleles'].append(record_id)
+
+        if sequence_data['cytoplasmic_sequence'] not in protein_allele_sequences[allele_slug]:
+            protein_allele_sequences[allele_slug].add(sequence_data['cytoplasmic_sequence'])
+            protein_alleles[allele_slug]['sequences'].append(sequence_data['cytoplasmic_sequence'])
+        
+        # now add the unique sequences to the different sequence dictionaries
+        for sequence_type in config['CONSTANTS']['SEQUENCE_TYPES']:
+            if sequence_type == 'pocket_pseudosequences':
+                # keep the order the records are seen in so the batch assignment matches record by record processing
+                locus_lists['pocket_records'].append((sequence_data['cytoplasmic_sequence'], allele_slug, record_id))
+                continue
+
+            this_sequence_type = locus_lists[sequence_type]
+            # sequence types in the config are plural, in the protein_allele dictionary they're singular
+            sequence_type = sequence_type[:-1]
+
+            # if the sequence is not in the specific sequence type dictionary then we need to create an entry
+            if sequence_data[sequence_type] not in this_sequence_type:
+                this_sequence_type[sequence_data[sequence_type]] = {
+                    'alleles':[],
+                    'canonical_allele':{}
+                }
+            # and then append the record id to the alleles list for the sequence
+            this_sequence_type[sequence_data[sequence_type]]['alleles'].append(record_id)
+    return allele_slug, suffix
+
+
+def assign_pocket_pseudosequences(locus_lists:Dict, pocket_residues:List, block_size:int=8192) -> Dict:
+    """
+    This function extracts the pocket pseudosequences for every record collected for a locus in batches and adds them to the accumulators
+
+    The records are encoded a block at a time, so the packed copy of the sequences which the batch is extracted from is bounded by the block size rather than growing with the locus. The pocket records are released once they have been assigned.
+
+    Args:
+        locus_lists (Dict): the accumulators for the locus, as created by new_locus_lists
+        pocket_residues (List): the IMGT numbered pocket residues
+        block_size (int): the number of records encoded at a time
+
+    Returns:
+        Dict: the updated accumulators for the locus
+    """
+    protein_alleles = locus_lists['protein_alleles']
+    pocket_pseudosequences = locus_lists['pocket_pseudosequences']
+    pocket_records = locus_lists['pocket_records']
+
+    if not pocket_records:
+        return locus_lists
+
+    for start in range(0, len(pocket_records), block_size):
+        block = pocket_records[start:start + block_size]
+        strings, _ = build_pocket_pseudosequences([record[0] for record in block], pocket_residues)
+
+        for pocket_pseudosequence, (cytoplasmic_sequence, allele_slug, record_id) in zip(strings, block):
+            # the protein allele takes the pseudosequence of the first record seen for it
+            if protein_alleles[allele_slug]['pocket_pseudosequence'] is None:
+                protein_alleles[allele_slug]['pocket_pseudosequence'] = pocket_pseudosequence
+            if pocket_pseudosequence not in pocket_pseudosequences:
+                pocket_pseudosequences[pocket_pseudosequence] = {
+                    'alleles':[],
+                    'canonical_allele':{}
+                }
+            pocket_pseudosequences[pocket_pseudosequence]['alleles'].append(record_id)
+    locus_lists['pocket_records'] = []
+    return locus_lists
+
+
+def materialise_locus_lists(locus_lists:Dict) -> Dict:
+    """
+    This function replaces the record ids in the accumulators for a locus with the allele information dictionaries, ready for canonical allele selection and output
+
+    Each record is converted to a dictionary once and that dictionary is shared by every list which refers to it. The records are replaced by their dictionaries as they are converted and the records list is released afterwards, so the slotted records and the dictionaries are never all held at the same time.
+
+    Args:
+        locus_lists (Dict): the accumulators for the locus generated by generate_lists_for_loci
+
+    Returns:
+        Dict: the updated accumulators for the locus
+    """
+    if locus_lists['materialised']:
+        return locus_lists
+
+    record_dicts = locus_lists['records']
+    for record_id in range(len(record_dicts)):
+        record_dicts[record_id] = record_dicts[record_id].to_dict()
+
+    for allele_slug in locus_lists['protein_alleles']:
+        protein_allele = locus_lists['protein_alleles'][allele_slug]
+        protein_allele['alleles'] = [record_dicts[record_id] for record_id in protein_allele['alleles']]
+
+    for sequence_type in ['cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences']:
+        sequences = locus_lists[sequence_type]
+        for sequence in sequences:
+            sequences[sequence]['alleles'] = [record_dicts[record_id] for record_id in sequences[sequence]['alleles']]
+
+    # the dictionaries are now only held by the lists which refer to them
+    locus_lists['records'] = None
+    locus_lists['materialised'] = True
+    return locus_lists
+
+
+def generate_lists_for_loci(loci:List[str], species_slug:str, sequence_set:str, config:Dict, verbose:bool, previous_manifests:Optional[Dict]=None, progress:Optional[ProgressReporter]=None) -> Dict[str, Dict]:
+    """
+    This function takes a dataset and generates an allele list and associated sequence lists for a set of loci in a single pass through the dataset.
+
+    For loci with a previous record manifest, the lists are not built. Only the records which are new or changed since the manifest are processed and collected (in changed_records) so that the existing files can be patched.
+
+    Args:
+        loci (List[str]): the loci of interest e.g. ['A', 'B', 'C']
         species_slug (str): the slug for the species, this is used to switch between allele numbering functions for the mouse in particular e.g. h2, hla
         sequence_set (str): the name of the sequence set, this is used to determine the file name e.g. IPD_IMGT_HLA_PROT which results in the filename tmp/ipd_imgt_hla_prot.fasta
+        config (Dict): the configuration dictionary
         verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+        previous_manifests (Dict): the record manifests from the previous run for the loci which can be updated incrementally, keyed by locus and then record id
+        progress (ProgressReporter): the progress reporter for the step, which is passed the number of records read
     Returns:
-        int: the number of class I sequences within a specific locus in the dataset
-        Dict: the dictionary of protein alleles 
-        Dict: the dictionary of cytoplasmic sequences
-        Dict: the dictionary of g-domain sequences
-        Dict: the dictionary of pocket pseudosequences (same as NetMHCPan pseudosequences)
+        Dict[str, Dict]: a dictionary keyed by locus of the accumulators for that locus (see new_locus_lists)
     """
     filename = f"tmp/{sequence_set.lower()}.fasta"
 
+    # each record is routed to the accumulators for its locus, records for other loci are skipped without further processing
+    lists = {locus:new_locus_lists() for locus in loci}
 
-    protein_alleles = {}
-    cytoplasmic_sequences = {}
-    gdomain_sequences = {}
-    pocket_pseudosequences = {}
-
-    # counter for number of sequences in the dataset
-    total_sequences = 0
-
-    suffixed_alleles = {}
+    # if the dataset has been indexed with the same description parser, only the records for these loci are read
+    fasta_index = load_fasta_index(filename)
+    if fasta_index and fasta_index.description_parser == species_functions[species_slug].__name__:
+        entries = fasta_index.reader(loci)
+    else:
+        entries = fasta_reader(filename)
 
-    for entry in fasta_reader(filename):
+    for records_read, (description, sequence) in enumerate(entries, start=1):
+        report_progress(progress, records_read)
         if verbose:
-            print (entry)
+            print (description)
             print (species_slug)
         
-        allele_info = species_functions[species_slug](str(entry.description))
+        allele_info = species_functions[species_slug](description)
 
         if verbose:
             print (allele_info)
 
-        if allele_info['locus'] in locus:
-            protein_allele_name = None
-            allele_slug = None
-            # increment the total sequence counter, only incrementing for class I sequences
-            total_sequences += 1 
-            sequence_data = process_sequence(str(entry.seq), config['CONSTANTS']['IMGT_POCKET_RESIDUES'])
-            # we only want alleles with sequences long enough to include cytoplasmic domains
-            if sequence_data['appropriate_length'] and sequence_data['cytoplasmic_sequence']: 
-                if len(sequence_data['cytoplasmic_sequence']) > 270:
-                    protein_allele_name = allele_info['protein_allele_name']
-                    
-                    if species_slug not in non_standard_nomenclature_species:
-                        # we need to check if the allele name has a modifier, such as N, Q etc
-                        modifier = protein_allele_name[-1]
-                        if protein_allele_name[-1] in allele_name_modifiers:
-                            if not modifier in suffixed_alleles:
-                                suffixed_alleles[modifier] = []
-                            suffixed_alleles[modifier].append(protein_allele_name)
-                            protein_allele_name = None
-                    
-                    if protein_allele_name:
-                        # slugify the cleaned allele name
-                        allele_slug = slugify(protein_allele_name)
-
-                        # and check if it's in the protein allele dict
-                        if allele_slug not in protein_alleles:
-                            protein_alleles[allele_slug] = {
-                                'sequences':[],
-                                'alleles':[],
-                                'canonical_allele':'',
-                                'canonical_sequence':'',
-                                'gdomain_sequence':sequence_data['gdomain_sequence'],
-                                'pocket_pseudosequence':sequence_data['pocket_pseudosequence']
-                            }
-                        # and append the specific allele information    
-                        protein_alleles[allele_slug]['alleles'].append(allele_info)
-
-                        if sequence_data['cytoplasmic_sequence'] not in  protein_alleles[allele_slug]['sequences']:
-                            protein_alleles[allele_slug]['sequences'].append(sequence_data['cytoplasmic_sequence'])
-                        
-                        # now add the unique sequences to the different sequence dictionaries
-                        # TODO this looks optimisable
-
-                        for sequence_type in config['CONSTANTS']['SEQUENCE_TYPES']:
-                            
-                            this_sequence_type = eval(sequence_type)
-                            # sequence types in the config are plural, in the protein_allele dictionary they're singular
-                            sequence_type = sequence_type[:-1]
-
-                            # if the sequence is not in the specific sequence type dictionary then we need to create an entry
-                            if sequence_data[sequence_type] not in this_sequence_type:
-                                this_sequence_type[sequence_data[sequence_type]] = {
-                                    'alleles':[],
-                                    'canonical_allele':{}
-                                }
-                            # and then append the allele info to the alleles list for the sequence
-                            this_sequence_type[sequence_data[sequence_type]]['alleles'].append(allele_info)
-
-    return total_sequences, protein_alleles, cytoplasmic_sequences, gdomain_sequences, pocket_pseudosequences, suffixed_alleles
+        if allele_info['locus'] in lists:
+            locus_lists = lists[allele_info['locus']]
+            this_sequence_hash = sequence_hash(sequence)
+            if previous_manifests and allele_info['locus'] in previous_manifests:
+                previous_entry = previous_manifests[allele_info['locus']].get(allele_info['id'])
+                locus_lists['total_sequences'] += 1
+                # unchanged records are carried over from the previous manifest without being processed
+                if previous_entry and previous_entry[1] == description and previous_entry[2] == this_sequence_hash:
+                    locus_lists['manifest'].append(previous_entry)
+                    continue
+                allele_slug, suffix, sequence_data = classify_record(allele_info, sequence, species_slug)
+                if allele_slug:
+                    locus_lists['changed_records'][allele_info['id']] = (allele_info, sequence_data)
+            else:
+                allele_slug, suffix = add_to_locus_lists(locus_lists, allele_info, sequence, species_slug, config)
+            locus_lists['manifest'].append([allele_info['id'], description, this_sequence_hash, allele_slug, suffix])
+
+    if fasta_index:
+        fasta_index.close()
+
+    for locus in lists:
+        assign_pocket_pseudosequences(lists[locus], config['CONSTANTS']['IMGT_POCKET_RESIDUES'])
+
+    return lists
+
+
+def generate_lists_for_locus(locus:str, species_slug, sequence_set:str, config:Dict, verbose:bool) -> Union[int, Dict, Dict, Dict, Dict]:
+    """
+    This function takes a dataset and generate an allele list and associated sequence lists for a specific locus.
+
+    Args:
+        locus (str): the locus of interest e.g. A
+        species_slug (str): the slug for the species, this is used to switch between allele numbering functions for the mouse in particular e.g. h2, hla
+        sequence_set (str): the name of the sequence set, this is used to determine the file name e.g. IPD_IMGT_HLA_PROT which results in the filename tmp/ipd_imgt_hla_prot.fasta
+        verbose (bool): whether specific information is output to the terminal, for large sequence sets this can be overwhelming and significantly slow down the function
+    Returns:
+        int: the number of class I sequences within a specific locus in the dataset
+        Dict: the dictionary of protein alleles 
+        Dict: the dictionary of cytoplasmic sequences
+        Dict: the dictionary of g-domain sequences
+        Dict: the dictionary of pocket pseudosequences (same as NetMHCPan pseudosequences)
+    """
+    locus_lists = materialise_locus_lists(generate_lists_for_loci([locus], species_slug, sequence_set, config, verbose)[locus])
+    return locus_lists['total_sequences'], locus_lists['protein_alleles'], locus_lists['cytoplasmic_sequences'], locus_lists['gdomain_sequences'], locus_lists['pocket_pseudosequences'], locus_lists['suffixed_alleles']
 
 
 def parse_sequence_dict(sequences:Dict, species_slug:str) -> Dict:
@@ -136,61 +346,187 @@ def parse_sequence_dict(sequences:Dict, species_slug:str) -> Dict:
     return sequences
 
 
-def construct_class_i_locus_allele_lists(config:Dict, **kwargs) -> Dict:
+def record_manifest_filename(output_path:str, species_slug:str, locus:str) -> str:
     """
-    This function creates the data for a specific locus and saves it in a set of files in the output directory
+    This function returns the filename of the record manifest for a locus
 
     Args:
-        locus (str): the locus to be processed in a dataset e.g. A for HLA-A
+        output_path (str): the path to the output directory
         species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
-        sequence_set (str): the dataset to be processed e.g. IPD_IMGT_HLA_PROT for the HLA protein sequence dataset from IPD/IMGT
+        locus (str): the locus e.g. A for HLA-A
+
+    Returns:
+        str: the path to the record manifest file
+    """
+    return f"{output_path}/processed_data/record_manifests/{species_slug}_{locus.lower()}.json"
+
+
+def locus_output_filenames(output_path:str, species_slug:str, locus:str) -> Dict:
+    """
+    This function returns the filenames of the output files for a locus, keyed by the type of data
+
+    Args:
+        output_path (str): the path to the output directory
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        locus (str): the locus e.g. A for HLA-A
+
+    Returns:
+        Dict: the output filenames keyed by data type e.g. protein_alleles
+    """
+    data_types = ['protein_alleles', 'cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences', 'allele_suffixes']
+    return {data_type:f"{output_path}/processed_data/{data_type}/{species_slug}_{locus.lower()}.json" for data_type in data_types}
+
+
+def manifest_provenance(config:Dict) -> str:
+    """
+    This function returns the provenance of a record manifest, a hash of the pocket residues, the sequence types and the code which parses the records and finds the canonical alleles
+
+    A manifest is only used to update the files incrementally if its provenance matches, otherwise the pocket pseudosequences, g-domains and canonical alleles of the unchanged records may be stale.
+
+    Args:
         config (Dict): the configuration dictionary
-        verbose (bool): a boolean as to whether this step should output to the terminal
 
     Returns:
-        Dict: the action dictionary for this step which will be stored in the pipeline log
+        str: the hex digest of the inputs
     """
-    
-    locus = kwargs['locus']
-    species_slug = kwargs['species_slug']
-    sequence_set = kwargs['sequence_set']
-    output_path = kwargs['output_path']
-    if 'verbose' in kwargs:
-        verbose = kwargs['verbose']
+    inputs = {
+        'pocket_residues': config['CONSTANTS']['IMGT_POCKET_RESIDUES'],
+        'sequence_types': config['CONSTANTS']['SEQUENCE_TYPES'],
+        'code': [file_hash(filename) for filename in provenance_modules]
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def save_record_manifest(output_path:str, species_slug:str, locus:str, manifest:List, provenance:str):
+    """
+    This function saves the record manifest for a locus, one entry per record of the locus in the dataset in file order
+
+    Args:
+        output_path (str): the path to the output directory
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        locus (str): the locus e.g. A for HLA-A
+        manifest (List): the manifest entries of id, description, sequence hash, protein allele slug (or None) and allele name suffix (or None)
+        provenance (str): the provenance of the manifest, from manifest_provenance
+    """
+    filename = record_manifest_filename(output_path, species_slug, locus)
+    write_json_atomically(filename, {'provenance': provenance, 'fields': ['id', 'description', 'sequence_hash', 'allele_slug', 'suffix'], 'records': manifest})
+
+
+def discard_record_manifest(output_path:str, species_slug:str, locus:str):
+    """
+    This function removes the record manifest for a locus, if there is one, before any of the files for the locus are written
+
+    If a run is interrupted while the files are being written, the next run finds no manifest and rebuilds the locus in full rather than applying the differences to partly updated files a second time.
+
+    Args:
+        output_path (str): the path to the output directory
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        locus (str): the locus e.g. A for HLA-A
+    """
+    filename = record_manifest_filename(output_path, species_slug, locus)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def load_previous_manifests(loci:List[str], species_slug:str, output_path:str, provenance:str) -> Dict:
+    """
+    This function loads the record manifests from the previous run for the loci which can be updated incrementally, that is those with a manifest of the same provenance and a full set of output files
+
+    Args:
+        loci (List[str]): the loci to be processed e.g. ['A', 'B', 'C']
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        output_path (str): the path to the output directory
+        provenance (str): the provenance of this run, from manifest_provenance, loci whose manifest has a different provenance are rebuilt in full
+
+    Returns:
+        Dict: the previous manifest entries keyed by locus and then record id, in the previous file order
+    """
+    previous_manifests = {}
+    for locus in loci:
+        filename = record_manifest_filename(output_path, species_slug, locus)
+        output_filenames = locus_output_filenames(output_path, species_slug, locus).values()
+        if os.path.exists(filename) and all([os.path.exists(output_filename) for output_filename in output_filenames]):
+            with open(filename, 'r') as json_file:
+                manifest = json.load(json_file)
+            if manifest.get('provenance') == provenance:
+                previous_manifests[locus] = {entry[0]:entry for entry in manifest['records']}
+    return previous_manifests
+
+
+def assign_canonical_protein_allele(protein_allele:Dict, species_slug:str) -> Dict:
+    """
+    This function finds the canonical allele (the one with the lowest number) and the canonical sequence for a protein allele
+
+    Args:
+        protein_allele (Dict): the protein allele dictionary, with its alleles and sequences
+        species_slug (str): a slugified version of the species prefix e.g. hla, h2
+
+    Returns:
+        Dict: the protein allele dictionary with the canonical allele and sequence assigned
+    """
+    allele_count = len(protein_allele['alleles'])
+    canonical_sequence = None
+    canonical_allele = None
+
+    # if there's more than one sequence and the species is not one with non-standard nomenclature, look for the canonical allele and sequence
+    if allele_count > 1 and species_slug not in non_standard_nomenclature_species:
+        protein_allele = find_canonical_allele(protein_allele)
+
+        # there may be many different length variants of the sequence, we just want the longest one to be the canonical one for matching
+        if len(protein_allele['sequences']) > 1:
+            max_sequence_length = 0
+            canonical_sequence = ''
+            # now iterate through the sequences
+            for sequence in protein_allele['sequences']:
+                # find the longest sequence, and make it the canonical one
+                if len(sequence) > max_sequence_length:
+                    max_sequence_length = len(sequence)
+                    canonical_sequence = sequence
+        else:
+            # or if there's no sequence variation, just make the first sequence in the array the canonical one
+            canonical_sequence = protein_allele['sequences'][0]
     else:
-        verbose = False
+        # if there is only one allele, the only allele is the canonical one and canonical sequence
+        protein_allele['canonical_allele'] = protein_allele['alleles'][0]
+        canonical_sequence = protein_allele['sequences'][0]
+    protein_allele['canonical_sequence'] = canonical_sequence
+    return protein_allele
+
 
-    total_sequences, protein_alleles, cytoplasmic_sequences, gdomain_sequences, pocket_pseudosequences, suffixed_alleles = generate_lists_for_locus(locus, species_slug, sequence_set, config, verbose)
+def save_locus_lists(locus:str, species_slug:str, output_path:str, locus_lists:Dict, provenance:str, verbose:bool, artifacts:Optional[ArtifactStore]=None) -> Dict:
+    """
+    This function assigns the canonical alleles and sequences for a specific locus and saves the lists in a set of files in the output directory
+
+    Args:
+        locus (str): the locus to be saved e.g. A for HLA-A
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        output_path (str): the path to the output directory
+        locus_lists (Dict): the accumulators for the locus generated by generate_lists_for_loci
+        provenance (str): the provenance of the record manifest, from manifest_provenance
+        verbose (bool): a boolean as to whether this step should output to the terminal
+        artifacts (ArtifactStore): the artifact store the lists are published to for later steps, if any
+
+    Returns:
+        Dict: the action dictionary for this locus which will be stored in the pipeline log
+    """
+    locus_lists = materialise_locus_lists(locus_lists)
+
+    locus_slug = f"{species_slug}_{locus.lower()}"
+
+    total_sequences = locus_lists['total_sequences']
+    protein_alleles = locus_lists['protein_alleles']
+    cytoplasmic_sequences = locus_lists['cytoplasmic_sequences']
+    gdomain_sequences = locus_lists['gdomain_sequences']
+    pocket_pseudosequences = locus_lists['pocket_pseudosequences']
+    suffixed_alleles = locus_lists['suffixed_alleles']
 
     # now we'll iterate through the alleles to find the canonical allele (the one with the lowest number)
     for allele in protein_alleles:
-        allele_count = len(protein_alleles[allele]['alleles'])
-        canonical_sequence = None
-        canonical_allele = None
-
-        # if there's more than one sequence and the species is not one with non-standard nomenclature, look for the canonical allele and sequence
-        if allele_count > 1 and species_slug not in non_standard_nomenclature_species:
-            protein_alleles[allele] = find_canonical_allele(protein_alleles[allele])
-
-            # there may be many different length variants of the sequence, we just want the longest one to be the canonical one for matching
-            if len(protein_alleles[allele]['sequences']) > 1:
-                max_sequence_length = 0
-                canonical_sequence = ''
-                # now iterate through the sequences
-                for sequence in protein_alleles[allele]['sequences']:
-                    # find the longest sequence, and make it the canonical one
-                    if len(sequence) > max_sequence_length:
-                        max_sequence_length = len(sequence)
-                        canonical_sequence = sequence
-            else:
-                # or if there's no sequence variation, just make the first sequence in the array the canonical one
-                canonical_sequence = protein_alleles[allele]['sequences'][0]
-        else:
-            # if there is only one allele, the only allele is the canonical one and canonical sequence
-            protein_alleles[allele]['canonical_allele'] = protein_alleles[allele]['alleles'][0]
-            canonical_sequence = protein_alleles[allele]['sequences'][0]
-        protein_alleles[allele]['canonical_sequence'] = canonical_sequence
+        protein_alleles[allele] = assign_canonical_protein_allele(protein_alleles[allele], species_slug)
+
 
+    # the manifest from a previous run no longer describes the files once any of them are rewritten
+    discard_record_manifest(output_path, species_slug, locus)
 
     # next we'll iterate through each type of sequence and process them and save each one to a file
     for sequence_type in ['cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences']:
@@ -202,23 +538,30 @@ def construct_class_i_locus_allele_lists(config:Dict, **kwargs) -> Dict:
         filename = f"{directory_path}/{species_slug}_{locus.lower()}.json"
         
         # parse the sequence dictionary to assign the canonical allele
-        sequence_list = parse_sequence_dict(eval(sequence_type), species_slug)
+        sequence_list = parse_sequence_dict(locus_lists[sequence_type], species_slug)
         
         # write the sequence dictionary
-        with open(filename, "w") as json_file:
-            json.dump(sequence_list, json_file, sort_keys=True, indent=4)
+        write_json_atomically(filename, sequence_list)
+
+        if artifacts is not None:
+            artifacts.publish(sequence_type, locus_slug, sequence_list, sort_keys=True)
 
     # now we'll output information on the null alleles to a file
     directory_path = f"{output_path}/processed_data/allele_suffixes"
     filename = f"{directory_path}/{species_slug}_{locus.lower()}.json"
-    with open(filename, "w") as json_file:
-        json.dump(suffixed_alleles, json_file, sort_keys=True, indent=4)
+    write_json_atomically(filename, suffixed_alleles)
+    if artifacts is not None:
+        artifacts.publish('allele_suffixes', locus_slug, suffixed_alleles, sort_keys=True)
 
     # now generate a dictionary file for alleles 
     directory_path = f"{output_path}/processed_data/protein_alleles"
     filename = f"{directory_path}/{species_slug}_{locus.lower()}.json"
-    with open(filename, "w") as json_file:
-        json.dump(protein_alleles, json_file, sort_keys=True, indent=4)
+    write_json_atomically(filename, protein_alleles)
+    if artifacts is not None:
+        artifacts.publish('protein_alleles', locus_slug, protein_alleles, sort_keys=True)
+
+    # save the manifest of records last, so that the next run only updates the files incrementally once they have all been written
+    save_record_manifest(output_path, species_slug, locus, locus_lists['manifest'], provenance)
 
     # output some statistics to the terminal if verbose is True
     if verbose:
@@ -241,3 +584,259 @@ def construct_class_i_locus_allele_lists(config:Dict, **kwargs) -> Dict:
     }
 
     return action_log
+
+
+def derive_sequence_keys(cytoplasmic_sequence:str, pocket_residues:List) -> Dict:
+    """
+    This function derives the keys of a record in each of the sequence dictionaries from its cytoplasmic sequence
+
+    Args:
+        cytoplasmic_sequence (str): the trimmed cytoplasmic sequence of the record
+        pocket_residues (List): the IMGT numbered pocket residues
+
+    Returns:
+        Dict: the record's key in each sequence dictionary, keyed by sequence type
+    """
+    pocket_pseudosequences, _ = build_pocket_pseudosequences([cytoplasmic_sequence], pocket_residues)
+    return {
+        'cytoplasmic_sequences': cytoplasmic_sequence,
+        'gdomain_sequences': cytoplasmic_sequence[:182],
+        'pocket_pseudosequences': pocket_pseudosequences[0]
+    }
+
+
+def patch_locus_lists(locus:str, species_slug:str, output_path:str, config:Dict, locus_lists:Dict, previous_manifest:Dict, provenance:str, verbose:bool, artifacts:Optional[ArtifactStore]=None) -> Optional[Dict]:
+    """
+    This function updates the saved files for a locus in place, using the differences between the previous record manifest and the current dataset
+
+    Records which have been removed or changed are taken out of the protein allele and sequence dictionaries, and new or changed records are added. Only the protein alleles and sequences affected are re-ordered and have their canonical allele reassigned, so the files are the same as a full rebuild.
+
+    Args:
+        locus (str): the locus to be updated e.g. A for HLA-A
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        output_path (str): the path to the output directory
+        config (Dict): the configuration dictionary
+        locus_lists (Dict): the accumulators for the locus generated by generate_lists_for_loci with a previous manifest
+        previous_manifest (Dict): the previous manifest entries for the locus keyed by record id
+        provenance (str): the provenance of the record manifest, from manifest_provenance
+        verbose (bool): a boolean as to whether this step should output to the terminal
+
+    Returns:
+        Dict: the action dictionary for this locus which will be stored in the pipeline log, or None if the locus cannot be updated incrementally and needs a full rebuild
+    """
+    pocket_residues = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
+    sequence_types = ['cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences']
+
+    manifest = locus_lists['manifest']
+    changed_records = locus_lists['changed_records']
+    current_manifest = {entry[0]:entry for entry in manifest}
+
+    removed_ids = [id for id in previous_manifest if id not in current_manifest or current_manifest[id] is not previous_manifest[id]]
+    added_ids = [entry[0] for entry in manifest if entry is not previous_manifest.get(entry[0])]
+
+    # the patched lists are only the same as a full rebuild if the records which are unchanged are still in the same relative order
+    previous_unchanged = [id for id in previous_manifest if current_manifest.get(id) is previous_manifest[id]]
+    current_unchanged = [entry[0] for entry in manifest if entry is previous_manifest.get(entry[0])]
+    if previous_unchanged != current_unchanged:
+        return None
+
+    filenames = locus_output_filenames(output_path, species_slug, locus)
+
+    action_log = {
+        'locus': f"{species_slug.upper()}-{locus}",
+        'incremental': True,
+        'records_added': len([id for id in added_ids if id not in previous_manifest]),
+        'records_changed': len([id for id in added_ids if id in previous_manifest]),
+        'records_removed': len([id for id in removed_ids if id not in current_manifest])
+    }
+
+    if removed_ids or added_ids:
+        data = {}
+        for data_type in filenames:
+            with open(filenames[data_type], 'r') as json_file:
+                data[data_type] = json.load(json_file)
+        protein_alleles = data['protein_alleles']
+
+        # the position of each record in the current dataset, the lists are in this order in a full rebuild
+        positions = {entry[0]:i for i, entry in enumerate(manifest)}
+
+        # the cytoplasmic sequence of each record, from which its keys in the other sequence dictionaries can be derived
+        record_sequences = {}
+        for cytoplasmic_sequence in data['cytoplasmic_sequences']:
+            for allele_info in data['cytoplasmic_sequences'][cytoplasmic_sequence]['alleles']:
+                record_sequences[allele_info['id']] = cytoplasmic_sequence
+
+        affected_alleles = set()
+        affected_sequences = {sequence_type:set() for sequence_type in sequence_types}
+
+        # first take out the records which have been removed or changed
+        for id in removed_ids:
+            allele_slug = previous_manifest[id][3]
+            if not allele_slug:
+                continue
+            affected_alleles.add(allele_slug)
+            protein_alleles[allele_slug]['alleles'] = [allele_info for allele_info in protein_alleles[allele_slug]['alleles'] if allele_info['id'] != id]
+            sequence_keys = derive_sequence_keys(record_sequences.pop(id), pocket_residues)
+            for sequence_type in sequence_types:
+                sequences = data[sequence_type]
+                key = sequence_keys[sequence_type]
+                sequences[key]['alleles'] = [allele_info for allele_info in sequences[key]['alleles'] if allele_info['id'] != id]
+                affected_sequences[sequence_type].add(key)
+
+        # then add the records which are new or changed
+        for id in added_ids:
+            if id not in changed_records:
+                continue
+            allele_info, sequence_data = changed_records[id]
+            allele_slug = current_manifest[id][3]
+            affected_alleles.add(allele_slug)
+            if allele_slug not in protein_alleles:
+                protein_alleles[allele_slug] = {
+                    'sequences':[],
+                    'alleles':[],
+                    'canonical_allele':'',
+                    'canonical_sequence':'',
+                    'gdomain_sequence':None,
+                    'pocket_pseudosequence':None
+                }
+            protein_alleles[allele_slug]['alleles'].append(allele_info)
+            record_sequences[id] = sequence_data['cytoplasmic_sequence']
+            sequence_keys = derive_sequence_keys(sequence_data['cytoplasmic_sequence'], pocket_residues)
+            for sequence_type in sequence_types:
+                sequences = data[sequence_type]
+                key = sequence_keys[sequence_type]
+                if key not in sequences:
+                    sequences[key] = {
+                        'alleles':[],
+                        'canonical_allele':{}
+                    }
+                sequences[key]['alleles'].append(allele_info)
+                affected_sequences[sequence_type].add(key)
+
+        # now reorder the affected protein alleles and reassign their sequences and canonical allele
+        for allele_slug in affected_alleles:
+            protein_allele = protein_alleles[allele_slug]
+            if not protein_allele['alleles']:
+                del protein_alleles[allele_slug]
+                continue
+            protein_allele['alleles'].sort(key=lambda allele_info: positions[allele_info['id']])
+            protein_allele['sequences'] = []
+            for allele_info in protein_allele['alleles']:
+                if record_sequences[allele_info['id']] not in protein_allele['sequences']:
+                    protein_allele['sequences'].append(record_sequences[allele_info['id']])
+            # the g-domain sequence and pocket pseudosequence of a protein allele are those of its first record
+            first_sequence_keys = derive_sequence_keys(protein_allele['sequences'][0], pocket_residues)
+            protein_allele['gdomain_sequence'] = first_sequence_keys['gdomain_sequences']
+            protein_allele['pocket_pseudosequence'] = first_sequence_keys['pocket_pseudosequences']
+            protein_allele['canonical_allele'] = ''
+            protein_alleles[allele_slug] = assign_canonical_protein_allele(protein_allele, species_slug)
+
+        # and the same for the affected entries in the sequence dictionaries
+        for sequence_type in sequence_types:
+            sequences = data[sequence_type]
+            affected = {}
+            for key in affected_sequences[sequence_type]:
+                if not sequences[key]['alleles']:
+                    del sequences[key]
+                    continue
+                sequences[key]['alleles'].sort(key=lambda allele_info: positions[allele_info['id']])
+                sequences[key]['canonical_allele'] = {}
+                affected[key] = sequences[key]
+            parse_sequence_dict(affected, species_slug)
+
+        # the suffixed alleles are rebuilt from the manifest in file order
+        suffixed_alleles = {}
+        for entry in manifest:
+            if entry[4]:
+                if entry[4] not in suffixed_alleles:
+                    suffixed_alleles[entry[4]] = []
+                suffixed_alleles[entry[4]].append(species_functions[species_slug](entry[1])['protein_allele_name'])
+        data['allele_suffixes'] = suffixed_alleles
+
+        discard_record_manifest(output_path, species_slug, locus)
+        for data_type in filenames:
+            write_json_atomically(filenames[data_type], data[data_type])
+            if artifacts is not None:
+                artifacts.publish(data_type, f"{species_slug}_{locus.lower()}", data[data_type], sort_keys=True)
+
+        save_record_manifest(output_path, species_slug, locus, manifest, provenance)
+
+        if verbose:
+            print (f"Updated {species_slug.upper()}-{locus}: {len(affected_alleles)} protein alleles affected")
+
+    else:
+        protein_alleles = load_artifact(artifacts, 'protein_alleles', f"{species_slug}_{locus.lower()}", output_path)
+        if verbose:
+            print (f"No changes to {species_slug.upper()}-{locus}")
+
+    action_log['sequences_processed'] = locus_lists['total_sequences']
+    action_log['alleles_found'] = len(protein_alleles)
+    return action_log
+
+
+def construct_class_i_locus_allele_lists(config:Dict, **kwargs) -> Dict:
+    """
+    This function creates the data for a set of loci in a single pass through a dataset and saves it in a set of files for each locus in the output directory
+
+    Args:
+        loci (List[str]): the loci to be processed in a dataset e.g. ['A', 'B', 'C'] for HLA-A, HLA-B and HLA-C
+        locus (str): a single locus to be processed, used if loci is not supplied e.g. A for HLA-A
+        species_slug (str): the slugified version of the species stem for the sequences e.g. hla for HLA
+        sequence_set (str): the dataset to be processed e.g. IPD_IMGT_HLA_PROT for the HLA protein sequence dataset from IPD/IMGT
+        config (Dict): the configuration dictionary
+        verbose (bool): a boolean as to whether this step should output to the terminal
+        force (bool): if True the files for every locus are rebuilt, otherwise loci with a record manifest of the same provenance from a previous run are updated incrementally
+        artifacts (ArtifactStore): the artifact store the lists for each locus are published to for later steps, if any
+        progress (ProgressReporter): the progress reporter the number of records read is passed to, if any
+
+    Returns:
+        Dict: the action dictionary for this step, keyed by locus, which will be stored in the pipeline log
+    """
+    if 'loci' in kwargs:
+        loci = kwargs['loci']
+    else:
+        loci = [kwargs['locus']]
+    species_slug = kwargs['species_slug']
+    sequence_set = kwargs['sequence_set']
+    output_path = kwargs['output_path']
+    if 'verbose' in kwargs:
+        verbose = kwargs['verbose']
+    else:
+        verbose = False
+
+    if 'artifacts' in kwargs:
+        artifacts = kwargs['artifacts']
+    else:
+        artifacts = None
+
+    if 'force' in kwargs:
+        force = kwargs['force']
+    else:
+        force = False
+
+    if 'progress' in kwargs:
+        progress = kwargs['progress']
+    else:
+        progress = None
+
+    provenance = manifest_provenance(config)
+    if force:
+        previous_manifests = {}
+    else:
+        previous_manifests = load_previous_manifests(loci, species_slug, output_path, provenance)
+
+    lists = generate_lists_for_loci(loci, species_slug, sequence_set, config, verbose, previous_manifests=previous_manifests, progress=progress)
+
+    action_log = {}
+    for locus in loci:
+        locus_action_log = None
+        if locus in previous_manifests:
+            locus_action_log = patch_locus_lists(locus, species_slug, output_path, config, lists[locus], previous_manifests[locus], provenance, verbose, artifacts=artifacts)
+            if locus_action_log is None:
+                # the dataset has been reordered, so fall back to a full rebuild of this locus
+                lists[locus] = generate_lists_for_loci([locus], species_slug, sequence_set, config, verbose)[locus]
+        if locus_action_log is None:
+            locus_action_log = save_locus_lists(locus, species_slug, output_path, lists[locus], provenance, verbose, artifacts=artifacts)
+        action_log[locus_action_log['locus']] = locus_action_log
+
+    return action_log
@@ -0,0 +1,240 @@
+from typing import Callable, Dict, List, Tuple
+
+from common.pipeline import reset_peak_rss, get_peak_rss, read_git_head, get_current_time, write_json_atomically
+from common.synthetic import generate_hla_fasta, generate_mhc_fasta
+
+from rich.console import Console
+import argparse
+import platform
+import tempfile
+import shutil
+import time
+import toml
+import json
+import os
+
+
+console = Console()
+
+
+def measure(function:Callable, *args, **kwargs) -> Tuple[object, Dict]:
+    """
+    Runs a function and measures its wall time, CPU time and peak resident set size
+
+    Args:
+        function (Callable): the function to be measured, called with the remaining arguments
+
+    Returns:
+        object: the return value of the function
+        Dict: the measurements
+    """
+    reset_peak_rss()
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+    result = function(*args, **kwargs)
+    measurements = {
+        'wall_time': round(time.perf_counter() - wall_before, 6),
+        'cpu_time': round(time.process_time() - cpu_before, 6),
+        'peak_rss': get_peak_rss()
+    }
+    return result, measurements
+
+
+def benchmark_find_closest_alleles(config:Dict, locus:str, vectorised:bool=False) -> int:
+    """
+    Finds the closest alleles with known motifs for every allele of a locus, as step 9 does
+
+    Args:
+        config (Dict): the configuration dictionary
+        locus (str): the locus to test e.g. A
+        vectorised (bool): whether all the alleles are compared at once with find_closest_alleles, otherwise find_closest_alleles_function is run for each allele
+
+    Returns:
+        int: the number of alleles tested
+    """
+    from find_allele_relationships import find_closest_alleles, find_closest_alleles_function
+
+    known_alleles = config['CONSTANTS']['MOTIF_ALLELES']
+    pocket_positions = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
+    known_pseudosequences = {}
+    for this_locus in config['CONSTANTS']['HLA_CLASS_I']:
+        with open(f"output/processed_data/protein_alleles/hla_{this_locus.lower()}.json", 'r') as json_file:
+            protein_alleles = json.load(json_file)
+        for allele_slug in protein_alleles:
+            if allele_slug in known_alleles:
+                known_pseudosequences[allele_slug] = protein_alleles[allele_slug]['pocket_pseudosequence']
+        if this_locus == locus:
+            alleles_to_test = {allele_slug:protein_alleles[allele_slug]['pocket_pseudosequence'] for allele_slug in protein_alleles if protein_alleles[allele_slug]['canonical_allele']['protein_allele_name'][-1] not in ['N', 'Q']}
+    if vectorised:
+        find_closest_alleles(alleles_to_test, known_alleles, known_pseudosequences, pocket_positions, mode='motif')
+    else:
+        for allele_slug in alleles_to_test:
+            find_closest_alleles_function(allele_slug, known_alleles, known_pseudosequences, alleles_to_test[allele_slug], pocket_positions, mode='motif')
+    return len(alleles_to_test)
+
+
+def run_benchmarks_at_scale(config:Dict, scale:float, seed:int, workers:int) -> Dict:
+    """
+    Generates synthetic datasets at a multiple of the size of a release and measures each benchmark on them, in a temporary working directory
+
+    The benchmarks run in pipeline order, as each uses the outputs of the ones before it.
+
+    Args:
+        config (Dict): the configuration dictionary
+        scale (float): the size of the datasets as a multiple of a release
+        seed (int): the seed for the synthetic datasets
+        workers (int): the number of worker processes for the bulk IPD-MHC parse
+
+    Returns:
+        Dict: the number of records in the datasets and the measurements for each benchmark
+    """
+    from common.allele import parse_hla_description
+    from common.fasta_index import load_fasta_index
+    from create_folder_structure import create_folder_structure
+    from parse_class_i_locus_data import generate_lists_for_locus, construct_class_i_locus_allele_lists
+    from parse_class_i_bulk_data import generate_lists
+    from construct_reference_allele_lists import construct_reference_allele_lists
+    from create_locus_pie_charts import create_locus_pie_charts
+    from create_allele_group_pie_chart import create_allele_group_pie_chart
+    from find_allele_relationships import find_allele_relationships
+    from create_tabular_representations import create_tabular_representations
+    from create_db_from_tabular_representations import create_db_from_tabular_representations
+
+    loci = config['CONSTANTS']['HLA_CLASS_I']
+    kwargs = {'verbose': False, 'force': True, 'output_path': 'output', 'log_path': 'logs'}
+
+    working_directory = os.getcwd()
+    benchmark_directory = tempfile.mkdtemp(prefix='allele_pipeline_benchmark_')
+    os.chdir(benchmark_directory)
+    try:
+        create_folder_structure(config, **kwargs)
+        for folder in ['output/processed_data/pie_charts/allele_groups', 'output/processed_data/relationships']:
+            os.makedirs(folder, exist_ok=True)
+
+        results = {'scale': scale, 'records': {}, 'benchmarks': {}}
+        results['records']['ipd_imgt_hla_prot'], results['benchmarks']['generate_hla_fasta'] = measure(generate_hla_fasta, 'tmp/ipd_imgt_hla_prot.fasta', scale=scale, seed=seed)
+        results['records']['ipd_mhc_prot'], results['benchmarks']['generate_mhc_fasta'] = measure(generate_mhc_fasta, 'tmp/ipd_mhc_prot.fasta', scale=scale, seed=seed)
+
+        # each benchmark is a name, the function to measure and its arguments
+        benchmarks = [
+            ('build_fasta_index', load_fasta_index, ['tmp/ipd_imgt_hla_prot.fasta', parse_hla_description], {}),
+            ('generate_lists_for_locus', generate_lists_for_locus, ['A', 'hla', 'IPD_IMGT_HLA_PROT', config, False], {}),
+            ('construct_class_i_locus_allele_lists', construct_class_i_locus_allele_lists, [config], {'loci': loci, 'species_slug': 'hla', 'sequence_set': 'IPD_IMGT_HLA_PROT', **kwargs}),
+            ('generate_lists', generate_lists, ['IPD_MHC_PROT'], {'verbose': False, 'workers': workers}),
+            ('construct_reference_allele_lists', lambda: [construct_reference_allele_lists(config, locus=locus, species_stem='hla', **kwargs) for locus in loci], [], {}),
+            ('find_closest_alleles_function', benchmark_find_closest_alleles, [config, 'A'], {}),
+            ('find_closest_alleles', benchmark_find_closest_alleles, [config, 'A'], {'vectorised': True}),
+            ('create_locus_pie_charts', lambda: [create_locus_pie_charts(config, locus=locus, species_stem='hla', **kwargs) for locus in loci], [], {}),
+            ('create_allele_group_pie_chart', lambda: [create_allele_group_pie_chart(config, locus=locus, species_stem='hla', **kwargs) for locus in loci], [], {}),
+            ('find_allele_relationships', lambda: [find_allele_relationships(config, locus=locus, loci=loci, species_stem='hla', **kwargs) for locus in loci], [], {}),
+            ('create_tabular_representations', lambda: [create_tabular_representations(config, locus=locus, species_stem='hla', **kwargs) for locus in loci], [], {}),
+            ('create_db_from_tabular_representations', create_db_from_tabular_representations, [config], {'loci': loci, 'species_stem': 'hla', **kwargs})
+        ]
+        for name, function, args, function_kwargs in benchmarks:
+            console.print(f"{scale}x {name}")
+            # a failing benchmark is recorded rather than ending the run, e.g. a step which runs out of memory at the larger scales
+            try:
+                _, results['benchmarks'][name] = measure(function, *args, **function_kwargs)
+            except Exception as error:
+                results['benchmarks'][name] = {'error': f"{type(error).__name__}: {error}"}
+            console.print(results['benchmarks'][name])
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(benchmark_directory)
+    return results
+
+
+def compare_with_baseline(results:Dict, baseline:Dict, threshold:float) -> List[str]:
+    """
+    Compares the results of a benchmark run with a baseline run and lists the measurements which have regressed by more than a threshold
+
+    Args:
+        results (Dict): the results of the benchmark run
+        baseline (Dict): the results of the baseline run
+        threshold (float): the fractional increase treated as a regression e.g. 0.25 for 25%
+
+    Returns:
+        List[str]: a description of each regression
+    """
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        if scale not in baseline['scales']:
+            continue
+        for name, measurements in scale_results['benchmarks'].items():
+            baseline_measurements = baseline['scales'][scale]['benchmarks'].get(name)
+            if baseline_measurements is None or 'error' in baseline_measurements or 'error' in measurements:
+                continue
+            for measurement in ['wall_time', 'peak_rss']:
+                if baseline_measurements[measurement] and measurements[measurement] > baseline_measurements[measurement] * (1 + threshold):
+                    regressions.append(f"{scale}x {name} {measurement}: {baseline_measurements[measurement]} -> {measurements[measurement]}")
+    return regressions
+
+
+def run_benchmarks(scales:List[float], seed:int=1, workers:int=1, benchmarks_path:str='benchmarks', save_baseline:bool=False, threshold:float=0.25) -> Dict:
+    """
+    Runs the benchmarks at each scale, saves the results and compares them with the stored baseline
+
+    Args:
+        scales (List[float]): the sizes of the synthetic datasets as multiples of a release e.g. [1, 10, 100]
+        seed (int): the seed for the synthetic datasets
+        workers (int): the number of worker processes for the bulk IPD-MHC parse
+        benchmarks_path (str): the folder the results and baseline are stored in
+        save_baseline (bool): whether these results should become the baseline
+        threshold (float): the fractional increase treated as a regression
+
+    Returns:
+        Dict: the results
+    """
+    config = {
+        'CONSTANTS': toml.load('constants.toml'),
+        'PATHS': {'TMP_PATH': 'tmp', 'OUTPUT_PATH': 'output', 'LOG_PATH': 'logs'}
+    }
+    results = {
+        'started_at': get_current_time(),
+        'pipeline_version': read_git_head(),
+        'python_version': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'scales': {}
+    }
+    for scale in scales:
+        results['scales'][str(scale)] = run_benchmarks_at_scale(config, scale, seed, workers)
+    results['completed_at'] = get_current_time()
+
+    os.makedirs(f"{benchmarks_path}/results", exist_ok=True)
+    write_json_atomically(f"{benchmarks_path}/results/{results['started_at'].replace(':', '-')}.json", results)
+
+    baseline_filename = f"{benchmarks_path}/baseline.json"
+    if os.path.exists(baseline_filename):
+        with open(baseline_filename, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_with_baseline(results, baseline, threshold)
+        if regressions:
+            console.print(f"Regressions of more than {int(threshold * 100)}% against the baseline from {baseline['started_at']}:")
+            for regression in regressions:
+                console.print(regression)
+        else:
+            console.print(f"No regressions of more than {int(threshold * 100)}% against the baseline from {baseline['started_at']}")
+    if save_baseline:
+        write_json_atomically(baseline_filename, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Allele Pipeline Benchmarks',
+                    description='This runs the pipeline steps on synthetic IPD-style datasets at multiples of the size of a release, and compares the time and memory they use with a stored baseline.',
+                    epilog='For more information see - https://github.com/histofyi/allele_pipeline')
+    parser.add_argument('-s', '--scales', help='the sizes of the synthetic datasets as multiples of a release, a comma separated list (1,10,100 is the default)', default='1,10,100')
+    parser.add_argument('--seed', help='the seed for the synthetic datasets (1 is the default)', type=int, default=1)
+    parser.add_argument('-w', '--workers', help='the number of worker processes for the bulk IPD-MHC parse (1 is the default)', type=int, default=1)
+    parser.add_argument('-b', '--save-baseline', help='saves the results as the baseline for later runs to be compared with', action='store_true')
+    parser.add_argument('-t', '--threshold', help='the fractional increase in time or memory reported as a regression (0.25 is the default)', type=float, default=0.25)
+    args = parser.parse_args()
+
+    scales = [float(scale) if '.' in scale else int(scale) for scale in args.scales.split(',')]
+    run_benchmarks(scales, seed=args.seed, workers=args.workers, save_baseline=args.save_baseline, threshold=args.threshold)
+
+
+if __name__ == '__main__':
+    main()
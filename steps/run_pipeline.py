@@ -1,139 +1,185 @@
-from typing import Dict
+from typing import Dict, List, Optional
 
-from common.pipeline import Pipeline
-
-from parse_class_i_locus_data import construct_class_i_locus_allele_lists
-from parse_class_i_bulk_data import construct_class_i_bulk_allele_lists
-from fetch_raw_data import fetch_raw_datasets
-from create_folder_structure import create_folder_structure
-from construct_reference_allele_lists import construct_reference_allele_lists
-from create_locus_pie_charts import create_locus_pie_charts
-from create_allele_group_pie_chart import create_allele_group_pie_chart
-from create_tabular_representations import create_tabular_representations
-from create_db_from_tabular_representations import create_db_from_tabular_representations
-from find_allele_relationships import find_allele_relationships
+from common.pipeline import Pipeline, load_config, get_output_paths
 
 from rich.console import Console
 import argparse
 
-def run_pipeline(verbose:bool=False, force:bool=False, mode:str='development') -> Dict:
+def locus_slugs(kwargs:Dict) -> List[str]:
+    """
+    Returns the slugs used in filenames for the locus, or loci, a step is run for e.g. hla_a
+
+    Args:
+        kwargs (Dict): the arguments for the step
+
+    Returns:
+        List[str]: the locus slugs
+    """
+    species = kwargs['species_slug'] if 'species_slug' in kwargs else kwargs['species_stem']
+    loci = [kwargs['locus']] if 'locus' in kwargs else kwargs['loci']
+    return [f"{species}_{locus.lower()}" for locus in loci]
+
+
+def select_steps(step_arguments:Dict, from_step:Optional[str]=None, only_step:Optional[str]=None, steps:Optional[List[str]]=None) -> Dict:
+    """
+    Selects the steps to be run, either a single step, a step and every step after it, or a list of steps
+
+    The steps which are not selected are assumed to have already been run, so their outputs are in place.
+
+    Args:
+        step_arguments (Dict): the arguments for each step of the pipeline, keyed by step number, in order
+        from_step (str): the step to start from e.g. 9
+        only_step (str): the only step to run e.g. 11
+        steps (List[str]): the steps to run e.g. ['9', '11'], an empty list runs no steps
+
+    Returns:
+        Dict: the arguments for each of the selected steps, in pipeline order
+    """
+    step_numbers = list(step_arguments.keys())
+    for step_number in [from_step, only_step] + (steps if steps is not None else []):
+        if step_number is not None and step_number not in step_numbers:
+            raise ValueError(f"Step {step_number} is not one of the steps run by the pipeline ({', '.join(step_numbers)})")
+    if steps is not None:
+        return {step_number:step_arguments[step_number] for step_number in step_numbers if step_number in steps}
+    if only_step is not None:
+        return {only_step:step_arguments[only_step]}
+    if from_step is not None:
+        return {step_number:step_arguments[step_number] for step_number in step_numbers[step_numbers.index(from_step):]}
+    return step_arguments
+
+
+def run_pipeline(verbose:bool=False, force:bool=False, mode:str='development', workers:int=1, profile:bool=False, resume:bool=False, from_step:Optional[str]=None, only_step:Optional[str]=None, selected_steps:Optional[List[str]]=None, metrics:bool=False, progress_interval:int=1000, upsert:bool=False, columnar:bool=False) -> Dict:
+    # the steps are registered by the module and name of their function, each module is only imported when its step is run
     steps = {
         '1':{
-            'function':create_folder_structure,
+            'function':'create_folder_structure.create_folder_structure',
             'title_template':'Creating the folder structure in the output directory',
             'list_item':'Creating the folder structure in the output directory'
         },
         '2':{
-            'function':fetch_raw_datasets,
+            'function':'fetch_raw_data.fetch_raw_datasets',
             'title_template':'Downloading latest versions of the IPD and H2 sequence datasets',
-            'list_item':'Downloading latest versions of the IPD and H2 sequence datasets'
+            'list_item':'Downloading latest versions of the IPD and H2 sequence datasets',
+            'depends_on':['1']
         },
         '3':{
-            'function':construct_class_i_locus_allele_lists,
-            'title_template':'Parsing IPD sequence set for HLA-{locus}',
-            'list_item':'Parsing the human Class I sequences from IPD'
+            'function':'parse_class_i_locus_data.construct_class_i_locus_allele_lists',
+            'title_template':'Parsing IPD sequence set for HLA Class I loci',
+            'list_item':'Parsing the human Class I sequences from IPD',
+            'depends_on':['2'],
+            'inputs': lambda kwargs: [f"tmp/{kwargs['sequence_set'].lower()}.fasta"],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/{data_type}/{locus_slug}.json" for locus_slug in locus_slugs(kwargs) for data_type in ['protein_alleles', 'cytoplasmic_sequences', 'gdomain_sequences', 'pocket_pseudosequences', 'allele_suffixes', 'record_manifests']]
         },
         '4':{
-            'function':construct_class_i_bulk_allele_lists,
+            'function':'parse_class_i_bulk_data.construct_class_i_bulk_allele_lists',
             'title_template':'Parsing IPD sequence set for non-human Class I',
-            'list_item':'Parsing the non-human Class I sequences from IPD'
+            'list_item':'Parsing the non-human Class I sequences from IPD',
+            'depends_on':['2'],
+            'worker_pool':True
         },
         '5':{
-            'function':construct_class_i_locus_allele_lists,
-            'title_template':'Parsing H2 sequence set for H2-{locus}',
-            'list_item':'Parsing the mouse Class I sequences from a custom dataset'
+            'function':'parse_class_i_locus_data.construct_class_i_locus_allele_lists',
+            'title_template':'Parsing H2 sequence set for H2 Class I loci',
+            'list_item':'Parsing the mouse Class I sequences from a custom dataset',
+            'depends_on':['2']
         },
         '6': {
-            'function': construct_reference_allele_lists,
+            'function': 'construct_reference_allele_lists.construct_reference_allele_lists',
             'title_template': 'Building reference allele lists',
-            'list_item': 'Building reference allele lists'
+            'list_item': 'Building reference allele lists',
+            'depends_on': ['3'],
+            'fan_out': True,
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/protein_alleles/{locus_slug}.json" for locus_slug in locus_slugs(kwargs)],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/{data_type}/{locus_slug}.json" for locus_slug in locus_slugs(kwargs) for data_type in ['reference_alleles', 'allele_groups']]
         },
         '7': {
-            'function': create_locus_pie_charts,
+            'function': 'create_locus_pie_charts.create_locus_pie_charts',
             'title_template': 'Creating the pie charts for each locus',
-            'list_item': 'Creating the pie charts for each locus'
+            'list_item': 'Creating the pie charts for each locus',
+            'depends_on': ['6'],
+            'fan_out': True,
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/allele_groups/{locus_slug}.json" for locus_slug in locus_slugs(kwargs)],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/pie_charts/{kwargs['locus'].lower()}{suffix}" for suffix in ['.png', '.svg', '_png.txt', '_svg.txt']]
         },
         '8': {
-            'function': create_allele_group_pie_chart,
+            'function': 'create_allele_group_pie_chart.create_allele_group_pie_chart',
             'title_template': 'Creating the pie charts for each allele group',
-            'list_item': 'Creating the pie charts for each allele group'
+            'list_item': 'Creating the pie charts for each allele group',
+            'depends_on': ['3'],
+            'fan_out': True,
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/pocket_pseudosequences/{locus_slug}.json" for locus_slug in locus_slugs(kwargs)],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/pie_charts/allele_groups/{locus_slug}_*.svg" for locus_slug in locus_slugs(kwargs)]
         },
         '9': {
-            'function': find_allele_relationships,
+            'function': 'find_allele_relationships.find_allele_relationships',
             'title_template': 'Creating a dataset of alleles closest/distant to those with know motifs',
-            'list_item': 'Creating a dataset of alleles closest/distant to those with know motifs'
+            'list_item': 'Creating a dataset of alleles closest/distant to those with know motifs',
+            'depends_on': ['3'],
+            'fan_out': True,
+            'gather': True,
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/protein_alleles/{kwargs['species_stem']}_{locus.lower()}.json" for locus in kwargs['loci']],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/relationships/{locus_slug}_distances.json" for locus_slug in locus_slugs(kwargs)] + [f"{kwargs['output_path']}/tabular_data/relationships/{locus_slug}_*.csv" for locus_slug in locus_slugs(kwargs)]
         },
         '10': {
-            'function': create_tabular_representations,
+            'function': 'create_tabular_representations.create_tabular_representations',
             'title_template': 'Creating the a tabular representation for each locus',
-            'list_item': 'Creating the a tabular representation for each locus'
+            'list_item': 'Creating the a tabular representation for each locus',
+            'depends_on': ['3'],
+            'fan_out': True,
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/protein_alleles/{locus_slug}.json" for locus_slug in locus_slugs(kwargs)],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/tabular_data/alleles/{locus_slug}.csv" for locus_slug in locus_slugs(kwargs)]
         },
         '11': {
-            'function': create_db_from_tabular_representations,
+            'function': 'create_db_from_tabular_representations.create_db_from_tabular_representations',
             'title_template': 'Creating a sqlite database from the tabular representations',
-            'list_item': 'Creating a sqlite database from the tabular representations'
+            'list_item': 'Creating a sqlite database from the tabular representations',
+            'depends_on': ['9', '10']
+        },
+        '12': {
+            'function': 'create_columnar_representations.create_columnar_representations',
+            'title_template': 'Creating a columnar representation for each locus',
+            'list_item': 'Creating a columnar representation for each locus',
+            'depends_on': ['9', '10'],
+            'fan_out': True,
+            # relationships are not found for HLA-E, F and G
+            'inputs': lambda kwargs: [f"{kwargs['output_path']}/tabular_data/alleles/{locus_slug}.csv" for locus_slug in locus_slugs(kwargs)] + [f"{kwargs['output_path']}/tabular_data/relationships/{locus_slug}_*.csv" for locus_slug in locus_slugs(kwargs) if locus_slug not in ['hla_e', 'hla_f', 'hla_g']],
+            'outputs': lambda kwargs: [f"{kwargs['output_path']}/columnar_data/*/{locus_slug}.parquet" for locus_slug in locus_slugs(kwargs)]
         }
     }
 
-    pipeline = Pipeline(steps, Console(), force=force, verbose=verbose, mode=mode)
+    pipeline = Pipeline(steps, Console(), force=force, verbose=verbose, mode=mode, profile=profile, resume=resume, metrics=metrics, progress_interval=progress_interval)
 
     hla_class_i = pipeline.get_config_item('CONSTANTS')['HLA_CLASS_I']
-    h2_class_i = ["K","D","L"]
-
-    # create the folder structure
-    pipeline.run_step('1')
-
-    # fetch the raw datasets
-    pipeline.run_step('2')
-
-    # parse the IPD sequence set for HLA
-    i = 1
-    for locus in hla_class_i:
-        pipeline.run_step('3', substep=i, locus=locus, species_slug='hla', sequence_set='IPD_IMGT_HLA_PROT')
-        i+=1
-
-    # parse the IPD sequence set for non-human Class I
-    #pipeline.run_step('4', sequence_set='IPD_MHC_PROT')
-
-    # parse the H2 sequence set for H2
-    #j = 1
-    #for locus in h2_class_i:
-    #    pipeline.run_step('5', substep=j, locus=locus, species_slug='h2', sequence_set='H2_CLASS_I_PROT')
-    #    j+=1
-
-    # build reference allele lists
-    i = 1
-    for locus in hla_class_i:
-        pipeline.run_step('6', locus=locus, species_stem='hla')
-        i+=1
-
-    # create the pie charts for each locus
-    i = 1
-    for locus in hla_class_i:
-        pipeline.run_step('7', locus=locus, species_stem='hla')
-        i+=1
-
-    # create the pie charts for each allele group
-    i = 1
-    for locus in hla_class_i:
-        pipeline.run_step('8', locus=locus, species_stem='hla')
-        i+=1
-
-    # find allele relationships
-    i = 1
-    for locus in hla_class_i:
-        if locus not in ['e', 'f', 'g']:
-            pipeline.run_step('9', locus=locus, loci=hla_class_i, species_stem='hla')
-            i+=1
-    
-    # create the tabular representations for each locus
-    i = 1
-    for locus in hla_class_i:
-        pipeline.run_step('10', locus=locus, species_stem='hla')
-        i+=1
 
-    # create the sqlite database from the tabular representations
-    pipeline.run_step('11', loci=hla_class_i, species_stem='hla')
+    # the arguments for each step to be run, steps declared with fan_out are run once for each locus
+    step_arguments = {
+        # create the folder structure
+        '1': {},
+        # fetch the raw datasets
+        '2': {},
+        # parse the IPD sequence set for HLA, all loci are parsed in a single pass through the sequence set
+        '3': {'loci':hla_class_i, 'species_slug':'hla', 'sequence_set':'IPD_IMGT_HLA_PROT'},
+        # parse the IPD sequence set for non-human Class I, the sequence set is split across a pool of worker processes when it is the only step being run
+        '4': {'sequence_set':'IPD_MHC_PROT'},
+        # parsing the H2 sequence set for H2 (step 5) is currently disabled
+        # build reference allele lists
+        '6': {'species_stem':'hla'},
+        # create the pie charts for each locus
+        '7': {'species_stem':'hla'},
+        # create the pie charts for each allele group
+        '8': {'species_stem':'hla'},
+        # find allele relationships
+        '9': {'loci':hla_class_i, 'species_stem':'hla'},
+        # create the tabular representations for each locus
+        '10': {'species_stem':'hla'},
+        # create the sqlite database from the tabular representations, in upsert mode only the rows which have changed are applied to the existing databases
+        '11': {'loci':hla_class_i, 'species_stem':'hla', 'upsert':upsert}
+    }
+    # the columnar export (step 12) is optional, as it needs pyarrow
+    if columnar:
+        step_arguments['12'] = {'species_stem':'hla'}
+
+    pipeline.run_steps(select_steps(step_arguments, from_step=from_step, only_step=only_step, steps=selected_steps), hla_class_i, workers=workers)
 
     action_logs = pipeline.finalise()
     
@@ -147,8 +193,31 @@ def main():
     parser.add_argument('-v','--verbose', help='increases output verbosity (non-verbosity is the default)', action='store_true')
     parser.add_argument('-f', '--force', help='forces reloading of underlying datasets (not forcing reload is the default)', action='store_true')
     parser.add_argument('-r', '--release', help='switch between development and release modes (development mode is the default)', action='store_true')
+    parser.add_argument('-w', '--workers', help='the number of worker processes to run independent steps and loci in parallel, or to parse the non-human sequence set when step 4 is run on its own (a single worker, running every step in turn, is the default)', type=int, default=1)
+    parser.add_argument('-p', '--profile', help='writes a cProfile dump of each step to the log directory (not profiling is the default)', action='store_true')
+    parser.add_argument('--resume', help='resumes the last run if it did not complete, skipping the steps it completed', action='store_true')
+    parser.add_argument('-m', '--metrics', help='writes Prometheus text metrics for the run to metrics.prom in the log directory, updated as each step starts and completes (no metrics file is the default)', action='store_true')
+    parser.add_argument('--progress-interval', help='the number of records between the progress events a step adds to the event log (1000 is the default)', type=int, default=1000)
+    parser.add_argument('-u', '--upsert', help='updates the existing SQLite databases with only the rows which have changed, rather than building them from scratch (building from scratch is the default)', action='store_true')
+    parser.add_argument('-c', '--columnar', help='also writes the alleles and relationships of each locus as Parquet files, which needs pyarrow (not writing Parquet files is the default)', action='store_true')
+    parser.add_argument('-s', '--serve', help='runs a read-only HTTP/JSON lookup service over the database built by a previous run, instead of running the pipeline', action='store_true')
+    parser.add_argument('--host', help='the address the lookup service listens on (127.0.0.1, the local machine, is the default)', default='127.0.0.1')
+    parser.add_argument('--port', help='the port the lookup service listens on (8080 is the default)', type=int, default=8080)
+    step_selection = parser.add_mutually_exclusive_group()
+    step_selection.add_argument('--from-step', help='runs the pipeline from this step onwards, using the outputs of earlier steps from a previous run')
+    step_selection.add_argument('--only-step', help='runs only this step, using the outputs of earlier steps from a previous run')
+    step_selection.add_argument('--steps', help='runs only these steps, a comma separated list e.g. 9,11, using the outputs of other steps from a previous run')
     args = parser.parse_args() 
 
+    if args.serve:
+        # the service module is only imported when it is run
+        from serve_lookups import serve_lookups
+        config = load_config(Console())
+        # the database built by the pipeline in the same mode is served, in release mode this is in the warehouse
+        output_path, log_path = get_output_paths(config, 'release' if args.release else 'development')
+        serve_lookups(config, host=args.host, port=args.port, database_filename=f"{output_path}/tabular_data/combined.db", output_path=output_path, verbose=args.verbose)
+        return
+
     if args.verbose:
         verbose = True
     else:
@@ -167,7 +236,7 @@ def main():
     print (verbose)
     print (force)
     print (mode)
-    output = run_pipeline(verbose=verbose, force=force, mode=mode)
+    output = run_pipeline(verbose=verbose, force=force, mode=mode, workers=args.workers, profile=args.profile, resume=args.resume, from_step=args.from_step, only_step=args.only_step, selected_steps=[step.strip() for step in args.steps.split(',') if step.strip()] if args.steps is not None else None, metrics=args.metrics, progress_interval=args.progress_interval, upsert=args.upsert, columnar=args.columnar)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,343 @@
+from typing import Dict, List
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import contextlib
+import functools
+import threading
+import queue
+import sqlite3
+import json
+import os
+
+from rich.console import Console
+
+
+console = Console()
+
+
+# the queries are kept as constants, so each connection prepares them once and reuses them from its statement cache
+ALLELE_QUERY = "SELECT * FROM alleles WHERE allele_slug = ?"
+ALLELE_RELATIONSHIPS_QUERY = "SELECT * FROM relationships WHERE allele_slug = ? ORDER BY relationship_type, distance, rowid"
+ALLELE_GROUP_QUERY = "SELECT allele_slug, allele FROM alleles WHERE allele_group_slug = ? ORDER BY rowid"
+LOCUS_QUERY = "SELECT allele_group_slug, allele_group, count(*) AS allele_count FROM alleles WHERE locus_slug = ? GROUP BY allele_group_slug, allele_group ORDER BY min(rowid)"
+NEAREST_QUERY = "SELECT * FROM relationships WHERE allele_slug = ? AND relationship_type = ? ORDER BY distance, rowid"
+KNOWN_ALLELES_QUERY = "SELECT * FROM alleles ORDER BY rowid"
+
+
+class LookupServiceError(Exception):
+    """
+    An error in a lookup which is returned to the client, with the HTTP status for the response
+    """
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+
+class AlleleLookups():
+    """
+    Read-only lookups of alleles, allele groups, loci and nearest known alleles from the combined database built by step 11
+
+    The lookups share a fixed pool of read-only connections to the database, so the connections, and the statements each has prepared, are reused by every request rather than opened for each request's thread. The results of the lookups are kept in an LRU cache, keyed by the generation of the database as well as the lookup. A new generation starts when the database is replaced by a later run, as step 11 swaps in a new file rather than changing the existing one, so results from the previous database are never returned once it has been replaced.
+    """
+    def __init__(self, config:Dict, database_filename:str='output/tabular_data/combined.db', output_path:str='output', cache_size:int=4096, pool_size:int=4):
+        self.config = config
+        self.database_filename = database_filename
+        self.output_path = output_path
+        self.pocket_positions = config['CONSTANTS']['IMGT_POCKET_RESIDUES']
+        self.relationship_types = config['CONSTANTS']['RELATIONSHIP_TYPES']
+        # each pooled connection is held with the generation of the database it was opened for, they are opened when first needed
+        self.connections = queue.Queue()
+        for i in range(pool_size):
+            self.connections.put((None, None))
+        self.lock = threading.Lock()
+        self.database_version = None
+        self.generation = 0
+        self.reference_panel = None
+        self.frequencies = self.load_frequencies()
+        for lookup in ['allele', 'allele_group', 'locus', 'nearest', 'nearest_to_pseudosequence']:
+            setattr(self, lookup, functools.lru_cache(maxsize=cache_size)(getattr(self, f"_{lookup}")))
+        self.check_database()
+
+
+    def load_frequencies(self) -> Dict[str, Dict]:
+        """
+        Loads the 1000 Genomes frequencies of the alleles and allele groups, if they have been built, so they are read once rather than for each request
+
+        Returns:
+            Dict[str, Dict]: the frequencies in each population, keyed by allele or allele group slug
+        """
+        frequencies = {}
+        for filename in [f"{self.output_path}/processed_data/1kgenomes/1k_alleles.json", f"{self.output_path}/processed_data/1kgenomes/1k_allele_groups.json"]:
+            if os.path.exists(filename):
+                with open(filename, 'r') as json_file:
+                    # both files group their entries, by allele group or by locus
+                    for grouped_frequencies in json.load(json_file).values():
+                        frequencies.update(grouped_frequencies)
+        return frequencies
+
+
+    def check_database(self):
+        """
+        Checks whether the database has been replaced since it was last checked, if so a new generation is started, the cached lookups are cleared and the pooled connections are reopened when they are next used
+
+        Returns:
+            int: the generation of the database
+        """
+        if not os.path.exists(self.database_filename):
+            raise LookupServiceError(503, f"{self.database_filename} has not been built, run the pipeline first")
+        stat = os.stat(self.database_filename)
+        database_version = (stat.st_ino, stat.st_mtime_ns)
+        if database_version != self.database_version:
+            with self.lock:
+                if database_version != self.database_version:
+                    for lookup in ['allele', 'allele_group', 'locus', 'nearest', 'nearest_to_pseudosequence']:
+                        getattr(self, lookup).cache_clear()
+                    self.reference_panel = None
+                    self.generation += 1
+                    self.database_version = database_version
+        return self.generation
+
+
+    @contextlib.contextmanager
+    def connection(self, generation:int):
+        """
+        Takes a read-only connection to the database from the pool for the duration of a lookup, waiting for one to be returned if they are all in use
+
+        A connection opened for an earlier generation of the database is closed and replaced.
+
+        Args:
+            generation (int): the generation of the database the lookup is for
+
+        Returns:
+            sqlite3.Connection: the connection
+        """
+        connection_generation, connection = self.connections.get()
+        try:
+            if connection_generation != generation:
+                if connection is not None:
+                    connection.close()
+                # connections are shared by the request threads, but only used by one thread at a time
+                connection = sqlite3.connect(f"file:{self.database_filename}?mode=ro", uri=True, cached_statements=16, check_same_thread=False)
+                connection.row_factory = sqlite3.Row
+                connection_generation = generation
+            yield connection
+        finally:
+            self.connections.put((connection_generation, connection))
+
+
+    def allele_dictionary(self, row:sqlite3.Row) -> Dict:
+        """
+        Converts a row of the alleles table to a dictionary, with the pocket residues as a pseudosequence
+
+        Args:
+            row (sqlite3.Row): the row
+
+        Returns:
+            Dict: the allele
+        """
+        allele = {key:row[key] for key in row.keys() if not key.startswith('alpha_')}
+        allele['pocket_pseudosequence'] = ''.join([row[f"alpha_{position}"] or '' for position in self.pocket_positions])
+        return allele
+
+
+    def relationship_dictionary(self, row:sqlite3.Row) -> Dict:
+        """
+        Converts a row of the relationships table to a dictionary, with the polymorphisms keyed by position
+
+        Args:
+            row (sqlite3.Row): the row
+
+        Returns:
+            Dict: the relationship
+        """
+        relationship = {key:row[key] for key in row.keys() if not key.startswith('alpha_')}
+        relationship['polymorphisms'] = {position:row[f"alpha_{position}"] for position in self.pocket_positions if row[f"alpha_{position}"]}
+        return relationship
+
+
+    def _allele(self, generation:int, allele_slug:str) -> Dict:
+        # an allele, with its relationships to the known alleles and its 1000 Genomes frequencies
+        with self.connection(generation) as connection:
+            row = connection.execute(ALLELE_QUERY, (allele_slug,)).fetchone()
+            if row is None:
+                raise LookupServiceError(404, f"{allele_slug} is not in the database")
+            allele = self.allele_dictionary(row)
+            allele['relationships'] = {relationship_type:[] for relationship_type in self.relationship_types}
+            for relationship in connection.execute(ALLELE_RELATIONSHIPS_QUERY, (allele_slug,)):
+                allele['relationships'].setdefault(relationship['relationship_type'], []).append(self.relationship_dictionary(relationship))
+        allele['frequencies'] = self.frequencies.get(allele_slug)
+        return allele
+
+
+    def _allele_group(self, generation:int, allele_group_slug:str) -> Dict:
+        # the alleles of an allele group, with the 1000 Genomes frequencies of the group
+        with self.connection(generation) as connection:
+            alleles = [dict(row) for row in connection.execute(ALLELE_GROUP_QUERY, (allele_group_slug.upper(),))]
+        if not alleles:
+            raise LookupServiceError(404, f"{allele_group_slug} is not in the database")
+        return {'allele_group_slug': allele_group_slug.upper(), 'alleles': alleles, 'frequencies': self.frequencies.get(allele_group_slug.lower())}
+
+
+    def _locus(self, generation:int, locus:str) -> Dict:
+        # the allele groups of a locus and the number of alleles in each
+        # loci can be given as the locus e.g. A or its slug e.g. hla_a
+        locus = locus.split('_')[-1].upper()
+        with self.connection(generation) as connection:
+            allele_groups = [dict(row) for row in connection.execute(LOCUS_QUERY, (locus,))]
+        if not allele_groups:
+            raise LookupServiceError(404, f"{locus} is not in the database")
+        return {'locus': locus, 'allele_count': sum([allele_group['allele_count'] for allele_group in allele_groups]), 'allele_groups': allele_groups}
+
+
+    def _nearest(self, generation:int, allele_slug:str, relationship_type:str) -> Dict:
+        # the nearest known alleles found for an allele by step 9
+        self.check_relationship_type(relationship_type)
+        with self.connection(generation) as connection:
+            relationships = [self.relationship_dictionary(row) for row in connection.execute(NEAREST_QUERY, (allele_slug, relationship_type))]
+        if not relationships:
+            raise LookupServiceError(404, f"There are no {relationship_type} relationships for {allele_slug} in the database")
+        return {'allele_slug': allele_slug, 'relationship_type': relationship_type, 'nearest_known_alleles': relationships}
+
+
+    def _nearest_to_pseudosequence(self, generation:int, pseudosequence:str, relationship_type:str) -> Dict:
+        # the nearest known alleles to a pocket pseudosequence which may not be in the database, found as step 9 does
+        from find_allele_relationships import find_closest_alleles
+
+        self.check_relationship_type(relationship_type)
+        if len(pseudosequence) != len(self.pocket_positions) or not pseudosequence.isalpha():
+            raise LookupServiceError(400, f"A pocket pseudosequence has one residue for each of the {len(self.pocket_positions)} pocket positions")
+        known_alleles = self.config['CONSTANTS'][f"{relationship_type.upper()}_ALLELES"]
+        known_pseudosequences = self.known_pseudosequences(generation)[relationship_type]
+        closest_alleles = find_closest_alleles({'query': pseudosequence.upper()}, known_alleles, known_pseudosequences, self.pocket_positions, mode=relationship_type)['query']
+        # the relationships are given in the same form as those from the database
+        relationships = [{
+            'known_allele_slug': closest_allele['nearest_known_allele'],
+            'distance': closest_allele['distance'],
+            'relationship_label': closest_allele['relationship_label'],
+            'relationship_type': relationship_type,
+            'polymorphisms': {position:f"{polymorphism['from']}{position}{polymorphism['to']}" for position, polymorphism in (closest_allele['polymorphisms'] or {}).items()}
+        } for closest_allele in closest_alleles]
+        return {'pocket_pseudosequence': pseudosequence.upper(), 'relationship_type': relationship_type, 'nearest_known_alleles': relationships}
+
+
+    def known_pseudosequences(self, generation:int) -> Dict[str, Dict[str, str]]:
+        """
+        Returns the reference panel, the pocket pseudosequences of the known alleles for each relationship type, built once for each generation of the database from the alleles table
+
+        Args:
+            generation (int): the generation of the database the lookup is for
+
+        Returns:
+            Dict[str, Dict[str, str]]: the pocket pseudosequence of each known allele, keyed by relationship type and then allele slug, in the order of the alleles table
+        """
+        if self.reference_panel is not None and self.reference_panel[0] == generation:
+            return self.reference_panel[1]
+        with self.connection(generation) as connection:
+            known_alleles = {relationship_type:set(self.config['CONSTANTS'][f"{relationship_type.upper()}_ALLELES"]) for relationship_type in self.relationship_types}
+            reference_panel = {relationship_type:{} for relationship_type in self.relationship_types}
+            for row in connection.execute(KNOWN_ALLELES_QUERY):
+                for relationship_type in self.relationship_types:
+                    if row['allele_slug'] in known_alleles[relationship_type]:
+                        reference_panel[relationship_type][row['allele_slug']] = self.allele_dictionary(row)['pocket_pseudosequence']
+        self.reference_panel = (generation, reference_panel)
+        return reference_panel
+
+
+    def check_relationship_type(self, relationship_type:str):
+        """
+        Checks that a relationship type requested by a client is one of those in the database
+
+        Args:
+            relationship_type (str): the relationship type e.g. motif
+        """
+        if relationship_type not in self.relationship_types:
+            raise LookupServiceError(400, f"{relationship_type} is not one of the relationship types ({', '.join(self.relationship_types)})")
+
+
+    def lookup(self, path:str, parameters:Dict[str, List[str]]) -> Dict:
+        """
+        Runs the lookup for the path of a request
+
+        The paths are /alleles/{allele_slug}, /allele_groups/{allele_group_slug}, /loci/{locus} and /nearest/{allele_slug} or /nearest?pseudosequence={pocket_pseudosequence}, the nearest known alleles are for the relationship type given by the type parameter (motif is the default).
+
+        Args:
+            path (str): the path of the request e.g. /alleles/hla_a_02_01
+            parameters (Dict[str, List[str]]): the query parameters of the request
+
+        Returns:
+            Dict: the result of the lookup
+        """
+        generation = self.check_database()
+        elements = [element for element in path.split('/') if element]
+        relationship_type = parameters.get('type', ['motif'])[0]
+        if len(elements) == 2 and elements[0] == 'alleles':
+            return self.allele(generation, elements[1].lower())
+        elif len(elements) == 2 and elements[0] == 'allele_groups':
+            return self.allele_group(generation, elements[1])
+        elif len(elements) == 2 and elements[0] == 'loci':
+            return self.locus(generation, elements[1])
+        elif len(elements) == 2 and elements[0] == 'nearest':
+            return self.nearest(generation, elements[1].lower(), relationship_type)
+        elif len(elements) == 1 and elements[0] == 'nearest' and 'pseudosequence' in parameters:
+            return self.nearest_to_pseudosequence(generation, parameters['pseudosequence'][0], relationship_type)
+        raise LookupServiceError(404, f"{path} is not a lookup, the lookups are /alleles/{{allele_slug}}, /allele_groups/{{allele_group_slug}}, /loci/{{locus}}, /nearest/{{allele_slug}} and /nearest?pseudosequence={{pocket_pseudosequence}}")
+
+
+def lookup_request_handler(lookups:AlleleLookups, verbose:bool=False) -> type:
+    """
+    This function returns the request handler class for the lookup service, which answers GET requests with JSON
+
+    Args:
+        lookups (AlleleLookups): the lookups for the service
+        verbose (bool): whether each request is logged to the terminal
+
+    Returns:
+        type: the request handler class
+    """
+    class LookupRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                status, body = 200, lookups.lookup(url.path, parse_qs(url.query))
+            except LookupServiceError as error:
+                status, body = error.status, {'error': str(error)}
+            response = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return LookupRequestHandler
+
+
+def serve_lookups(config:Dict, host:str='127.0.0.1', port:int=8080, database_filename:str='output/tabular_data/combined.db', output_path:str='output', cache_size:int=4096, pool_size:int=4, verbose:bool=False):
+    """
+    Runs the read-only lookup service over the database built by the pipeline, until it is interrupted
+
+    Args:
+        config (Dict): the configuration dictionary
+        host (str): the address the service listens on, the local machine is the default
+        port (int): the port the service listens on
+        database_filename (str): the path to the combined database
+        output_path (str): the path to the output directory, for the 1000 Genomes frequencies
+        cache_size (int): the number of results of each lookup kept in the LRU cache
+        pool_size (int): the number of connections to the database shared by the requests
+        verbose (bool): whether each request is logged to the terminal
+    """
+    lookups = AlleleLookups(config, database_filename=database_filename, output_path=output_path, cache_size=cache_size, pool_size=pool_size)
+    server = ThreadingHTTPServer((host, port), lookup_request_handler(lookups, verbose=verbose))
+    console.print(f"Serving lookups from {database_filename} at http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
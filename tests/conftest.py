@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the steps import each other and the common modules from the steps folder, as they do when the pipeline is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps'))
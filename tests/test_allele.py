@@ -0,0 +1,127 @@
+import random
+
+import pytest
+
+from common.allele import build_pocket_pseudosequence, class_i_starts, process_sequence
+
+
+pocket_residues = [7, 9, 24, 45, 59, 62, 63, 66, 67, 69, 70, 73, 74, 76, 77, 80, 81, 84, 95, 97, 99, 114, 116, 118, 143, 147, 150, 152, 156, 158, 159, 163, 167, 171]
+
+# the residues of the start motifs, so the background of a sequence is full of near misses
+alphabet = sorted(set(''.join(class_i_starts)))
+
+
+def baseline_process_sequence(sequence, pocket_residues):
+    """
+    The previous implementation, which tested each start motif in turn
+    """
+    missing_start = None
+    cytoplasmic_sequence = None
+    gdomain_sequence = None
+    pocket_pseudosequence = None
+    appropriate_length = None
+    start_match = False
+    has_class_i_start = False
+    if len(sequence) > 270:
+        appropriate_length = True
+        for start in class_i_starts:
+            if start in sequence:
+                has_class_i_start = True
+                start_string = start
+                missing_start = False
+                start_match = True
+                break
+            elif start[1:] in sequence and not start_match:
+                has_class_i_start = True
+                start_string = start[1:]
+                missing_start = True
+    else:
+        appropriate_length = False
+    if has_class_i_start:
+        cytoplasmic_sequence = start_string + sequence.split(start_string)[1]
+        if missing_start:
+            cytoplasmic_sequence = f"-{cytoplasmic_sequence[:274]}"
+        cytoplasmic_sequence = cytoplasmic_sequence[:275]
+        gdomain_sequence = cytoplasmic_sequence[:182]
+        if pocket_residues:
+            pocket_pseudosequence = build_pocket_pseudosequence(cytoplasmic_sequence, pocket_residues)
+    return {
+            'cytoplasmic_sequence':cytoplasmic_sequence,
+            'gdomain_sequence':gdomain_sequence,
+            'pocket_pseudosequence':pocket_pseudosequence,
+            'class_i_start':has_class_i_start,
+            'missing_start':missing_start,
+            'appropriate_length':appropriate_length
+    }
+
+
+def outcome(function, sequence):
+    # a motif close to the end of a sequence leaves too few residues for the pocket pseudosequence, which both implementations reject
+    try:
+        return function(sequence, pocket_residues)
+    except IndexError:
+        return IndexError
+
+
+def overlapping_motifs():
+    """
+    Finds the pairs of start motifs, full or truncated, where the end of one is the start of the other, joined on their overlap
+    """
+    motifs = set(class_i_starts) | set(start[1:] for start in class_i_starts)
+    joined = []
+    for first in motifs:
+        for second in motifs:
+            for overlap in range(1, min(len(first), len(second))):
+                if first != second and first[-overlap:] == second[:overlap]:
+                    joined.append(first + second[overlap:])
+    return sorted(joined)
+
+
+def random_sequence(generator, joined_motifs):
+    """
+    Generates a sequence containing several start motifs, which may be full or truncated, overlapping or repeated
+    """
+    sequence = [generator.choice(alphabet) for i in range(generator.randint(260, 420))]
+    only_truncated = generator.random() < 0.3
+    for i in range(generator.randint(0, 5)):
+        choice = generator.random()
+        if choice < 0.3 and not only_truncated:
+            motif = generator.choice(class_i_starts)
+        elif choice < 0.6:
+            motif = generator.choice(class_i_starts)[1:]
+        elif only_truncated:
+            continue
+        else:
+            motif = generator.choice(joined_motifs)
+        # most motifs are placed near the start of the sequence, some over an earlier one, some are repeated later on
+        position = generator.randint(0, 120)
+        sequence[position:position + len(motif)] = motif
+        if generator.random() < 0.2:
+            position = generator.randint(0, len(sequence) - len(motif))
+            sequence[position:position + len(motif)] = motif
+    return ''.join(sequence)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_process_sequence_matches_the_previous_implementation(seed):
+    generator = random.Random(seed)
+    joined_motifs = overlapping_motifs()
+    truncated_starts = 0
+    for i in range(400):
+        sequence = random_sequence(generator, joined_motifs)
+        result = outcome(process_sequence, sequence)
+        assert result == outcome(baseline_process_sequence, sequence), sequence
+        if result is not IndexError and result['missing_start']:
+            truncated_starts += 1
+    # the sequences include ones where only a truncated start is found
+    assert truncated_starts > 0
+
+
+def test_overlapping_full_and_truncated_starts():
+    background = 'A' * 300
+    # the truncated start of a later motif inside an earlier full start, two overlapping full starts and several truncated starts, each repeated after the cytoplasmic sequence
+    for motifs in [['GSHSMRY'], ['GDTRPRYSHSMRY'], ['RSHSMRYSHSLRY'], ['SHSMRY', 'GSHSLRY'], ['SHSLRY', 'SHSMRY', 'HSFSRF']]:
+        sequence = background[:20] + 'W'.join(motifs) + background + ''.join(motifs)
+        result = process_sequence(sequence, pocket_residues)
+        assert result['class_i_start']
+        assert result == baseline_process_sequence(sequence, pocket_residues), sequence
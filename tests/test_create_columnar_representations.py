@@ -0,0 +1,74 @@
+import csv
+import os
+
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet
+
+from create_columnar_representations import create_columnar_representations
+
+
+config = {'CONSTANTS': {'IMGT_POCKET_RESIDUES': [7, 9], 'RELATIONSHIP_TYPES': ['motif', 'structure']}}
+
+alleles = [
+    ['allele_slug', 'allele', 'allele_id', 'allele_url', 'allele_group_slug', 'allele_group', 'locus_slug', 'locus', 'species', 'netmhcpan_pseudosequence', 'alpha_7', 'alpha_9'],
+    ['hla_a_01_01', 'HLA-A*01:01', 'imgt/hla:HLA00001', 'https://www.ebi.ac.uk/ipd/imgt/hla/alleles/allele/?accession=HLA00001', 'HLA_A_01', 'HLA-A*01', 'A', 'HLA-A', 'homo_sapiens', 'YF', 'Y', 'F'],
+    ['hla_a_02_01', 'HLA-A*02:01', 'imgt/hla:HLA00005', '', 'HLA_A_02', 'HLA-A*02', 'A', 'HLA-A', 'homo_sapiens', '', 'Y', 'Y']
+]
+
+relationships = {
+    'motif': [
+        ['allele_slug', 'known_allele_slug', 'distance', 'relationship_label', 'relationship_type', 'alpha_7', 'alpha_9'],
+        ['hla_a_01_01', 'hla_a_01_01', '0', 'experimentally_determined_motif', 'motif', '', ''],
+        ['hla_a_02_01', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'motif', '', 'F9Y']
+    ],
+    'structure': [
+        ['allele_slug', 'known_allele_slug', 'distance', 'relationship_label', 'relationship_type', 'alpha_7', 'alpha_9'],
+        ['hla_a_02_01', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'structure', '', 'F9Y']
+    ]
+}
+
+
+def write_csv(filename, rows):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', newline='') as filehandle:
+        csv.writer(filehandle).writerows(rows)
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    write_csv(f"{tmp_path}/tabular_data/alleles/hla_a.csv", alleles)
+    for relationship_type, rows in relationships.items():
+        write_csv(f"{tmp_path}/tabular_data/relationships/hla_a_{relationship_type}.csv", rows)
+    return str(tmp_path)
+
+
+def test_parquet_files_have_the_rows_of_the_csv_files(output_path):
+    action_log = create_columnar_representations(config, locus='A', species_stem='hla', output_path=output_path)
+    assert {table_name:log['rows'] for table_name, log in action_log.items()} == {'alleles': 2, 'relationships': 3}
+
+    table = pyarrow.parquet.read_table(f"{output_path}/columnar_data/alleles/hla_a.parquet")
+    assert table.column_names == alleles[0]
+    assert table.schema.field('alpha_7').type == pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    assert table.schema.field('allele').type == pyarrow.string()
+    # empty cells are read as nulls, as they are stored as NULL in the database
+    assert [list(row.values()) for row in table.to_pylist()] == [[value if value != '' else None for value in row] for row in alleles[1:]]
+
+    table = pyarrow.parquet.read_table(f"{output_path}/columnar_data/relationships/hla_a.parquet")
+    assert table.schema.field('distance').type == pyarrow.int16()
+    assert [list(row.values()) for row in table.to_pylist()] == [[int(value) if i == 2 else (value if value != '' else None) for i, value in enumerate(row)] for row in relationships['motif'][1:] + relationships['structure'][1:]]
+    assert sorted(os.listdir(f"{output_path}/columnar_data/relationships")) == ['hla_a.parquet']
+
+
+def test_header_which_does_not_match_the_schema_is_rejected(output_path):
+    create_columnar_representations(config, locus='A', species_stem='hla', output_path=output_path)
+    previous = pyarrow.parquet.read_table(f"{output_path}/columnar_data/relationships/hla_a.parquet")
+
+    write_csv(f"{output_path}/tabular_data/relationships/hla_a_structure.csv", [row[:-1] for row in relationships['structure']])
+    with pytest.raises(ValueError):
+        create_columnar_representations(config, locus='A', species_stem='hla', output_path=output_path)
+
+    # the previous file is left in place and the partly written file is removed
+    assert pyarrow.parquet.read_table(f"{output_path}/columnar_data/relationships/hla_a.parquet").equals(previous)
+    assert sorted(os.listdir(f"{output_path}/columnar_data/relationships")) == ['hla_a.parquet']
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+
+import pytest
+
+from create_db_from_tabular_representations import create_dbs_from_tables
+
+
+pocket_positions = [7, 9]
+
+alleles = [
+    ['allele_slug', 'allele', 'allele_id', 'allele_url', 'allele_group_slug', 'allele_group', 'locus_slug', 'locus', 'species', 'netmhcpan_pseudosequence', 'alpha_7', 'alpha_9'],
+    ['hla_a_01_01', 'HLA-A*01:01', 'imgt/hla:HLA00001', 'https://www.ebi.ac.uk/ipd/imgt/hla/alleles/allele/?accession=HLA00001', 'HLA_A_01', 'HLA-A*01', 'A', 'HLA-A', 'homo_sapiens', 'YF', 'Y', 'F'],
+    ['hla_a_02_01', 'HLA-A*02:01', 'imgt/hla:HLA00005', 'https://www.ebi.ac.uk/ipd/imgt/hla/alleles/allele/?accession=HLA00005', 'HLA_A_02', 'HLA-A*02', 'A', 'HLA-A', 'homo_sapiens', 'YY', 'Y', 'Y'],
+    ['hla_b_07_02', 'HLA-B*07:02', 'imgt/hla:HLA00132', 'https://www.ebi.ac.uk/ipd/imgt/hla/alleles/allele/?accession=HLA00132', 'HLA_B_07', 'HLA-B*07', 'B', 'HLA-B', 'homo_sapiens', 'YY', 'Y', 'Y']
+]
+
+relationships = [
+    ['allele_slug', 'known_allele_slug', 'distance', 'relationship_label', 'relationship_type', 'alpha_7', 'alpha_9'],
+    ['hla_a_01_01', 'hla_a_01_01', '0', 'experimentally_determined_motif', 'motif', '', ''],
+    ['hla_a_02_01', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'motif', '', 'F9Y'],
+    ['hla_b_07_02', 'hla_a_02_01', '0', 'exact_pseudosequence_match', 'motif', '', ''],
+    ['hla_b_07_02', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'structure', '', 'F9Y']
+]
+
+
+def database_filenames(path):
+    return {
+        f"{path}/alleles.db": ['alleles'],
+        f"{path}/relationships.db": ['relationships'],
+        f"{path}/combined.db": ['alleles', 'relationships']
+    }
+
+
+def read_table(database_filename, table_name):
+    connection = sqlite3.connect(database_filename)
+    rows = connection.execute(f"SELECT * FROM {table_name} ORDER BY rowid").fetchall()
+    connection.close()
+    return rows
+
+
+def test_databases_have_the_schema_and_rows_of_the_csv_files(tmp_path):
+    databases = database_filenames(tmp_path)
+    result = create_dbs_from_tables({'alleles': alleles, 'relationships': relationships}, databases, pocket_positions, batch_size=2)
+    assert result['row_counts'] == {'alleles': 3, 'relationships': 4}
+
+    connection = sqlite3.connect(f"{tmp_path}/combined.db")
+    assert [(column[1], column[2], column[3]) for column in connection.execute("PRAGMA table_info(relationships)")] == [
+        ('allele_slug', 'TEXT', 1), ('known_allele_slug', 'TEXT', 1), ('distance', 'INTEGER', 1), ('relationship_label', 'TEXT', 0), ('relationship_type', 'TEXT', 1), ('alpha_7', 'TEXT', 0), ('alpha_9', 'TEXT', 0)
+    ]
+    assert [column[1] for column in connection.execute("PRAGMA table_info(alleles)")] == alleles[0]
+    # the keys of each table are unique and the lookup columns are indexed
+    indexes = dict(connection.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'").fetchall())
+    assert indexes == {'alleles_key': 'alleles', 'alleles_locus_slug': 'alleles', 'alleles_allele_group_slug': 'alleles', 'relationships_key': 'relationships', 'relationships_known_allele_slug': 'relationships'}
+    # the distance is stored as an integer and empty cells as NULL
+    assert connection.execute("SELECT typeof(distance), typeof(alpha_7), typeof(alpha_9) FROM relationships WHERE allele_slug = 'hla_a_02_01'").fetchone() == ('integer', 'null', 'text')
+    connection.close()
+
+    expected_alleles = [tuple(row) for row in alleles[1:]]
+    expected_relationships = [tuple(int(value) if i == 2 else (value if value != '' else None) for i, value in enumerate(row)) for row in relationships[1:]]
+    assert read_table(f"{tmp_path}/alleles.db", 'alleles') == expected_alleles
+    assert read_table(f"{tmp_path}/relationships.db", 'relationships') == expected_relationships
+    assert read_table(f"{tmp_path}/combined.db", 'alleles') == expected_alleles
+    assert read_table(f"{tmp_path}/combined.db", 'relationships') == expected_relationships
+
+
+def interrupted(rows, after):
+    for i, row in enumerate(rows):
+        if i == after:
+            raise RuntimeError('interrupted')
+        yield row
+
+
+@pytest.mark.parametrize('upsert', [False, True])
+def test_interrupted_build_leaves_the_previous_databases_in_place(tmp_path, upsert):
+    databases = database_filenames(tmp_path)
+    create_dbs_from_tables({'alleles': alleles, 'relationships': relationships}, databases, pocket_positions)
+    previous = {database_filename:{table_name:read_table(database_filename, table_name) for table_name in table_names} for database_filename, table_names in databases.items()}
+
+    changed_alleles = [alleles[0]] + [row[:9] + ['FF', 'F', 'F'] for row in alleles[1:]]
+    with pytest.raises(RuntimeError):
+        create_dbs_from_tables({'alleles': changed_alleles, 'relationships': interrupted(relationships, 3)}, databases, pocket_positions, upsert=upsert, batch_size=1)
+
+    assert {database_filename:{table_name:read_table(database_filename, table_name) for table_name in table_names} for database_filename, table_names in databases.items()} == previous
+    assert sorted(os.listdir(tmp_path)) == ['alleles.db', 'combined.db', 'relationships.db']
+
+
+def test_header_which_does_not_match_the_schema_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        create_dbs_from_tables({'alleles': [alleles[0][:-1]] + alleles[1:]}, {f"{tmp_path}/alleles.db": ['alleles']}, pocket_positions)
+    assert os.listdir(tmp_path) == []
+
+
+def read_table_by_key(database_filename, table_name, key_columns):
+    connection = sqlite3.connect(database_filename)
+    rows = connection.execute(f"SELECT * FROM {table_name} ORDER BY {', '.join(key_columns)}").fetchall()
+    connection.close()
+    return rows
+
+
+def read_rowids(database_filename, table_name):
+    connection = sqlite3.connect(database_filename)
+    rowids = dict(connection.execute(f"SELECT allele_slug || ' ' || known_allele_slug || ' ' || relationship_type, rowid FROM {table_name}").fetchall())
+    connection.close()
+    return rowids
+
+
+def read_schema(database_filename):
+    connection = sqlite3.connect(database_filename)
+    schema = sorted(connection.execute("SELECT type, name, tbl_name, sql FROM sqlite_master").fetchall())
+    connection.close()
+    return schema
+
+
+def test_upsert_gives_the_same_databases_as_a_full_rebuild(tmp_path):
+    os.makedirs(f"{tmp_path}/upserted")
+    os.makedirs(f"{tmp_path}/rebuilt")
+    upserted = database_filenames(f"{tmp_path}/upserted")
+    rebuilt = database_filenames(f"{tmp_path}/rebuilt")
+    create_dbs_from_tables({'alleles': alleles, 'relationships': relationships}, upserted, pocket_positions)
+    previous_rowids = read_rowids(f"{tmp_path}/upserted/relationships.db", 'relationships')
+
+    # one allele is removed, one has changed and one is new, one relationship is removed, one has changed and one is new
+    changed_alleles = [alleles[0], alleles[1], alleles[2][:9] + ['YF', 'Y', 'F'], ['hla_b_08_01', 'HLA-B*08:01', 'imgt/hla:HLA00146', 'https://www.ebi.ac.uk/ipd/imgt/hla/alleles/allele/?accession=HLA00146', 'HLA_B_08', 'HLA-B*08', 'B', 'HLA-B', 'homo_sapiens', 'DY', 'D', 'Y']]
+    changed_relationships = [relationships[0], relationships[1], ['hla_a_02_01', 'hla_a_01_01', '2', 'nearest_pseudosequence_match', 'motif', 'Y7D', 'F9Y'], relationships[4], ['hla_b_08_01', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'motif', 'Y7D', '']]
+
+    result = create_dbs_from_tables({'alleles': changed_alleles, 'relationships': changed_relationships}, upserted, pocket_positions, upsert=True)
+    create_dbs_from_tables({'alleles': changed_alleles, 'relationships': changed_relationships}, rebuilt, pocket_positions)
+
+    assert result['changes'][f"{tmp_path}/upserted/combined.db"] == {
+        'alleles': {'inserted': 1, 'updated': 1, 'deleted': 1, 'rebuilt': False},
+        'relationships': {'inserted': 1, 'updated': 1, 'deleted': 1, 'rebuilt': False}
+    }
+    for database_filename, table_names in upserted.items():
+        rebuilt_filename = database_filename.replace('upserted', 'rebuilt')
+        assert read_schema(database_filename) == read_schema(rebuilt_filename)
+        for table_name in table_names:
+            key_columns = ['allele_slug', 'known_allele_slug', 'relationship_type'] if table_name == 'relationships' else ['allele_slug']
+            assert read_table_by_key(database_filename, table_name, key_columns) == read_table_by_key(rebuilt_filename, table_name, key_columns)
+
+    # only the changed row is updated, the rows which have not changed are left in place
+    rowids = read_rowids(f"{tmp_path}/upserted/relationships.db", 'relationships')
+    for row in [relationships[1], relationships[4]]:
+        key = f"{row[0]} {row[1]} {row[4]}"
+        assert rowids[key] == previous_rowids[key]
@@ -0,0 +1,136 @@
+import csv
+import json
+import os
+import random
+
+import pytest
+
+from find_allele_relationships import find_allele_relationships, find_closest_alleles, find_closest_alleles_function, tabulate_relationships
+
+
+pocket_positions = [7, 9, 24, 45, 59, 62, 63, 66]
+
+
+def random_pseudosequence(generator):
+    # a small alphabet gives many alleles at the same distance from several known alleles
+    return ''.join(generator.choice('ACD') for position in pocket_positions)
+
+
+def random_panel(seed):
+    """
+    Generates known alleles, some sharing a pseudosequence, and alleles to test, some of which are known alleles and some of which share a pseudosequence
+    """
+    generator = random.Random(seed)
+    known_pseudosequences = {}
+    for i in range(12):
+        if known_pseudosequences and generator.random() < 0.25:
+            known_pseudosequences[f"hla_a_known_{i}"] = generator.choice(list(known_pseudosequences.values()))
+        else:
+            known_pseudosequences[f"hla_a_known_{i}"] = random_pseudosequence(generator)
+    known_alleles = list(known_pseudosequences.keys())
+
+    alleles_to_test = {}
+    for i in range(200):
+        choice = generator.random()
+        if choice < 0.1:
+            allele_slug = generator.choice(known_alleles)
+            alleles_to_test[allele_slug] = known_pseudosequences[allele_slug]
+        elif choice < 0.2:
+            alleles_to_test[f"hla_a_{i}"] = generator.choice(list(known_pseudosequences.values()))
+        elif choice < 0.4 and alleles_to_test:
+            alleles_to_test[f"hla_a_{i}"] = generator.choice(list(alleles_to_test.values()))
+        else:
+            alleles_to_test[f"hla_a_{i}"] = random_pseudosequence(generator)
+    return alleles_to_test, known_alleles, known_pseudosequences
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('block_size', [3, 2048])
+def test_find_closest_alleles_matches_the_search_for_each_allele(seed, block_size):
+    alleles_to_test, known_alleles, known_pseudosequences = random_panel(seed)
+
+    closest_alleles = find_closest_alleles(alleles_to_test, known_alleles, known_pseudosequences, pocket_positions, mode='motif', block_size=block_size)
+
+    assert list(closest_alleles.keys()) == list(alleles_to_test.keys())
+    for allele_slug, allele_pseudosequence in alleles_to_test.items():
+        assert closest_alleles[allele_slug] == find_closest_alleles_function(allele_slug, known_alleles, known_pseudosequences, allele_pseudosequence, pocket_positions, mode='motif')
+
+
+def test_find_closest_alleles_covers_each_relationship_label():
+    alleles_to_test, known_alleles, known_pseudosequences = random_panel(0)
+    # the first known allele is searched first, so a copy of its pseudosequence matches it rather than a later known allele with the same pseudosequence
+    known_pseudosequences['hla_a_known_12'] = known_pseudosequences['hla_a_known_0']
+    alleles_to_test['hla_a_copy'] = known_pseudosequences['hla_a_known_0']
+    # an allele with two known alleles at the same, smallest, distance
+    known_pseudosequences['hla_a_known_13'] = 'DDDDDDDA'
+    known_pseudosequences['hla_a_known_14'] = 'DDDDDDAD'
+    alleles_to_test['hla_a_tie'] = 'DDDDDDAA'
+    known_alleles = list(known_pseudosequences.keys())
+
+    closest_alleles = find_closest_alleles(alleles_to_test, known_alleles, known_pseudosequences, pocket_positions, mode='motif', block_size=3)
+
+    labels = set(relationship['relationship_label'] for relationships in closest_alleles.values() for relationship in relationships)
+    assert labels == {'experimentally_determined_motif', 'exact_pseudosequence_match', 'nearest_pseudosequence_match'}
+    assert closest_alleles['hla_a_copy'][0]['nearest_known_allele'] == 'hla_a_known_0'
+    assert [(relationship['nearest_known_allele'], relationship['distance']) for relationship in closest_alleles['hla_a_tie']][-2:] == [('hla_a_known_13', 1), ('hla_a_known_14', 1)]
+    for allele_slug, allele_pseudosequence in alleles_to_test.items():
+        assert closest_alleles[allele_slug] == find_closest_alleles_function(allele_slug, known_alleles, known_pseudosequences, allele_pseudosequence, pocket_positions, mode='motif')
+
+
+def write_protein_alleles(output_path, locus, protein_alleles):
+    os.makedirs(f"{output_path}/processed_data/protein_alleles", exist_ok=True)
+    with open(f"{output_path}/processed_data/protein_alleles/hla_{locus.lower()}.json", 'w') as json_file:
+        json.dump(protein_alleles, json_file)
+
+
+def random_protein_alleles(locus, generator):
+    """
+    Generates the protein alleles of a locus, many of which share a pocket pseudosequence, and some of which are null or questionable alleles
+    """
+    protein_alleles = {}
+    pseudosequences = []
+    for i in range(1, 120):
+        if pseudosequences and generator.random() < 0.5:
+            pocket_pseudosequence = generator.choice(pseudosequences)
+        else:
+            pocket_pseudosequence = random_pseudosequence(generator)
+            pseudosequences.append(pocket_pseudosequence)
+        suffix = generator.choice(['', '', '', '', 'N', 'Q'])
+        protein_alleles[f"hla_{locus.lower()}_01_{i:02d}"] = {
+            'canonical_allele': {'protein_allele_name': f"HLA-{locus}*01:{i:02d}{suffix}"},
+            'pocket_pseudosequence': pocket_pseudosequence
+        }
+    return protein_alleles
+
+
+def test_relationship_csvs_match_the_search_for_each_allele(tmp_path):
+    generator = random.Random(1)
+    loci = ['A', 'B']
+    output_path = str(tmp_path / 'output')
+    protein_alleles = {locus:random_protein_alleles(locus, generator) for locus in loci}
+    for locus in loci:
+        write_protein_alleles(output_path, locus, protein_alleles[locus])
+    for folder in ['processed_data/relationships', 'tabular_data/relationships']:
+        os.makedirs(f"{output_path}/{folder}", exist_ok=True)
+
+    relationship_types = ['motif', 'structure']
+    config = {'CONSTANTS': {
+        'RELATIONSHIP_TYPES': relationship_types,
+        'MOTIF_ALLELES': ['hla_a_01_01', 'hla_a_01_05', 'hla_a_01_09', 'hla_b_01_02', 'hla_b_01_07'],
+        'STRUCTURE_ALLELES': ['hla_b_01_03', 'hla_a_01_02', 'hla_b_01_11'],
+        'IMGT_POCKET_RESIDUES': pocket_positions
+    }}
+
+    find_allele_relationships(config, locus='A', loci=loci, species_stem='hla', output_path=output_path)
+
+    # the known alleles are searched in the order of the loci and of the alleles in their files
+    alleles_to_test = {allele_slug:protein_allele['pocket_pseudosequence'] for allele_slug, protein_allele in protein_alleles['A'].items() if protein_allele['canonical_allele']['protein_allele_name'][-1] not in ['N', 'Q']}
+    for relationship_type in relationship_types:
+        known_alleles = config['CONSTANTS'][f"{relationship_type.upper()}_ALLELES"]
+        known_pseudosequences = {allele_slug:protein_allele['pocket_pseudosequence'] for locus in loci for allele_slug, protein_allele in protein_alleles[locus].items() if allele_slug in known_alleles}
+        relationships = {allele_slug:find_closest_alleles_function(allele_slug, known_alleles, known_pseudosequences, allele_pseudosequence, pocket_positions, mode=relationship_type) for allele_slug, allele_pseudosequence in alleles_to_test.items()}
+        expected_rows, outliers, distance_counts = tabulate_relationships(relationships, relationship_type, pocket_positions)
+
+        with open(f"{output_path}/tabular_data/relationships/hla_a_{relationship_type}.csv", 'r', newline='') as csv_file:
+            rows = list(csv.reader(csv_file))
+        assert rows == [[str(value) for value in row] for row in expected_rows]
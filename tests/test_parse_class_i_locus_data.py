@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+import toml
+
+import parse_class_i_locus_data
+from parse_class_i_locus_data import construct_class_i_locus_allele_lists, locus_output_filenames, record_manifest_filename
+from create_folder_structure import create_folder_structure
+from common.allele import fasta_reader
+from common.synthetic import generate_hla_fasta
+
+
+constants_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'constants.toml')
+fasta_filename = 'tmp/ipd_imgt_hla_prot.fasta'
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {
+        'CONSTANTS': toml.load(constants_path),
+        'PATHS': {'TMP_PATH': 'tmp', 'OUTPUT_PATH': 'output', 'LOG_PATH': 'logs'}
+    }
+    create_folder_structure(config, verbose=False, output_path='output', log_path='logs')
+    generate_hla_fasta(fasta_filename, scale=0.05, seed=1)
+    return config
+
+
+def construct_locus_a(config, force=False):
+    return construct_class_i_locus_allele_lists(config, loci=['A'], species_slug='hla', sequence_set='IPD_IMGT_HLA_PROT', output_path='output', verbose=False, force=force)
+
+
+def read_locus_a_files():
+    files = {}
+    for data_type, filename in locus_output_filenames('output', 'hla', 'A').items():
+        with open(filename, 'r') as json_file:
+            files[data_type] = json.load(json_file)
+    return files
+
+
+def update_dataset():
+    """
+    Changes the sequence of one HLA-A record, removes another and adds a new one at the end, keeping the order of the other records
+    """
+    records = list(fasta_reader(fasta_filename))
+    locus_a = [i for i, (description, sequence) in enumerate(records) if description.split(' ')[1].startswith('A*')]
+    description, sequence = records[locus_a[0]]
+    records[locus_a[0]] = (description, sequence[:100] + ('W' if sequence[100] != 'W' else 'Y') + sequence[101:])
+    added = (f"HLA:HLA99999 {records[locus_a[1]][0].split(' ')[1][:-2]}99 {len(records[locus_a[1]][1])} bp", records[locus_a[1]][1])
+    del records[locus_a[2]]
+    records.append(added)
+    with open(fasta_filename, 'w') as fasta_file:
+        for description, sequence in records:
+            fasta_file.write(f">{description}\n")
+            for start in range(0, len(sequence), 60):
+                fasta_file.write(f"{sequence[start:start + 60]}\n")
+
+
+def interrupt_after_first_data_file(monkeypatch):
+    write_json_atomically = parse_class_i_locus_data.write_json_atomically
+    def interrupted_write(filename, data):
+        write_json_atomically(filename, data)
+        if 'record_manifests' not in filename:
+            raise Interrupted(filename)
+    monkeypatch.setattr(parse_class_i_locus_data, 'write_json_atomically', interrupted_write)
+
+
+@pytest.mark.parametrize('force', [False, True])
+def test_interrupted_update_gives_the_same_files_as_a_full_rebuild(config, monkeypatch, force):
+    construct_locus_a(config)
+    update_dataset()
+
+    with monkeypatch.context() as patch:
+        interrupt_after_first_data_file(patch)
+        with pytest.raises(Interrupted):
+            construct_locus_a(config, force=force)
+
+    # the manifest is removed before the first file is written, so the next run cannot patch the partly written files
+    assert not os.path.exists(record_manifest_filename('output', 'hla', 'A'))
+
+    action_log = construct_locus_a(config)
+    assert 'incremental' not in action_log['HLA-A']
+    recovered = read_locus_a_files()
+
+    construct_locus_a(config, force=True)
+    assert recovered == read_locus_a_files()
+
+
+def test_incremental_update_gives_the_same_files_as_a_full_rebuild(config):
+    construct_locus_a(config)
+    update_dataset()
+
+    action_log = construct_locus_a(config)
+    assert action_log['HLA-A']['incremental']
+    patched = read_locus_a_files()
+
+    construct_locus_a(config, force=True)
+    assert patched == read_locus_a_files()
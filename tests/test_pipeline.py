@@ -0,0 +1,54 @@
+import os
+
+from common.pipeline import Pipeline
+
+
+def stub_pipeline(steps):
+    # the pipeline is created without loading the configuration files or the repository information, as only the step fingerprint is tested
+    pipeline = Pipeline.__new__(Pipeline)
+    pipeline.steps = steps
+    pipeline.config = {'CONSTANTS': {'IMGT_POCKET_RESIDUES': [7, 9]}}
+    return pipeline
+
+
+steps = {
+    '6': {
+        'function': 'construct_reference_allele_lists.construct_reference_allele_lists',
+        'inputs': lambda kwargs: [f"{kwargs['output_path']}/processed_data/protein_alleles/hla_{kwargs['locus'].lower()}.json"]
+    }
+}
+
+
+def write_input(output_path, contents):
+    os.makedirs(f"{output_path}/processed_data/protein_alleles", exist_ok=True)
+    with open(f"{output_path}/processed_data/protein_alleles/hla_a.json", 'w') as json_file:
+        json_file.write(contents)
+
+
+def test_step_with_a_missing_input_is_not_fingerprinted(tmp_path):
+    pipeline = stub_pipeline(steps)
+    assert pipeline.fingerprint_step('6', {'locus': 'A', 'output_path': str(tmp_path / 'warehouse')}) is None
+
+
+def test_fingerprint_follows_the_inputs_in_the_output_path(tmp_path):
+    pipeline = stub_pipeline(steps)
+    output_path = str(tmp_path / 'warehouse')
+    kwargs = {'locus': 'A', 'output_path': output_path}
+
+    write_input(output_path, '{"hla_a_01_01": {}}')
+    fingerprint = pipeline.fingerprint_step('6', kwargs)
+    assert fingerprint is not None
+    assert pipeline.fingerprint_step('6', kwargs) == fingerprint
+
+    write_input(output_path, '{"hla_a_01_02": {}}')
+    assert pipeline.fingerprint_step('6', kwargs) != fingerprint
+
+
+def test_worker_pool_size_is_not_fingerprinted(tmp_path):
+    pipeline = stub_pipeline(steps)
+    output_path = str(tmp_path / 'warehouse')
+    write_input(output_path, '{"hla_a_01_01": {}}')
+
+    fingerprint = pipeline.fingerprint_step('6', {'locus': 'A', 'output_path': output_path, 'workers': 1})
+    assert pipeline.fingerprint_step('6', {'locus': 'A', 'output_path': output_path, 'workers': 8}) == fingerprint
+    assert pipeline.step_cache_key('6', {'locus': 'A', 'workers': 1}) == pipeline.step_cache_key('6', {'locus': 'A', 'workers': 8})
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from create_db_from_tabular_representations import create_dbs_from_tables
+from serve_lookups import AlleleLookups, LookupServiceError
+
+
+pocket_positions = [7, 9]
+
+config = {'CONSTANTS': {
+    'IMGT_POCKET_RESIDUES': pocket_positions,
+    'RELATIONSHIP_TYPES': ['motif'],
+    'MOTIF_ALLELES': ['hla_a_01_01']
+}}
+
+allele_headers = ['allele_slug', 'allele', 'allele_id', 'allele_url', 'allele_group_slug', 'allele_group', 'locus_slug', 'locus', 'species', 'netmhcpan_pseudosequence', 'alpha_7', 'alpha_9']
+relationship_headers = ['allele_slug', 'known_allele_slug', 'distance', 'relationship_label', 'relationship_type', 'alpha_7', 'alpha_9']
+
+
+def allele_row(allele_slug, pocket_pseudosequence):
+    elements = allele_slug.split('_')
+    allele_group_slug = '_'.join(elements[:3]).upper()
+    return [allele_slug, f"HLA-{elements[1].upper()}*{elements[2]}:{elements[3]}", 'imgt/hla:HLA00001', '', allele_group_slug, allele_group_slug, elements[1].upper(), f"HLA-{elements[1].upper()}", 'homo_sapiens', pocket_pseudosequence, pocket_pseudosequence[0], pocket_pseudosequence[1]]
+
+
+def build_database(path, alleles):
+    tables = {
+        'alleles': [allele_headers] + [allele_row(allele_slug, pocket_pseudosequence) for allele_slug, pocket_pseudosequence in alleles.items()],
+        'relationships': [relationship_headers, ['hla_a_02_01', 'hla_a_01_01', '1', 'nearest_pseudosequence_match', 'motif', '', 'F9Y']]
+    }
+    create_dbs_from_tables(tables, {f"{path}/combined.db": ['alleles', 'relationships']}, pocket_positions)
+
+
+@pytest.fixture
+def lookups(tmp_path):
+    build_database(tmp_path, {'hla_a_01_01': 'YF', 'hla_a_02_01': 'YY'})
+    return AlleleLookups(config, database_filename=f"{tmp_path}/combined.db", output_path=str(tmp_path))
+
+
+def test_lookups_of_an_allele_and_its_nearest_known_alleles(lookups):
+    allele = lookups.lookup('/alleles/hla_a_02_01', {})
+    assert allele['pocket_pseudosequence'] == 'YY'
+    assert [(relationship['known_allele_slug'], relationship['distance'], relationship['polymorphisms']) for relationship in allele['relationships']['motif']] == [('hla_a_01_01', 1, {9: 'F9Y'})]
+
+    nearest = lookups.lookup('/nearest', {'pseudosequence': ['yy']})
+    assert [(relationship['known_allele_slug'], relationship['distance'], relationship['polymorphisms']) for relationship in nearest['nearest_known_alleles']] == [('hla_a_01_01', 1, {9: 'F9Y'})]
+
+
+@pytest.mark.parametrize('path, parameters, status', [
+    ('/alleles/hla_a_03_01', {}, 404),
+    ('/loci/b', {}, 404),
+    ('/unknown', {}, 404),
+    ('/nearest', {'pseudosequence': ['Y']}, 400),
+    ('/nearest', {'pseudosequence': ['Y1']}, 400),
+    ('/nearest/hla_a_02_01', {'type': ['unknown']}, 400)
+])
+def test_lookup_errors(lookups, path, parameters, status):
+    with pytest.raises(LookupServiceError) as error:
+        lookups.lookup(path, parameters)
+    assert error.value.status == status
+
+
+def test_cached_lookups_are_cleared_when_the_database_is_replaced(lookups, tmp_path):
+    assert lookups.lookup('/alleles/hla_a_02_01', {})['pocket_pseudosequence'] == 'YY'
+    with pytest.raises(LookupServiceError):
+        lookups.lookup('/alleles/hla_a_03_01', {})
+    assert lookups.lookup('/nearest', {'pseudosequence': ['DF']})['nearest_known_alleles'][0]['known_allele_slug'] == 'hla_a_01_01'
+
+    # a later run swaps in a new database, in which the alleles and the reference panel have changed
+    build_database(tmp_path, {'hla_a_01_01': 'DF', 'hla_a_02_01': 'YF', 'hla_a_03_01': 'YD'})
+
+    assert lookups.lookup('/alleles/hla_a_02_01', {})['pocket_pseudosequence'] == 'YF'
+    assert lookups.lookup('/alleles/hla_a_03_01', {})['pocket_pseudosequence'] == 'YD'
+    assert lookups.lookup('/nearest', {'pseudosequence': ['DF']})['nearest_known_alleles'][0]['relationship_label'] == 'exact_pseudosequence_match'
+
+
+def test_database_which_has_not_been_built(tmp_path):
+    with pytest.raises(LookupServiceError) as error:
+        AlleleLookups(config, database_filename=f"{tmp_path}/combined.db", output_path=str(tmp_path))
+    assert error.value.status == 503